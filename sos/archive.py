@@ -9,6 +9,8 @@
 # version 2 of the GNU General Public License.
 #
 # See the LICENSE file in the source distribution for further information.
+import gzip
+import hashlib
 import os
 import tarfile
 import shutil
@@ -17,11 +19,15 @@ import codecs
 import errno
 import stat
 import re
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from threading import Lock
 
-from importlib.util import find_spec
-from sos.utilities import sos_get_command_output
+from sos.utilities import sos_get_command_output, copy_file
 
 try:
     import selinux
@@ -31,11 +37,46 @@ except ImportError:
     # the sos archive
     pass
 
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 P_FILE = "file"
 P_LINK = "link"
 P_NODE = "node"
 P_DIR = "dir"
 
+#: Flags applied to every regex used for file content substitutions
+SUB_FLAGS = re.IGNORECASE | re.MULTILINE
+
+
+@lru_cache(maxsize=1024)
+def compile_sub_regex(regexp, flags=SUB_FLAGS):
+    """Compile a regex used to substitute content in the archive, merging in
+    the given flags. Compiled patterns are cached, as the same handful of
+    patterns are applied to a large number of files by plugins.
+
+    :param regexp:  The regex to compile
+    :type regexp: ``str`` or compiled ``re`` object
+
+    :param flags:   Flags to add to those already set on `regexp`
+    :type flags: ``int``
+
+    :returns: The compiled regex
+    :rtype: ``re.Pattern``
+    """
+    if hasattr(regexp, "pattern"):
+        if regexp.flags | flags == regexp.flags:
+            return regexp
+        return re.compile(regexp.pattern, regexp.flags | flags)
+    return re.compile(regexp, flags)
+
 
 class Archive(object):
     """Abstract base class for archives."""
@@ -85,6 +126,9 @@ class Archive(object):
     def add_string(self, content, dest, mode='w'):
         raise NotImplementedError
 
+    def add_tail(self, src, dest, size):
+        raise NotImplementedError
+
     def add_binary(self, content, dest):
         raise NotImplementedError
 
@@ -138,6 +182,9 @@ class FileCacheArchive(Archive):
     _archive_root = ""
     _archive_name = ""
 
+    #: The ArchiveStream the compressed archive is written to, if any
+    stream = None
+
     def __init__(self, name, tmpdir, policy, threads, enc_opts, sysroot,
                  manifest=None):
         self._name = name
@@ -151,6 +198,9 @@ class FileCacheArchive(Archive):
         self.sysroot = sysroot or '/'
         self.manifest = manifest
         self._archive_root = os.path.join(tmpdir, name)
+        # destination paths whose content is currently being written, see
+        # _lock_dest()
+        self._dest_locks = {}
         with self._path_lock:
             os.makedirs(self._archive_root, 0o700)
         self.log_info("initialised empty FileCacheArchive at "
@@ -272,10 +322,12 @@ class FileCacheArchive(Archive):
             enter the class while another method invocation was being
             dispatched.
 
-            Deal with this by implementing a locking scheme for operations
-            that modify the path structure of the archive, and by testing
-            explicitly for conflicts with any existing content at the
-            specified destination path.
+            Deal with this by serializing the creation of leading
+            directories and the path type checks, and by testing explicitly
+            for conflicts with any existing content at the specified
+            destination path, including paths that another thread is still
+            writing to. Writing the content itself is not serialized, see
+            `_lock_dest()`.
 
             It is not an error to attempt to create a path that already
             exists in the archive so long as the type of the object to be
@@ -292,6 +344,12 @@ class FileCacheArchive(Archive):
             :returns: An absolute destination path if the path should be
                       copied now or `None` otherwise
         """
+        with self._path_lock:
+            return self._check_path(src, path_type, dest=dest, force=force)
+
+    def _check_path(self, src, path_type, dest=None, force=False):
+        """Implementation of `check_path()`, called with the path lock held
+        """
         dest = dest or self.dest_path(src)
         if path_type == P_DIR:
             dest_dir = dest
@@ -319,23 +377,75 @@ class FileCacheArchive(Archive):
         if force:
             return dest
 
+        ve_msg = "path '%s' exists and is not a %s"
+        type_names = {
+            P_FILE: "regular file",
+            P_LINK: "symbolic link",
+            P_NODE: "special file",
+            P_DIR: "directory"
+        }
+
+        # Path is being written by another thread: check the type and skip
+        if dest in self._dest_locks:
+            if self._dest_locks[dest][0] != path_type:
+                raise ValueError(ve_msg % (dest, type_names[path_type]))
+            return None
+
         # Check destination path presence and type
         if os.path.exists(dest):
             # Use lstat: we care about the current object, not the referent.
             st = os.lstat(dest)
-            ve_msg = "path '%s' exists and is not a %s"
             if path_type == P_FILE and not stat.S_ISREG(st.st_mode):
-                raise ValueError(ve_msg % (dest, "regular file"))
+                raise ValueError(ve_msg % (dest, type_names[path_type]))
             if path_type == P_LINK and not stat.S_ISLNK(st.st_mode):
-                raise ValueError(ve_msg % (dest, "symbolic link"))
+                raise ValueError(ve_msg % (dest, type_names[path_type]))
             if path_type == P_NODE and not is_special(st.st_mode):
-                raise ValueError(ve_msg % (dest, "special file"))
+                raise ValueError(ve_msg % (dest, type_names[path_type]))
             if path_type == P_DIR and not stat.S_ISDIR(st.st_mode):
-                raise ValueError(ve_msg % (dest, "directory"))
+                raise ValueError(ve_msg % (dest, type_names[path_type]))
             # Path has already been copied: skip
             return None
         return dest
 
+    def _lock_dest(self, src, path_type, force=False):
+        """Check a new destination path in the archive as `check_path()`
+        does, and lock it so that its content can be written without holding
+        the archive wide path lock, allowing concurrent plugins to copy
+        different files at the same time.
+
+        If another thread is still writing to the path, wait for it to be
+        done, so that callers skipping an existing path can rely on its
+        content being in place, and forced writes are not interleaved.
+
+        :param src: the path in the archive to be written
+        :param path_type: the type of object to be written
+        :param force: force file creation even if the path exists
+        :returns: A tuple of the absolute destination path and the locked
+                  ``Lock`` that must be released once written, or
+                  (`None`, `None`) if the path should not be written
+        """
+        while True:
+            with self._path_lock:
+                dest = self._check_path(src, path_type, force=force)
+                busy = self._dest_locks.get(dest or self.dest_path(src))
+                if dest and not busy:
+                    lock = Lock()
+                    lock.acquire()
+                    self._dest_locks[dest] = (path_type, lock)
+                    return dest, lock
+            if busy:
+                with busy[1]:
+                    pass
+            if not dest:
+                return None, None
+
+    def _release_dest(self, dest, lock):
+        """Release a destination path locked by `_lock_dest()`
+        """
+        with self._path_lock:
+            del self._dest_locks[dest]
+        lock.release()
+
     def _copy_attributes(self, src, dest):
         # copy file attributes, skip SELinux xattrs for /sys and /proc
         try:
@@ -350,20 +460,21 @@ class FileCacheArchive(Archive):
             self.log_debug(f"caught '{e}' setting attributes of '{dest}'")
 
     def add_file(self, src, dest=None, force=False):
-        with self._path_lock:
-            if not dest:
-                dest = src
+        if not dest:
+            dest = src
 
-            dest = self.check_path(dest, P_FILE, force=force)
-            if not dest:
-                return
+        dest, lock = self._lock_dest(dest, P_FILE, force=force)
+        if not dest:
+            return
 
+        try:
             # Handle adding a file from either a string respresenting
             # a path, or a File object open for reading.
             if not getattr(src, "read", None):
                 # path case
                 try:
-                    shutil.copy(src, dest)
+                    copy_file(src, dest, buffered=src.startswith(
+                        ("/sys/", "/proc/")))
                 except OSError as e:
                     # Filter out IO errors on virtual file systems.
                     if src.startswith("/sys/") or src.startswith("/proc/"):
@@ -381,54 +492,86 @@ class FileCacheArchive(Archive):
                     for line in src:
                         f.write(line)
                 file_name = "open file"
+        finally:
+            self._release_dest(dest, lock)
 
-            self.log_debug(f"added {file_name} to FileCacheArchive "
-                           f"'{self._archive_root}'")
+        self.log_debug(f"added {file_name} to FileCacheArchive "
+                       f"'{self._archive_root}'")
 
     def add_string(self, content, dest, mode='w'):
-        with self._path_lock:
-            src = dest
+        src = dest
 
-            # add_string() is a special case: it must always take precedence
-            # over any exixting content in the archive, since it is used by
-            # the Plugin postprocessing hooks to perform regex substitution
-            # on file content.
-            dest = self.check_path(dest, P_FILE, force=True)
+        # add_string() is a special case: it must always take precedence
+        # over any exixting content in the archive, since it is used by
+        # the Plugin postprocessing hooks to perform regex substitution
+        # on file content.
+        dest, lock = self._lock_dest(dest, P_FILE, force=True)
 
+        try:
             with codecs.open(dest, mode, encoding='utf-8') as f:
                 if isinstance(content, bytes):
                     content = content.decode('utf8', 'ignore')
                 f.write(content)
                 if os.path.exists(src):
                     self._copy_attributes(src, dest)
-                self.log_debug(f"added string at '{src}' to FileCacheArchive "
-                               f"'{self._archive_root}'")
+        finally:
+            self._release_dest(dest, lock)
+        self.log_debug(f"added string at '{src}' to FileCacheArchive "
+                       f"'{self._archive_root}'")
+
+    def add_tail(self, src, dest, size):
+        """Add the last `size` bytes of the file at `src` to the archive,
+        overwriting any existing content at `dest`.
+
+        :param src: The path of the file in the host file system
+        :type src: ``str``
+
+        :param dest: The path in the archive to write the tail to
+        :type dest: ``str``
+
+        :param size: The amount of bytes to collect from the end of `src`
+        :type size: ``int``
+        """
+        dest, lock = self._lock_dest(dest, P_FILE, force=True)
+
+        try:
+            offset = max(os.stat(src).st_size - size, 0)
+            copy_file(src, dest, offset=offset, count=size,
+                      buffered=src.startswith(("/sys/", "/proc/")))
+        finally:
+            self._release_dest(dest, lock)
+        self.log_debug(f"added tail of '{src}' at '{dest}' to "
+                       f"FileCacheArchive '{self._archive_root}'")
 
     def add_binary(self, content, dest):
-        with self._path_lock:
-            dest = self.check_path(dest, P_FILE)
-            if not dest:
-                return
+        dest, lock = self._lock_dest(dest, P_FILE)
+        if not dest:
+            return
 
+        try:
             with codecs.open(dest, 'wb', encoding=None) as f:
                 f.write(content)
-            self.log_debug(f"added binary content at '{dest}' to archive "
-                           f"'{self._archive_root}'")
+        finally:
+            self._release_dest(dest, lock)
+        self.log_debug(f"added binary content at '{dest}' to archive "
+                       f"'{self._archive_root}'")
 
     def add_link(self, source, link_name):
         self.log_debug(f"adding symlink at '{link_name}' -> '{source}'")
-        with self._path_lock:
-            dest = self.check_path(link_name, P_LINK)
-            if not dest:
-                return
+        dest, lock = self._lock_dest(link_name, P_LINK)
+        if not dest:
+            return
 
+        try:
             if not os.path.lexists(dest):
                 os.symlink(source, dest)
                 self.log_debug(f"added symlink at '{dest}' to '{source}' in "
                                f"archive '{self._archive_root}'")
+        finally:
+            self._release_dest(dest, lock)
 
-        # Follow-up must be outside the path lock: we recurse into
-        # other monitor methods that will attempt to reacquire it.
+        # Follow-up must be outside the destination lock: we recurse into
+        # other monitor methods that will attempt to take path locks.
 
         self.log_debug(f"Link follow up: source={source} link_name={link_name}"
                        f" dest={dest}")
@@ -492,8 +635,7 @@ class FileCacheArchive(Archive):
             :param path: the path in the host file system to add
         """
         # Establish path structure
-        with self._path_lock:
-            self.check_path(path, P_DIR)
+        self.check_path(path, P_DIR)
 
     def add_node(self, path, mode, device):
         dest = self.check_path(path, P_NODE)
@@ -541,6 +683,27 @@ class FileCacheArchive(Archive):
         if os.path.isdir(self._archive_root):
             shutil.rmtree(self._archive_root)
 
+    def stream_to(self, path, hash_name):
+        """Write the compressed archive to `path` instead of to a file in the
+        temporary directory. This is usually a FIFO that another process,
+        e.g. sos collect, reads the archive from while it is being built, so
+        that no copy of the archive is kept on disk.
+
+        :param path:        The FIFO or file to write the archive to
+        :type path:         ``str``
+
+        :param hash_name:   The hashlib algorithm of the archive checksum
+        :type hash_name:    ``str``
+        """
+        self.stream = ArchiveStream(path, hash_name)
+        self.log_info(f"archive will be written to '{path}'")
+
+    def _open_archive_file(self):
+        """Open the file that the compressed archive is written to"""
+        if self.stream is not None:
+            return self.stream.open()
+        return open(self._archive_name, 'wb')
+
     def add_final_manifest_data(self, method):
         """Adds component-agnostic data to the manifest so that individual
         SoSComponents do not need to redundantly add these manually
@@ -580,25 +743,34 @@ class FileCacheArchive(Archive):
         :returns: Number of replacements made
         :rtype: ``int``
         """
-        common_flags = re.IGNORECASE | re.MULTILINE
-        if hasattr(regexp, "pattern"):
-            pattern = regexp.pattern
-            flags = regexp.flags | common_flags
-        else:
-            pattern = regexp
-            flags = common_flags
+        return self.do_file_subs(path, [(compile_sub_regex(regexp), subst)])
+
+    def do_file_subs(self, path, subs):
+        """Apply a list of regexp substitutions, in order, to a file in the
+        archive. The file is read once, and is only written back once all
+        substitutions have been made and if its content actually changed.
+
+        :param path: Path in the archive where the file can be found
+        :type path: ``str``
 
-        content = ""
+        :param subs: The (regexp, substitution string) pairs to apply. The
+                     regexes are used as given, see `compile_sub_regex()`
+        :type subs: ``list`` of ``tuple``
+
+        :returns: Number of replacements made
+        :rtype: ``int``
+        """
         with self.open_file(path) as readable:
             content = readable.read()
         if not isinstance(content, str):
             content = content.decode('utf8', 'ignore')
-        result, replacements = re.subn(pattern, subst, content,
-                                       flags=flags)
-        if replacements:
+        result = content
+        replacements = 0
+        for regexp, subst in subs:
+            result, count = regexp.subn(subst, result)
+            replacements += count
+        if replacements and result != content:
             self.add_string(result, path)
-        else:
-            replacements = 0
         return replacements
 
     def finalize(self, method):
@@ -611,6 +783,10 @@ class FileCacheArchive(Archive):
             return self.name()
 
         self.cleanup()
+        if self.stream is not None:
+            self.log_info(f"wrote archive '{self._archive_name}' to "
+                          f"'{self.stream.path}' (size={self.stream.size})")
+            return res
         self.log_info(f"built archive at '{self._archive_name}' "
                       f"(size={os.stat(self._archive_name).st_size})")
 
@@ -671,12 +847,187 @@ class FileCacheArchive(Archive):
         pass
 
 
+class ParallelCompressor():
+    """File-like object that compresses the data written to it using a pool
+    of worker threads.
+
+    Written data is split into fixed size blocks which are compressed
+    independently of each other, and the results are written to `fileobj` in
+    order. For gzip each block becomes a separate gzip member, and for xz a
+    separate xz stream. Concatenated members and streams are valid per the
+    respective formats, so the result is decompressed as a single stream by
+    gzip, xz, tar and python's tarfile alike.
+
+    Both zlib and lzma release the GIL while compressing, so this scales with
+    the number of workers.
+
+    :param fileobj: The file to write compressed data to
+    :type fileobj:  A binary file object
+
+    :param method:  The compression method, either 'gzip' or 'xz'
+    :type method:   ``str``
+
+    :param workers: The number of blocks to compress concurrently
+    :type workers:  ``int``
+    """
+
+    # block sizes balance parallelism against the loss of compression ratio
+    # from not sharing a dictionary across blocks
+    blocksizes = {
+        'gzip': 1 << 20,
+        'xz': 8 << 20
+    }
+
+    def __init__(self, fileobj, method, workers):
+        self.fileobj = fileobj
+        self.blocksize = self.blocksizes[method]
+        if method == 'gzip':
+            self._compress = self._compress_gzip
+        else:
+            self._compress = self._compress_xz
+        self.pool = ThreadPoolExecutor(workers,
+                                       thread_name_prefix='sos-compress')
+        self.maxpending = workers * 2
+        self.pending = deque()
+        self.buf = bytearray()
+        self.offset = 0
+
+    @staticmethod
+    def _compress_gzip(block):
+        # a wbits of 31 writes a gzip header, with an mtime of 0
+        comp = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return comp.compress(block) + comp.flush()
+
+    @staticmethod
+    def _compress_xz(block):
+        return lzma.compress(block, format=lzma.FORMAT_XZ, preset=3)
+
+    def _submit(self, block):
+        # bound the number of blocks held in memory
+        if len(self.pending) >= self.maxpending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.pending.append(self.pool.submit(self._compress, block))
+
+    def write(self, data):
+        self.buf += data
+        self.offset += len(data)
+        while len(self.buf) >= self.blocksize:
+            self._submit(bytes(self.buf[:self.blocksize]))
+            del self.buf[:self.blocksize]
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def close(self):
+        """Compress any remaining data and write out all pending blocks"""
+        try:
+            if self.buf:
+                self._submit(bytes(self.buf))
+                self.buf.clear()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+        finally:
+            # don't compress blocks that will never be written
+            for future in self.pending:
+                future.cancel()
+            self.pending.clear()
+            self.pool.shutdown(wait=True)
+
+
+class ArchiveStream():
+    """File-like object that the compressed archive is written to when it is
+    streamed to a FIFO or another file, see `FileCacheArchive.stream_to()`.
+    The checksum of the archive is computed as it is written, as there is no
+    file to read it back from afterwards.
+
+    :param path:        The FIFO or file to write to
+    :type path:         ``str``
+
+    :param hash_name:   The hashlib algorithm of the archive checksum
+    :type hash_name:    ``str``
+    """
+
+    #: How long to wait for a reader to open a FIFO, in seconds
+    open_timeout = 60
+
+    def __init__(self, path, hash_name):
+        self.path = path
+        self.hash_name = hash_name
+        self.digest = hashlib.new(hash_name)
+        self.size = 0
+        self.complete = False
+        self.fileobj = None
+
+    def open(self):
+        """Open the stream for writing
+
+        :returns:   The stream itself, to be used as a context manager
+        :rtype:     ``ArchiveStream``
+        """
+        if os.path.exists(self.path) and \
+                stat.S_ISFIFO(os.stat(self.path).st_mode):
+            self.fileobj = os.fdopen(self._open_fifo(), 'wb')
+        else:
+            self.fileobj = open(self.path, 'wb')
+        return self
+
+    def _open_fifo(self):
+        # opening a FIFO for writing blocks until it is opened for reading,
+        # so poll instead to not wait forever if the reader has gone away
+        deadline = time.monotonic() + self.open_timeout
+        while True:
+            try:
+                fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as err:
+                if err.errno != errno.ENXIO or time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+                continue
+            os.set_blocking(fd, True)
+            return fd
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.digest.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+    def hexdigest(self):
+        """Get the checksum of the data written so far"""
+        return self.digest.hexdigest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        self.complete = exc_type is None
+
+
 class TarFileArchive(FileCacheArchive):
     """ archive class using python TarFile to create tar archives"""
 
     method = None
     _with_selinux_context = False
 
+    #: Number of threads used to compress the archive, None for all CPUs
+    compress_workers = None
+
+    _pipeline = None
+
+    compression_suffixes = {
+        'gzip': 'gz',
+        'xz': 'xz',
+        'zstd': 'zst'
+    }
+
     def __init__(self, name, tmpdir, policy, threads, enc_opts, sysroot,
                  manifest=None):
         super().__init__(name, tmpdir, policy, threads,
@@ -732,21 +1083,61 @@ class TarFileArchive(FileCacheArchive):
         # the limit of the underlying FileCacheArchive.
         return super().name_max()
 
-    def _build_archive(self, method):
+    def _get_compress_workers(self):
+        """Returns the number of threads to use for compression"""
+        return self.compress_workers or os.cpu_count() or 1
+
+    def _get_compress_method(self, method):
+        """Resolve the requested compression method to the one that will
+        actually be used
+        """
+        if method == 'zstd' and zstandard is None:
+            self.log_warn("zstd compression requested but the zstandard "
+                          "module is not available, using default compression")
+            method = 'auto'
         if method == 'auto':
-            method = 'xz' if find_spec('lzma') is not None else 'gzip'
-        _comp_mode = method.strip('ip')
-        self._archive_name = f"{self._archive_name}.{_comp_mode}"
+            method = 'xz' if lzma is not None else 'gzip'
+        return method
+
+    def _open_compressor(self, fileobj, method):
+        """Return a file object that compresses the data written to it into
+        `fileobj` as a single gzip member, xz stream or zstd frame, or a
+        sequence of them. When using more than one worker for compression,
+        gzip and xz compression is done in parallel by a ParallelCompressor,
+        whereas zstd handles multi-threading on its own.
+
+        Closing the returned object does not close `fileobj`.
+        """
+        workers = self._get_compress_workers()
+        if method == 'zstd':
+            return zstandard.ZstdCompressor(
+                level=3, threads=workers if workers > 1 else 0
+            ).stream_writer(fileobj, closefd=False)
+        if workers > 1:
+            return ParallelCompressor(fileobj, method, workers)
         # tarfile does not currently have a consistent way to define comnpress
         # level for both xz and gzip ('preset' for xz, 'compresslevel' for gz)
         if method == 'gzip':
-            kwargs = {'compresslevel': 6}
-        else:
-            kwargs = {'preset': 3}
-        tar = tarfile.open(self._archive_name, mode=f"w:{_comp_mode}",
-                           **kwargs)
-        # add commonly reviewed files first, so that they can be more easily
-        # read from memory without needing to extract the whole archive
+            return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=6)
+        return lzma.LZMAFile(fileobj, mode='wb', preset=3)
+
+    @staticmethod
+    def _open_decompressor(fileobj, method):
+        """Return a file object that decompresses what `_open_compressor()`
+        wrote to `fileobj`
+        """
+        if method == 'zstd':
+            return zstandard.ZstdDecompressor().stream_reader(
+                fileobj, closefd=False
+            )
+        if method == 'gzip':
+            return gzip.GzipFile(fileobj=fileobj, mode='rb')
+        return lzma.LZMAFile(fileobj, mode='rb')
+
+    def _add_first_content(self, tar):
+        """Add commonly reviewed files first, so that they can be more easily
+        read from memory without needing to extract the whole archive
+        """
         for _content in ['version.txt', 'sos_reports', 'sos_logs']:
             if not os.path.exists(os.path.join(self._archive_root, _content)):
                 continue
@@ -754,13 +1145,210 @@ class TarFileArchive(FileCacheArchive):
                 os.path.join(self._archive_root, _content),
                 arcname=f"{self._name}/{_content}"
             )
-        # we need to pass the absolute path to the archive root but we
-        # want the names used in the archive to be relative.
-        tar.add(self._archive_root, arcname=self._name,
-                filter=self.copy_permissions_filter)
-        tar.close()
+
+    def _build_archive(self, method):
+        method = self._get_compress_method(method)
+        if self._pipeline is not None:
+            return self._build_pipelined_archive(method)
+        _comp_mode = self.compression_suffixes[method]
+        self._archive_name = f"{self._archive_name}.{_comp_mode}"
+        with self._open_archive_file() as _arc:
+            _comp = self._open_compressor(_arc, method)
+            try:
+                tar = tarfile.TarFile(fileobj=_comp, mode='w')
+                self._add_first_content(tar)
+                # we need to pass the absolute path to the archive root but we
+                # want the names used in the archive to be relative.
+                tar.add(self._archive_root, arcname=self._name,
+                        filter=self.copy_permissions_filter)
+                tar.close()
+            finally:
+                _comp.close()
         self._suffix += f".{_comp_mode}"
         return self.name()
 
+    def start_pipeline(self, method):
+        """Start building the compressed archive while content is still being
+        collected.
+
+        Content handed to `append_paths()` is added to a separately compressed
+        body of the archive in a background thread. When the archive is
+        finalized, the commonly reviewed files that are usually placed first
+        in the archive, the body and then all content not yet appended are
+        written out as a sequence of compressed streams, which together
+        decompress as a single tar archive.
+
+        :param method:  The compression method that will be used
+        :type method:   ``str``
+        """
+        method = self._get_compress_method(method)
+        self._pipeline_body = f"{self._archive_name}.body"
+        _body = open(self._pipeline_body, 'wb')
+        _comp = self._open_compressor(_body, method)
+        self._pipeline = {
+            'method': method,
+            'file': _body,
+            'compressor': _comp,
+            'tar': tarfile.TarFile(fileobj=_comp, mode='w'),
+            'pool': ThreadPoolExecutor(1, thread_name_prefix='sos-archive'),
+            'lock': Lock(),
+            'appended': set(),
+            'rewritten': set()
+        }
+        self.log_info(f"building archive while collecting, using '{method}'")
+
+    def append_paths(self, paths):
+        """Queue paths within the archive to be appended to the archive being
+        built by the pipeline. Directories are appended recursively.
+
+        Content should no longer be modified once appended. Content that is
+        rewritten anyway is dropped from the body of the archive when it is
+        finalized, which then needs to be decompressed and compressed again,
+        and only its final version is added.
+
+        :param paths:   Paths relative to the archive root
+        :type paths:    ``list``
+        """
+        if self._pipeline is None:
+            return
+        self._pipeline['pool'].submit(self._append_paths, list(paths))
+
+    def _append_paths(self, paths):
+        tar = self._pipeline['tar']
+        realroot = os.path.realpath(self._archive_root)
+        for path in paths:
+            path = os.path.normpath(path.lstrip('/'))
+            src = os.path.join(self._archive_root, path)
+            # content that is reached through a symlink within the archive is
+            # added under its real path when the archive is finalized
+            if (os.path.realpath(os.path.dirname(src)) !=
+                    os.path.dirname(os.path.join(realroot, path))):
+                continue
+            if os.path.isdir(src) and not os.path.islink(src):
+                for root, dirs, files in os.walk(src):
+                    # os.walk() lists symlinks to directories as directories
+                    links = [d for d in dirs
+                             if os.path.islink(os.path.join(root, d))]
+                    for name in files + links:
+                        self._append_file(tar, os.path.join(root, name))
+            elif os.path.lexists(src):
+                self._append_file(tar, src)
+
+    def _append_file(self, tar, src):
+        arcname = os.path.join(self._name,
+                               os.path.relpath(src, self._archive_root))
+        with self._pipeline['lock']:
+            if arcname in self._pipeline['appended'] or \
+                    arcname in self._pipeline['rewritten']:
+                return
+            try:
+                tarinfo = self.copy_permissions_filter(
+                    tar.gettarinfo(src, arcname=arcname)
+                )
+                if tarinfo is None:
+                    return
+                if tarinfo.isreg():
+                    with open(src, 'rb') as fobj:
+                        tar.addfile(tarinfo, fobj)
+                else:
+                    tar.addfile(tarinfo)
+            except OSError as err:
+                self.log_debug(f"could not append '{src}' to archive: {err}, "
+                               "it will be added when finalizing")
+                return
+            self._pipeline['appended'].add(arcname)
+
+    def add_string(self, content, dest, mode='w'):
+        if self._pipeline is not None:
+            arcname = os.path.join(
+                self._name,
+                os.path.relpath(self.dest_path(dest), self._archive_root)
+            )
+            with self._pipeline['lock']:
+                if arcname in self._pipeline['appended']:
+                    self.log_warn(f"'{dest}' was modified after it was added "
+                                  "to the archive, it will be replaced when "
+                                  "the archive is finalized")
+                    self._pipeline['appended'].discard(arcname)
+                    self._pipeline['rewritten'].add(arcname)
+        super().add_string(content, dest, mode)
+
+    def _add_unappended(self, tar, path, arcname):
+        """Recursively add path to tar like `TarFile.add()`, leaving out the
+        content that was already appended by the pipeline without looking it
+        up on disk again
+        """
+        if arcname in self._pipeline['appended']:
+            return
+        tarinfo = tar.gettarinfo(path, arcname=arcname)
+        if tarinfo is not None:
+            tarinfo = self.copy_permissions_filter(tarinfo)
+        if tarinfo is None:
+            return
+        if tarinfo.isreg():
+            with open(path, 'rb') as fobj:
+                tar.addfile(tarinfo, fobj)
+        else:
+            tar.addfile(tarinfo)
+        if tarinfo.isdir():
+            for name in sorted(os.listdir(path)):
+                self._add_unappended(tar, os.path.join(path, name),
+                                     os.path.join(arcname, name))
+
+    def _copy_body_members(self, tar, method):
+        """Add the members of the body of the archive to tar, except for the
+        content that was rewritten after it was appended
+        """
+        with open(self._pipeline_body, 'rb') as _body:
+            with self._open_decompressor(_body, method) as _decomp:
+                with tarfile.open(fileobj=_decomp, mode='r|') as body:
+                    for member in body:
+                        if member.name in self._pipeline['rewritten']:
+                            continue
+                        tar.addfile(member, body.extractfile(member))
+
+    def _build_pipelined_archive(self, method):
+        pipe = self._pipeline
+        pipe['pool'].shutdown(wait=True)
+        body_size = pipe['tar'].offset
+        pipe['compressor'].close()
+        pipe['file'].close()
+        if method != pipe['method']:
+            self.log_warn(f"ignoring compression method '{method}', the "
+                          f"archive is built using '{pipe['method']}'")
+            method = pipe['method']
+        _comp_mode = self.compression_suffixes[method]
+        self._archive_name = f"{self._archive_name}.{_comp_mode}"
+        with self._open_archive_file() as _arc:
+            # the commonly reviewed files still go first
+            _comp = self._open_compressor(_arc, method)
+            try:
+                tar = tarfile.TarFile(fileobj=_comp, mode='w')
+                self._add_first_content(tar)
+                offset = tar.offset
+            finally:
+                _comp.close()
+            # followed by the content appended while collecting, as is unless
+            # some of it has been rewritten since
+            if not pipe['rewritten']:
+                with open(self._pipeline_body, 'rb') as _body:
+                    shutil.copyfileobj(_body, _arc, 1 << 20)
+                offset += body_size
+            # and finally everything else, including the directory entries
+            _comp = self._open_compressor(_arc, method)
+            try:
+                tar = tarfile.TarFile(fileobj=_comp, mode='w')
+                # account for the preceding content when padding the archive
+                tar.offset = offset
+                if pipe['rewritten']:
+                    self._copy_body_members(tar, method)
+                self._add_unappended(tar, self._archive_root, self._name)
+                tar.close()
+            finally:
+                _comp.close()
+        os.unlink(self._pipeline_body)
+        self._pipeline = None
+        self._suffix += f".{_comp_mode}"
+        return self.name()
 
 # vim: set et ts=4 sw=4 :
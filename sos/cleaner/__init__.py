@@ -8,11 +8,17 @@
 #
 # See the LICENSE file in the source distribution for further information.
 
+import copy
 import hashlib
+import io
 import json
 import logging
+import multiprocessing
+import multiprocessing.connection
 import os
+import re
 import shutil
+import stat
 import tempfile
 import fnmatch
 
@@ -36,6 +42,7 @@ from sos.cleaner.archives.sos import (SoSReportArchive, SoSReportDirectory,
                                       SoSCollectorDirectory)
 from sos.cleaner.archives.generic import DataDirArchive, TarballArchive
 from sos.cleaner.archives.insights import InsightsArchive
+from sos.cleaner.archives import get_file_compression, open_compressed_file
 from sos.utilities import get_human_readable, import_module, ImporterHelper
 
 
@@ -91,10 +98,25 @@ class SoSCleaner(SoSComponent):
         'map_file': '/etc/sos/cleaner/default_mapping',
         'no_update': False,
         'keep_binary_files': False,
+        'file_jobs': 1,
+        'stream': False,
         'target': '',
         'usernames': []
     }
 
+    # version of the format of the index saved next to the map file
+    map_index_version = 1
+    # the size above which members of a tarball obfuscated without being
+    # extracted are held in temp files instead of in memory
+    stream_spool_size = 16 * 1024 * 1024
+    # the number of characters read at a time when obfuscating a file
+    obfuscate_block_size = 1024 * 1024
+    # roughly how many times more content single compressed files hold than
+    # their size, used to balance the work given to worker processes
+    compressed_size_ratio = 10
+    # matches once for every line that is not blank
+    _nonblank_line = re.compile(r'\S[^\n]*()')
+
     def __init__(self, parser=None, args=None, cmdline=None, in_place=False,
                  hook_commons=None):
         if not in_place:
@@ -113,6 +135,10 @@ class SoSCleaner(SoSComponent):
             self.from_cmdline = False
             if not hasattr(self.opts, 'jobs'):
                 self.opts.jobs = 4
+            if not hasattr(self.opts, 'file_jobs'):
+                self.opts.file_jobs = 1
+            if not hasattr(self.opts, 'stream'):
+                self.opts.stream = False
             self.opts.archive_type = 'auto'
             self.soslog = logging.getLogger('sos')
             self.ui_log = logging.getLogger('sos_ui')
@@ -150,6 +176,8 @@ class SoSCleaner(SoSComponent):
                     )
                     self.parsers.remove(_loaded)
 
+        self.load_map_index()
+
         self.archive_types = [
             SoSReportDirectory,
             SoSReportArchive,
@@ -217,6 +245,60 @@ class SoSCleaner(SoSComponent):
                                    f"'{self.opts.map_file}': {err}")
         return _conf
 
+    def get_map_index_path(self):
+        """Get the path of the index of the map file's regexes, which is saved
+        next to the map file itself
+        """
+        return f"{self.opts.map_file}.index"
+
+    def get_map_hash(self, _map):
+        """Get a hash of the contents of a map, and of everything else that
+        decides which regexes are generated for them, to check that a saved
+        index was made for the same map
+
+        :param _map:    The mapping of each parser's map_file_key to its items
+        :type _map:     ``dict``
+
+        :returns:       The hex digest of the hash
+        :rtype:         ``str``
+        """
+        _content = json.dumps(
+            {'version': self.map_index_version, 'sos': __version__,
+             'map': _map},
+            sort_keys=True
+        )
+        return hashlib.sha256(_content.encode()).hexdigest()
+
+    def load_map_index(self):
+        """If an index of the regexes for the loaded map file was saved by a
+        previous run, load it into the parsers' maps so that the regexes do
+        not need to be generated again. The index is only used if it was saved
+        for exactly the same map contents.
+        """
+        if not self.cleaner_mapping:
+            return
+        index_path = self.get_map_index_path()
+        if not os.path.exists(index_path):
+            return
+        try:
+            with open(index_path, 'r') as mi:
+                _index = json.load(mi)
+            if _index.get('version') != self.map_index_version or \
+                    _index.get('map_hash') != \
+                    self.get_map_hash(self.cleaner_mapping):
+                self.log_debug(f"Map index {index_path} does not match the "
+                               "map file, not loading it")
+                return
+            for parser in self.parsers:
+                if parser.compile_regexes and \
+                        parser.map_file_key in _index['maps']:
+                    parser.mapping.load_regex_index(
+                        _index['maps'][parser.map_file_key]
+                    )
+            self.log_debug(f"Loaded map index {index_path}")
+        except Exception as err:
+            self.log_error(f"Could not load map index '{index_path}': {err}")
+
     def print_disclaimer(self):
         """When we are directly running `sos clean`, rather than hooking into
         SoSCleaner via report or collect, print a disclaimer banner
@@ -273,6 +355,13 @@ third party.
                                      'cleaning. Globs are supported.'))
         clean_grp.add_argument('-j', '--jobs', default=4, type=int,
                                help='Number of concurrent archives to clean')
+        clean_grp.add_argument('--file-jobs', default=1, type=int,
+                               dest='file_jobs',
+                               help=('Number of processes used to clean the '
+                                     'files within each archive'))
+        clean_grp.add_argument('--stream', default=False, action='store_true',
+                               help=('Clean tarballs without extracting them '
+                                     'to disk'))
         clean_grp.add_argument('--keywords', action='extend', default=[],
                                dest='keywords',
                                help='List of keywords to obfuscate')
@@ -513,6 +602,30 @@ third party.
                 self.log_debug(f"Wrote mapping to {self.opts.map_file}")
             except Exception as err:
                 self.log_error(f"Could not update mapping config file: {err}")
+                return
+            self.write_map_index(_map)
+
+    def write_map_index(self, _map):
+        """Save the index of the regexes for the map written to the config
+        file, so that subsequent runs loading the same map can use it instead
+        of generating the regexes again
+        """
+        index_path = self.get_map_index_path()
+        _index = {
+            'version': self.map_index_version,
+            'map_hash': self.get_map_hash(_map),
+            'maps': {}
+        }
+        for parser in self.parsers:
+            if parser.compile_regexes:
+                _index['maps'][parser.map_file_key] = \
+                    parser.mapping.get_regex_index()
+        try:
+            with open(index_path, 'w') as mi:
+                json.dump(_index, mi)
+            self.log_debug(f"Wrote map index to {index_path}")
+        except Exception as err:
+            self.log_error(f"Could not write map index '{index_path}': {err}")
 
     def write_cleaner_log(self, archive=False):
         """When invoked via the command line, the logging from SoSCleaner will
@@ -554,12 +667,16 @@ third party.
         during setup.
 
         Each archive is handled in a separate thread, up to self.opts.jobs will
-        be obfuscated concurrently.
+        be obfuscated concurrently. If the files of each archive are cleaned
+        by multiple processes, archives are handled one at a time instead, so
+        that the workers are never forked while another archive is updating
+        the maps.
         """
         try:
+            jobs = self.opts.jobs if self.opts.file_jobs < 2 else 1
             msg = (
                 f"Found {len(self.report_paths)} total reports to obfuscate, "
-                f"processing up to {self.opts.jobs} concurrently\n"
+                f"processing up to {jobs} concurrently\n"
             )
             self.ui_log.info(msg)
             if self.opts.keep_binary_files:
@@ -567,7 +684,7 @@ third party.
                     "WARNING: binary files that potentially contain sensitive "
                     "information will NOT be removed from the final archive\n"
                 )
-            pool = ThreadPoolExecutor(self.opts.jobs)
+            pool = ThreadPoolExecutor(jobs)
             pool.map(self.obfuscate_report, self.report_paths, chunksize=1)
             pool.shutdown(wait=True)
             # finally, obfuscate the nested archive if one exists
@@ -599,7 +716,48 @@ third party.
         for parser in self.parsers:
             parser.generate_item_regexes()
 
-    def _prepare_archive_with_prepper(self, archive, prepper):
+    def _get_prep_items(self, archive, preppers):
+        """Get the files and items that each prepper provides for each parser
+        from an archive, along with the contents of those files. Only the
+        archive is read, and the maps are not changed, so that this can be done
+        for several archives concurrently.
+
+        Fresh instances of the preppers are used, so that the regex_items of
+        each archive are kept apart.
+
+        :param archive: The archive to get the files and items from
+        :type archive:  ``SoSObfuscationArchive`` subclass
+
+        :param preppers: The preppers to get the files and items from
+        :type preppers:  ``list`` of ``SoSPrepper`` subclasses
+
+        :returns: For each prepper name, the prep items of each parser and the
+                  prepper's regex_items once all parsers are done
+        :rtype: ``dict``
+        """
+        _prep = {}
+        for prepper in preppers:
+            _prepper = prepper.__class__(options=self.opts)
+            _parser_items = {}
+            for _parser in self.parsers:
+                pname = _parser.name.lower().split()[0].strip()
+                _files = []
+                for _file in _prepper.get_parser_file_list(pname, archive):
+                    content = archive.get_file_content(_file)
+                    if content:
+                        _files.append((_file, content))
+                map_items = _prepper.get_items_for_map(pname, archive)
+                if isinstance(map_items, set):
+                    # keep the order items are added in, and so their
+                    # obfuscated values, the same between runs
+                    map_items = sorted(map_items)
+                _parser_items[pname] = (
+                    _files, map_items, set(_prepper.regex_items[pname])
+                )
+            _prep[prepper.name] = (_parser_items, _prepper.regex_items)
+        return _prep
+
+    def _prepare_archive_with_prepper(self, archive, prepper, prep_items):
         """
         For each archive we've determined we need to operate on, pass it to
         each prepper so that we can extract necessary files and/or items for
@@ -609,19 +767,26 @@ third party.
         building up monolithic lists of file paths, as we'd still need to
         manipulate these on a per-archive basis.
 
+        The files and items were already read from the archive by
+        _get_prep_items(), and are added to the mappings here, in the same
+        order as if they were read now.
+
         :param archive: The archive we are currently using to prepare our
                         mappings with
         :type archive:  ``SoSObfuscationArchive`` subclass
 
         :param prepper: The individual prepper we're using to source items
         :type prepper:  ``SoSPrepper`` subclass
+
+        :param prep_items: The prep items of the archive for each parser, and
+                           the regex_items found in the archive
+        :type prep_items:  ``tuple``
         """
+        _parser_items, _regex_items = prep_items
         for _parser in self.parsers:
             pname = _parser.name.lower().split()[0].strip()
-            for _file in prepper.get_parser_file_list(pname, archive):
-                content = archive.get_file_content(_file)
-                if not content:
-                    continue
+            _files, map_items, _parser_regex_items = _parser_items[pname]
+            for _file, content in _files:
                 self.log_debug(f"Prepping {pname} parser with file {_file} "
                                f"from {archive.ui_name}")
                 for line in content.splitlines():
@@ -631,15 +796,18 @@ third party.
                         self.log_debug(
                             f"Failed to prep {pname} map from {_file}: {err}"
                         )
-            map_items = prepper.get_items_for_map(pname, archive)
             if map_items:
                 self.log_debug(f"Prepping {pname} mapping with items from "
                                f"{archive.ui_name}")
                 for item in map_items:
                     _parser.mapping.add(item)
 
-            for ritem in prepper.regex_items[pname]:
-                _parser.mapping.add_regex_item(ritem)
+            prepper.regex_items[pname].update(_parser_regex_items)
+            _parser.mapping.add_regex_items(
+                sorted(prepper.regex_items[pname])
+            )
+        for pname, items in _regex_items.items():
+            prepper.regex_items[pname].update(items)
 
     def get_preppers(self):
         """
@@ -663,9 +831,21 @@ third party.
         obfuscated in node1's archive.
         """
         self.log_info("Pre-loading all archives into obfuscation maps")
-        for prepper in self.get_preppers():
-            for archive in self.report_paths:
-                self._prepare_archive_with_prepper(archive, prepper)
+        preppers = list(self.get_preppers())
+        # read the prep files of the archives concurrently, and then add
+        # what was found to the maps in a fixed order, so that the obfuscated
+        # values do not depend on which archive was read first
+        with ThreadPoolExecutor(self.opts.jobs) as pool:
+            prep_items = list(pool.map(
+                lambda archive: self._get_prep_items(archive, preppers),
+                self.report_paths
+            ))
+        for prepper in preppers:
+            for archive, _items in zip(self.report_paths, prep_items):
+                self._prepare_archive_with_prepper(archive, prepper,
+                                                   _items[prepper.name])
+        for archive in self.report_paths:
+            archive.clear_file_content_cache()
 
     def obfuscate_report(self, archive):  # pylint: disable=too-many-branches
         """Individually handle each archive or directory we've discovered by
@@ -679,56 +859,13 @@ third party.
             arc_md = self.cleaner_md.add_section(archive.archive_name)
             start_time = datetime.now()
             arc_md.add_field('start_time', start_time)
-            # don't double extract nested archives
-            if not archive.is_extracted:
-                archive.extract()
-            archive.report_msg("Beginning obfuscation...")
-
-            for fname in archive.get_file_list():
-                short_name = fname.split(archive.archive_name + '/')[1]
-                if archive.should_skip_file(short_name):
-                    continue
-                if (not self.opts.keep_binary_files and
-                        archive.should_remove_file(short_name)):
-                    archive.remove_file(short_name)
-                    continue
-                try:
-                    count = self.obfuscate_file(fname, short_name,
-                                                archive.archive_name)
-                    if count:
-                        archive.update_sub_count(short_name, count)
-                except Exception as err:
-                    self.log_debug(f"Unable to parse file {short_name}: {err}")
-
-            try:
-                self.obfuscate_directory_names(archive)
-            except Exception as err:
-                self.log_info(f"Failed to obfuscate directories: {err}",
-                              caller=archive.archive_name)
-
-            try:
-                self.obfuscate_symlinks(archive)
-            except Exception as err:
-                self.log_info(f"Failed to obfuscate symlinks: {err}",
-                              caller=archive.archive_name)
-
-            # if the archive was already a tarball, repack it
-            if not archive.is_nested:
-                method = archive.get_compression()
-                if method:
-                    archive.report_msg("Re-compressing...")
-                    try:
-                        archive.rename_top_dir(
-                            self.obfuscate_string(archive.archive_name)
-                        )
-                        archive.compress(method)
-                    except Exception as err:
-                        self.log_debug(f"Archive {archive.archive_name} failed"
-                                       f" to compress: {err}")
-                        archive.report_msg(
-                            f"Failed to re-compress archive: {err}")
-                        return
+            if self._can_stream_archive(archive):
+                archive.report_msg("Beginning obfuscation without "
+                                   "extracting...")
+                self.obfuscate_archive_stream(archive)
                 self.completed_reports.append(archive)
+            elif not self._obfuscate_extracted_archive(archive):
+                return
 
             end_time = datetime.now()
             arc_md.add_field('end_time', end_time)
@@ -745,15 +882,651 @@ third party.
             self.ui_log.info("Exception while processing "
                              f"{archive.archive_name}: {err}")
 
+    def _obfuscate_extracted_archive(self, archive):
+        """Obfuscate an archive by extracting it, obfuscating the extracted
+        files, directory names and symlinks, and then repacking it if it was
+        a tarball
+
+        :returns:   False if the archive could not be repacked
+        :rtype:     ``bool``
+        """
+        # don't double extract nested archives
+        if not archive.is_extracted:
+            archive.extract()
+        archive.report_msg("Beginning obfuscation...")
+
+        if self.opts.file_jobs > 1:
+            self.obfuscate_files_in_processes(archive)
+        else:
+            for fname, short_name in self._get_files_to_obfuscate(archive):
+                self._obfuscate_archive_file(archive, fname, short_name)
+
+        try:
+            self.obfuscate_directory_names(archive)
+        except Exception as err:
+            self.log_info(f"Failed to obfuscate directories: {err}",
+                          caller=archive.archive_name)
+
+        try:
+            self.obfuscate_symlinks(archive)
+        except Exception as err:
+            self.log_info(f"Failed to obfuscate symlinks: {err}",
+                          caller=archive.archive_name)
+
+        # if the archive was already a tarball, repack it
+        if not archive.is_nested:
+            method = archive.get_compression()
+            if method:
+                archive.report_msg("Re-compressing...")
+                try:
+                    archive.rename_top_dir(
+                        self.obfuscate_string(archive.archive_name)
+                    )
+                    archive.compress(method)
+                except Exception as err:
+                    self.log_debug(f"Archive {archive.archive_name} failed"
+                                   f" to compress: {err}")
+                    archive.report_msg(
+                        f"Failed to re-compress archive: {err}")
+                    return False
+            self.completed_reports.append(archive)
+        return True
+
+    def _can_stream_archive(self, archive):
+        """Check if an archive can be obfuscated without extracting it, which
+        is only done for tarballs that are not archives of archives, and when
+        the files of the archive are obfuscated by this process
+        """
+        return (
+            self.opts.stream and self.opts.file_jobs < 2 and
+            not archive.is_nested and not archive.is_extracted and
+            archive.is_tarfile and archive.get_compression() is not None
+        )
+
+    def obfuscate_archive_stream(self, archive):
+        """Obfuscate a tarball without extracting it. Each member is read from
+        the tarball, obfuscated in memory, or in a temp file for larger
+        members, and written straight into the obfuscated tarball.
+
+        Unlike for an extracted archive, where directory names and symlinks
+        are obfuscated once all files have been, the name of each member is
+        obfuscated as it is written, with the items known at that point. The
+        items that typically appear in names, such as host names, are already
+        known from preloading the archive into the maps.
+
+        A member that cannot be read is left out of the obfuscated tarball,
+        but any error once a member has been partly written fails the whole
+        archive.
+
+        :param archive:     The tarball to obfuscate
+        :type archive:      ``SoSObfuscationArchive``
+        """
+        root = archive.get_archive_root()
+        ob_name = self.obfuscate_string(archive.archive_name)
+        # the obfuscated names of members written so far, for hard links
+        renamed = {}
+        os.makedirs(os.path.join(self.tmpdir, 'cleaner'), exist_ok=True)
+        tar, tarpath = archive.open_tar_file(
+            os.path.join(self.tmpdir, 'cleaner', ob_name),
+            archive.get_compression()
+        )
+        with tar:
+            for member in archive.tarobj:
+                if member.name == root:
+                    short_name = ''
+                elif member.name.startswith(root.rstrip('/') + '/'):
+                    short_name = member.name[len(root.rstrip('/')) + 1:]
+                else:
+                    short_name = member.name
+                offset = tar.offset
+                try:
+                    self._stream_archive_member(archive, tar, member,
+                                                short_name, ob_name, renamed)
+                except Exception as err:
+                    if tar.offset != offset:
+                        # the header of the member has been written, so the
+                        # obfuscated tarball cannot be used anymore
+                        raise
+                    self.log_debug(f"Unable to obfuscate {short_name}, "
+                                   f"removing it: {err}",
+                                   caller=archive.archive_name)
+        archive.archive_name = ob_name
+        archive.final_archive_path = tarpath
+
+    def _stream_archive_member(self, archive, tar, member, short_name,
+                               ob_name, renamed):
+        """Write the obfuscated counterpart of one member of a tarball that is
+        being obfuscated without extracting it
+
+        :param archive:     The tarball being obfuscated
+        :type archive:      ``SoSObfuscationArchive``
+
+        :param tar:         The obfuscated tarball being written
+        :type tar:          ``tarfile.TarFile``
+
+        :param member:      The member to obfuscate
+        :type member:       ``tarfile.TarInfo``
+
+        :param short_name:  The path of the member within the archive
+        :type short_name:   ``str``
+
+        :param ob_name:     The obfuscated name of the archive
+        :type ob_name:      ``str``
+
+        :param renamed:     The obfuscated names of the members written so far
+        :type renamed:      ``dict``
+        """
+        tarinfo = copy.copy(member)
+        # pax headers would take precedence over the obfuscated names
+        tarinfo.pax_headers = {
+            _key: _val for _key, _val in member.pax_headers.items()
+            if _key not in ('path', 'linkpath', 'size')
+        }
+        if member.isfile():
+            self._stream_archive_file(archive, tar, member, tarinfo,
+                                      short_name, ob_name)
+        else:
+            _parsers = self._get_file_parsers(short_name)
+            if member.issym() and _parsers:
+                tarinfo.linkname = self.obfuscate_string(member.linkname)
+            elif member.islnk():
+                tarinfo.linkname = renamed.get(member.linkname,
+                                               member.linkname)
+            tarinfo.name = self._get_obfuscated_member_name(
+                short_name, ob_name, member.isdir() or bool(_parsers)
+            )
+            tar.addfile(tarinfo)
+        renamed[member.name] = tarinfo.name
+
+    def _stream_archive_file(self, archive, tar, member, tarinfo, short_name,
+                             ob_name):
+        """Write the obfuscated counterpart of a regular file within a tarball
+        that is being obfuscated without extracting it, making the same
+        checks as for a file of an extracted archive
+        """
+        tarinfo.name = self._get_obfuscated_member_name(short_name, ob_name,
+                                                        False)
+        _module = get_file_compression(short_name)
+        # the member is read in full before anything is written, so that an
+        # error reading it does not leave a truncated member behind
+        with self._get_stream_spool(member.size) as raw:
+            shutil.copyfileobj(archive.tarobj.extractfile(member), raw)
+            raw.seek(0)
+            if archive.in_skip_list(short_name):
+                tar.addfile(tarinfo, raw)
+                return
+            if (not self.opts.keep_binary_files and
+                    archive.should_remove_member(
+                        short_name, self._read_member_start(_module, raw)
+                    )):
+                archive.log_info(f"Removing binary file '{short_name}' from "
+                                 "archive")
+                archive.removed_file_count += 1
+                return
+            raw.seek(0)
+            _parsers = self._get_file_parsers(short_name)
+            if not _parsers:
+                self.log_debug(f"Skipping obfuscation of {short_name} due to "
+                               "matching file skip pattern")
+                tar.addfile(tarinfo, raw)
+                return
+            self.log_debug(f"Obfuscating {short_name}",
+                           caller=archive.archive_name)
+            with self._get_stream_spool(member.size) as out:
+                if _module:
+                    _in = io.TextIOWrapper(open_compressed_file(_module, raw),
+                                           errors='replace')
+                    _out = io.TextIOWrapper(
+                        open_compressed_file(_module, out, 'wb')
+                    )
+                else:
+                    _in = io.TextIOWrapper(raw, errors='replace')
+                    _out = io.TextIOWrapper(out)
+                subs = self._obfuscate_lines(_in, _out, short_name, _parsers,
+                                             archive.archive_name)
+                _out.flush()
+                if _module:
+                    # write the end of the compressed stream, which leaves
+                    # out itself open
+                    _out.close()
+                else:
+                    _out.detach()
+                _in.detach()
+                tarinfo.name = self._get_obfuscated_member_name(
+                    short_name, ob_name, True
+                )
+                if not subs:
+                    raw.seek(0)
+                    tar.addfile(tarinfo, raw)
+                    return
+                archive.update_sub_count(short_name, subs)
+                tarinfo.size = out.tell()
+                out.seek(0)
+                tar.addfile(tarinfo, out)
+
+    @staticmethod
+    def _read_member_start(module, raw):
+        """Read the start of the content of a tarball member that is held in
+        raw, decompressed if the member is a single compressed file, to check
+        if it is binary.
+
+        :returns:   The start of the content, or None if it cannot be
+                    decompressed
+        :rtype:     ``bytes``
+        """
+        if not module:
+            return raw.read(1 << 20)
+        try:
+            with open_compressed_file(module, raw) as _cfile:
+                return _cfile.read(1 << 20)
+        except Exception:
+            return None
+
+    def _get_stream_spool(self, size):
+        """Get a file object to hold the content of a member of a tarball that
+        is obfuscated without extracting it, in memory unless the member is
+        larger than stream_spool_size
+        """
+        if size > self.stream_spool_size:
+            return tempfile.TemporaryFile(dir=self.tmpdir)
+        return io.BytesIO()
+
+    def _get_obfuscated_member_name(self, short_name, ob_name, obfuscate_base):
+        """Get the obfuscated name of a member of a tarball that is obfuscated
+        without extracting it, with the obfuscated name of the archive as its
+        top directory. Directory names within the path are always obfuscated,
+        the final name only if ``obfuscate_base`` is set, as files that are not
+        obfuscated are not renamed either.
+        """
+        if not short_name:
+            return ob_name
+        _parts = short_name.split('/')
+        _names = [self.obfuscate_string(_part) for _part in _parts[:-1]]
+        if obfuscate_base:
+            _names.append(self.obfuscate_string(_parts[-1]))
+        else:
+            _names.append(_parts[-1])
+        return '/'.join([ob_name] + _names)
+
+    def _get_files_to_obfuscate(self, archive):
+        """Iterate over the files of an archive that should be obfuscated,
+        removing any binary files that cannot be obfuscated along the way.
+
+        :param archive:     The archive being obfuscated
+        :type archive:      ``SoSObfuscationArchive``
+
+        :returns:   The full path and the path within the archive of each file
+        :rtype:     A generator of ``tuple``
+        """
+        for fname in archive.get_file_list():
+            short_name = fname.split(archive.archive_name + '/')[1]
+            if archive.should_skip_file(short_name):
+                continue
+            if (not self.opts.keep_binary_files and
+                    archive.should_remove_file(short_name)):
+                archive.remove_file(short_name)
+                continue
+            yield fname, short_name
+
+    def _obfuscate_archive_file(self, archive, fname, short_name):
+        """Obfuscate a single file of an archive, and record the number of
+        substitutions made for it
+        """
+        try:
+            count = self.obfuscate_file(fname, short_name,
+                                        archive.archive_name)
+            if count:
+                archive.update_sub_count(short_name, count)
+        except Exception as err:
+            self._handle_file_error(archive, short_name, err)
+
+    def _handle_file_error(self, archive, short_name, err):
+        """Handle a file of an archive that could not be obfuscated. Single
+        compressed files, which may be corrupt beyond the part read to check
+        if they are binary, are removed like binary files would be, rather
+        than being left in the archive as they are.
+        """
+        self.log_debug(f"Unable to parse file {short_name}: {err}")
+        if (get_file_compression(short_name) and
+                not self.opts.keep_binary_files):
+            archive.remove_file(short_name)
+
+    def obfuscate_files_in_processes(self, archive):
+        """Obfuscate the files of an archive using multiple processes, rather
+        than line by line in the current thread which is bound to a single
+        CPU.
+
+        To keep the obfuscation of each item consistent across all files,
+        this is done in two phases. The file list is split into contiguous
+        shards, and each shard is first parsed by a worker starting from the
+        current state of the maps, in order to discover the items that are not
+        yet known. These items are then added to the maps of this process one
+        shard after the other, which freezes the obfuscated value of every
+        item.
+
+        In the second phase, each shard is obfuscated by a worker that is
+        forked just before the items discovered in its shard are added, so
+        that it starts from the state the maps are in at the start of the
+        shard. Workers may only add the items that have been frozen at that
+        point, using the same obfuscated values.
+
+        Should a worker still encounter an item that was not frozen, for
+        instance an item that is only recognized with the items of earlier
+        shards known, the file it was found in is left untouched by the worker
+        and is obfuscated here instead, once all workers have finished.
+
+        :param archive:     The archive being obfuscated
+        :type archive:      ``SoSObfuscationArchive``
+        """
+        files = list(self._get_files_to_obfuscate(archive))
+        shards = self._shard_file_list(files, self.opts.file_jobs * 4)
+
+        archive.report_msg(
+            f"Discovering items in {len(files)} files using "
+            f"{self.opts.file_jobs} processes..."
+        )
+        discovered = self._run_shard_workers(
+            self.discover_file_items, archive, shards, lambda _idx: None
+        )
+
+        def _reserve_items(idx):
+            self._add_discovered_items(discovered[idx] or [])
+            return [dict(parser.mapping.dataset) for parser in self.parsers]
+
+        archive.report_msg("Obfuscating files...")
+        obfuscated = self._run_shard_workers(
+            self.obfuscate_files_with_reserved_items, archive, shards,
+            _reserve_items
+        )
+
+        retry = []
+        for shard, result in zip(shards, obfuscated):
+            if result is None:
+                retry.extend(shard)
+                continue
+            results, line_counts = result
+            for parser, (parsed, rejected) in zip(self.parsers, line_counts):
+                parser.lines_parsed += parsed
+                parser.lines_rejected += rejected
+            for fname, short_name, count, err in results:
+                if err is not None:
+                    self._handle_file_error(archive, short_name, err)
+                elif count is None:
+                    retry.append((fname, short_name))
+                elif count:
+                    archive.update_sub_count(short_name, count)
+        for fname, short_name in retry:
+            self.log_debug(f"Obfuscating {short_name} in the main process, as "
+                           "it contains items unknown to the worker processes")
+            self._obfuscate_archive_file(archive, fname, short_name)
+
+    def _run_shard_workers(self, func, archive, shards, get_data):
+        """Handle each shard of the files of an archive in a forked worker,
+        with no more than file_jobs workers running at the same time. A worker
+        is only forked once another one has finished, so that it starts from
+        the state of this process at that point.
+
+        :param func:        Called by each worker with the data sent to it,
+                            the archive and the files of its shard
+        :type func:         ``callable``
+
+        :param archive:     The archive being obfuscated
+        :type archive:      ``SoSObfuscationArchive``
+
+        :param shards:      The shards of the file list
+        :type shards:       ``list`` of ``list``
+
+        :param get_data:    Called with the index of a shard right after its
+                            worker is forked, and returns the data to send to
+                            the worker
+        :type get_data:     ``callable``
+
+        :returns:   The result of each worker, None for those that failed
+        :rtype:     ``list``
+        """
+        ctx = multiprocessing.get_context('fork')
+        results = [None] * len(shards)
+        running = {}
+        for idx, shard in enumerate(shards):
+            while len(running) >= self.opts.file_jobs:
+                self._collect_shard_results(running, results)
+            proc, conn = self._fork_shard_worker(ctx, func, archive, shard)
+            running[conn] = (idx, proc)
+            conn.send(get_data(idx))
+        while running:
+            self._collect_shard_results(running, results)
+        return results
+
+    def _collect_shard_results(self, running, results):
+        """Wait for at least one of the running workers to finish, and store
+        the results of those that have
+
+        :param running:     The index of the shard and process of each
+                            running worker, by its end of the pipe
+        :type running:      ``dict``
+
+        :param results:     The results of the workers, by shard index
+        :type results:      ``list``
+        """
+        for conn in multiprocessing.connection.wait(list(running)):
+            idx, proc = running.pop(conn)
+            results[idx] = self._get_shard_result(proc, conn)
+
+    def _fork_shard_worker(self, ctx, func, archive, files):
+        """Fork a worker process that handles a shard of the files of an
+        archive. The worker waits for data to be sent to it before calling
+        ``func`` with that data, the archive and the files, and sends back the
+        result.
+
+        :param ctx:     The multiprocessing context to fork the worker with
+        :type ctx:      ``multiprocessing.context.ForkContext``
+
+        :returns:       The worker process and its end of the pipe
+        :rtype:         ``tuple``
+        """
+        conn, child_conn = ctx.Pipe()
+        proc = ctx.Process(target=self._run_shard_worker,
+                           args=(child_conn, func, archive, files))
+        proc.start()
+        child_conn.close()
+        return proc, conn
+
+    def _run_shard_worker(self, conn, func, archive, files):
+        """The entry point of the worker processes forked by
+        _fork_shard_worker()
+        """
+        data = conn.recv()
+        result = None
+        try:
+            result = func(data, archive, files)
+        except Exception as err:
+            self.log_info(f"Worker failed to process files: {err}",
+                          caller=archive.archive_name)
+        conn.send(result)
+        conn.close()
+
+    def _get_shard_result(self, proc, conn):
+        """Wait for the result of a worker forked by _fork_shard_worker()
+
+        :returns:   The result sent by the worker, or None if it failed
+        """
+        try:
+            result = conn.recv()
+        except EOFError:
+            result = None
+        conn.close()
+        proc.join()
+        return result
+
+    def _add_discovered_items(self, shard_items):
+        """Add the items discovered in a shard of files by a worker process to
+        the maps, in the order the worker added them to its own maps.
+
+        Items that contain one of the obfuscated values generated by the
+        worker are the result of parsing the worker's own substitutions again,
+        for example a MAC address regex matching part of an already obfuscated
+        address, and are not added. The equivalent items for the obfuscated
+        values generated here are found by the second phase instead.
+
+        :param shard_items: For each parser, the (item, obfuscated value)
+                            tuples discovered by the worker
+        :type shard_items:  ``list`` of ``list``
+        """
+        values = {
+            value for items in shard_items for item, value in items
+            if value and value != item
+        }
+        worker_values = None
+        if values:
+            worker_values = re.compile(
+                '|'.join(re.escape(v) for v in sorted(values, key=len,
+                                                      reverse=True))
+            )
+        for parser, items in zip(self.parsers, shard_items):
+            for item, _ in items:
+                if worker_values and worker_values.search(item):
+                    continue
+                try:
+                    parser.mapping.get(item)
+                except Exception as err:
+                    self.log_debug(f"Failed to add {item} to {parser.name} "
+                                   f"map: {err}")
+
+    def _shard_file_list(self, files, count):
+        """Split a list of files into contiguous shards of roughly the same
+        total size. The size of single compressed files is scaled by
+        compressed_size_ratio, as they are obfuscated decompressed.
+
+        :param files:   The (path, short name) tuples of files to split
+        :type files:    ``list``
+
+        :param count:   The maximum number of shards to create
+        :type count:    ``int``
+
+        :returns:       The shards of the file list
+        :rtype:         ``list`` of ``list``
+        """
+        sizes = []
+        for fname, _ in files:
+            try:
+                size = os.lstat(fname).st_size
+            except OSError:
+                size = 0
+            if get_file_compression(fname):
+                size *= self.compressed_size_ratio
+            sizes.append(size)
+        target = max(sum(sizes) / max(count, 1), 1)
+        shards = [[]]
+        shard_size = 0
+        for _file, size in zip(files, sizes):
+            if shard_size >= target and len(shards) < count:
+                shards.append([])
+                shard_size = 0
+            shards[-1].append(_file)
+            shard_size += size
+        return [shard for shard in shards if shard]
+
+    def discover_file_items(self, _data, archive, files):
+        """Parse files without writing the result, in order to find the items
+        that would be added to the maps when obfuscating them. This is run by
+        the worker processes of the first phase of
+        obfuscate_files_in_processes().
+
+        :param archive: The archive being obfuscated
+        :type archive:  ``SoSObfuscationArchive``
+
+        :param files:   The (path, short name) tuples of files to parse
+        :type files:    ``list``
+
+        :returns:   For each parser, the items added to its map and their
+                    obfuscated values, in the order they were added
+        :rtype:     ``list`` of ``list``
+        """
+        for parser in self.parsers:
+            parser.mapping.discoveries = []
+        for fname, short_name in files:
+            try:
+                if self._obfuscate_file_content(fname, short_name,
+                                                archive.archive_name,
+                                                write=False) is not None:
+                    self._get_obfuscated_file_names(fname, short_name)
+            except Exception as err:
+                self.log_debug(f"Unable to parse file {short_name}: {err}")
+        return [
+            [(item, parser.mapping.dataset.get(item))
+             for item in parser.mapping.discoveries]
+            for parser in self.parsers
+        ]
+
+    def obfuscate_files_with_reserved_items(self, reserved, archive, files):
+        """Obfuscate files while only allowing the maps to add the items that
+        have been reserved for them, using the obfuscated values that were
+        generated for them. This is run by the worker processes of the second
+        phase of obfuscate_files_in_processes().
+
+        Files that contain items that have not been reserved, or for which a
+        map generates a different obfuscated value, are left untouched.
+
+        :param reserved: For each parser, the items and obfuscated values its
+                         map may use
+        :type reserved:  ``list`` of ``dict``
+
+        :param archive: The archive being obfuscated
+        :type archive:  ``SoSObfuscationArchive``
+
+        :param files:   The (path, short name) tuples of files to obfuscate
+        :type files:    ``list``
+
+        :returns:   The path, short name, number of substitutions and any
+                    error for each file, where the number of substitutions is
+                    None if the file still needs to be obfuscated. Along with
+                    the number of lines parsed and rejected by each parser.
+        :rtype:     ``tuple`` of (``list``, ``list``)
+        """
+        for parser, items in zip(self.parsers, reserved):
+            parser.mapping.reserved = items
+            parser.lines_parsed = 0
+            parser.lines_rejected = 0
+        results = []
+        for fname, short_name in files:
+            for parser in self.parsers:
+                parser.mapping.discoveries = []
+            try:
+                result = self._obfuscate_file_content(fname, short_name,
+                                                      archive.archive_name)
+                if result is None:
+                    results.append((fname, short_name, 0, None))
+                    continue
+                subs, tname = result
+                ob_names = self._get_obfuscated_file_names(fname, short_name)
+                if any(
+                    item not in items or
+                    parser.mapping.dataset.get(item) != items[item]
+                    for parser, items in zip(self.parsers, reserved)
+                    for item in parser.mapping.discoveries
+                ):
+                    if tname:
+                        os.unlink(tname)
+                    results.append((fname, short_name, None, None))
+                    continue
+                self._replace_obfuscated_file(fname, short_name, subs, tname,
+                                              *ob_names)
+                results.append((fname, short_name, subs, None))
+            except Exception as err:
+                results.append((fname, short_name, 0, str(err)))
+        return results, [
+            (parser.lines_parsed, parser.lines_rejected)
+            for parser in self.parsers
+        ]
+
     def obfuscate_file(self, filename, short_name=None, arc_name=None):
-        # pylint: disable=too-many-locals
         """Obfuscate and individual file, line by line.
 
-        Lines processed, even if no substitutions occur, are then written to a
-        temp file without our own tmpdir. Once the file has been completely
+        Once the first substitution is made, the lines processed are written
+        to a temp file next to the file. Once the file has been completely
         iterated through, if there have been substitutions then the temp file
-        overwrites the original file. If there are no substitutions, then the
-        original file is left in place.
+        replaces the original file. If there are no substitutions, then the
+        original file is left in place and nothing is written.
 
         Positional arguments:
 
@@ -763,44 +1536,292 @@ third party.
         if not filename:
             # the requested file doesn't exist in the archive
             return None
-        subs = 0
         if not short_name:
             short_name = filename.split('/')[-1]
-        if not os.path.islink(filename):
+        result = self._obfuscate_file_content(filename, short_name, arc_name)
+        if result is None:
+            return 0
+        subs, tname = result
+        ob_names = self._get_obfuscated_file_names(filename, short_name)
+        self._replace_obfuscated_file(filename, short_name, subs, tname,
+                                      *ob_names)
+        return subs
+
+    def _obfuscate_file_content(self, filename, short_name, arc_name=None,
+                                write=True):
+        """Obfuscate the content of a file, line by line, into a temp file
+        next to the file, which is only created once a substitution is made.
+        Single compressed files are decompressed as they are read, and the
+        temp file is compressed the same way.
+
+        :param filename:    The path of the file to obfuscate
+        :type filename:     ``str``
+
+        :param short_name:  The path of the file within the archive
+        :type short_name:   ``str``
+
+        :param arc_name:    The name of the archive, used for logging
+        :type arc_name:     ``str``
+
+        :param write:       Write the obfuscated lines to the temp file
+        :type write:        ``bool``
+
+        :returns:   The number of substitutions made and the path of the temp
+                    file, which is None for symlinks, if no substitutions were
+                    made or if ``write`` is not set. None if the file should
+                    not be obfuscated at all.
+        :rtype:     ``tuple`` or ``None``
+        """
+        if os.path.islink(filename):
             # don't run the obfuscation on the link, but on the actual file
             # at some other point.
-            _parsers = [
-                _p for _p in self.parsers if not
-                any(
-                    _skip.match(short_name) for _skip in _p.skip_patterns
-                )
-            ]
-            if not _parsers:
-                self.log_debug(
-                    f"Skipping obfuscation of {short_name or filename} due to "
-                    f"matching file skip pattern"
-                )
-                return 0
-            self.log_debug(f"Obfuscating {short_name or filename}",
-                           caller=arc_name)
-            tfile = tempfile.NamedTemporaryFile(mode='w', dir=self.tmpdir)
-            with open(filename, 'r', errors='replace') as fname:
-                for line in fname:
-                    try:
-                        line, count = self.obfuscate_line(line, _parsers)
-                        subs += count
-                        tfile.write(line)
-                    except Exception as err:
-                        self.log_debug(f"Unable to obfuscate {short_name}: "
-                                       f"{err}", caller=arc_name)
-            tfile.seek(0)
-            if subs:
-                shutil.copyfile(tfile.name, filename)
+            return 0, None
+        _parsers = self._get_file_parsers(short_name)
+        if not _parsers:
+            self.log_debug(
+                f"Skipping obfuscation of {short_name or filename} due to "
+                f"matching file skip pattern"
+            )
+            return None
+        self.log_debug(f"Obfuscating {short_name or filename}",
+                       caller=arc_name)
+        subs = None
+        _copy = []
+
+        def _open_copy(length):
+            _copy.extend(self._open_obfuscated_copy(filename, length))
+            return _copy[1]
+
+        try:
+            with self._open_file_text(filename) as fname:
+                subs = self._obfuscate_lines(fname,
+                                             _open_copy if write else None,
+                                             short_name, _parsers, arc_name)
+        finally:
+            if _copy:
+                tname, tfile, raw = _copy
+                tfile.close()
+                raw.close()
+                if subs is None:
+                    os.unlink(tname)
+        return subs, _copy[0] if _copy else None
+
+    @staticmethod
+    def _open_file_text(filename):
+        """Open a file to read its text content in the same way as it is
+        obfuscated, decompressing single compressed files
+        """
+        _module = get_file_compression(filename)
+        if _module:
+            return _module.open(filename, 'rt', errors='replace')
+        return open(filename, 'r', errors='replace')
+
+    def _open_obfuscated_copy(self, filename, length):
+        """Open the temp file that the obfuscated content of a file is written
+        to, in the same directory so that it can replace the file once done,
+        and copy the start of the file, which has no substitutions, to it.
+        The temp file is compressed the same way as the file.
+
+        :param filename:    The path of the file being obfuscated
+        :type filename:     ``str``
+
+        :param length:      The number of characters to copy
+        :type length:       ``int``
+
+        :returns:   The path of the temp file, the text file object to write
+                    to it and the underlying binary file object, which both
+                    need to be closed in that order
+        :rtype:     ``tuple``
+        """
+        _fd, tname = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                      prefix='.sos-clean-')
+        raw = open(_fd, 'wb')
+        _module = get_file_compression(filename)
+        tfile = io.TextIOWrapper(
+            open_compressed_file(_module, raw, 'wb') if _module else raw
+        )
+        try:
+            with self._open_file_text(filename) as fname:
+                while length > 0:
+                    content = fname.read(
+                        min(length, self.obfuscate_block_size)
+                    )
+                    if not content:
+                        break
+                    tfile.write(content)
+                    length -= len(content)
+        except Exception:
             tfile.close()
+            raw.close()
+            os.unlink(tname)
+            raise
+        return tname, tfile, raw
+
+    def _get_file_parsers(self, short_name):
+        """Get the parsers that should be used for a file, i.e. the parsers
+        that the file does not match a skip pattern of
+
+        :param short_name:  The path of the file within the archive
+        :type short_name:   ``str``
+
+        :returns:   The parsers to obfuscate the file with
+        :rtype:     ``list``
+        """
+        return [
+            _p for _p in self.parsers if not
+            any(
+                _skip.match(short_name) for _skip in _p.skip_patterns
+            )
+        ]
 
+    def _obfuscate_lines(self, infile, outfile, short_name, parsers,
+                         arc_name=None):
+        """Obfuscate the lines read from a file object, writing them to
+        another file object if one is given.
+
+        The file is read in large blocks, and only the lines of a block that
+        any of the parsers may change are passed to obfuscate_line(), see
+        _split_candidate_lines(). The lines between them are copied as is.
+
+        :param outfile: The file object to write to, or a callable returning
+                        it once the first substitution is made. The callable
+                        is passed the number of characters read before the
+                        line the substitution was made in, which it must have
+                        written to the file object already.
+        :type outfile:  file object or ``callable``
+
+        :returns:   The number of substitutions made
+        :rtype:     ``int``
+        """
+        subs = 0
+        read = 0
+        _out = None if callable(outfile) else outfile
+        _counted = [_p for _p in parsers if _p.regex_patterns]
+        _partial = ''
+        while True:
+            block = infile.read(self.obfuscate_block_size)
+            content = _partial + block
+            if block:
+                # keep the last, incomplete, line for the next block
+                end = content.rfind('\n') + 1
+                content, _partial = content[:end], content[end:]
+            for lines, candidate in self._split_candidate_lines(content,
+                                                                parsers):
+                length = len(lines)
+                if not candidate:
+                    if _counted:
+                        num = len(self._nonblank_line.findall(lines))
+                        for _parser in _counted:
+                            _parser.count_unparsed_lines(lines, num)
+                    if _out:
+                        _out.write(lines)
+                    read += length
+                    continue
+                try:
+                    lines, count = self.obfuscate_line(lines, parsers)
+                    subs += count
+                    if count and not _out and outfile:
+                        _out = outfile(read)
+                    if _out:
+                        _out.write(lines)
+                except Exception as err:
+                    self.log_debug(f"Unable to obfuscate {short_name}: "
+                                   f"{err}", caller=arc_name)
+                read += length
+            if not block:
+                return subs
+
+    def _split_candidate_lines(self, content, parsers):
+        """Split content made of whole lines into the lines that any of the
+        parsers may change, and the runs of lines between them that none of
+        the parsers will change.
+
+        The lines are found by searching the content for the regexes returned
+        by each parser's get_line_candidate_regexes(). As items may be added
+        to the maps while the lines found are obfuscated, the regexes are
+        fetched again for each line, while the position of the next match of
+        regexes that did not change is kept.
+
+        :param content: The lines to split
+        :type content:  ``str``
+
+        :param parsers: The parsers the lines will be obfuscated with
+        :type parsers:  ``list``
+
+        :returns:   The runs of lines, each with whether they may be changed
+        :rtype:     A generator of (``str``, ``bool``) tuples
+        """
+        pos = 0
+        _next = {}
+        while pos < len(content):
+            start = len(content)
+            for _parser in parsers:
+                for regex, confirm in _parser.get_line_candidate_regexes():
+                    if _next.get(regex, -1) < pos:
+                        _next[regex] = self._find_candidate_line(
+                            content, pos, regex, confirm
+                        )
+                    start = min(start, _next[regex])
+            if start >= len(content):
+                yield content[pos:], False
+                return
+            line_start = content.rfind('\n', pos, start) + 1 or pos
+            line_end = content.find('\n', start) + 1 or len(content)
+            if line_start > pos:
+                yield content[pos:line_start], False
+            yield content[line_start:line_end], True
+            pos = line_end
+
+    @staticmethod
+    def _find_candidate_line(content, pos, regex, confirm):
+        """Find the next match of a regex from get_line_candidate_regexes()
+        in content, skipping the lines that do not also match any of the
+        regexes in confirm
+
+        :returns:   The position of the match, or the length of content if
+                    there is none
+        :rtype:     ``int``
+        """
+        while pos < len(content):
+            match = regex.search(content, pos)
+            if not match:
+                break
+            if confirm is None:
+                return match.start()
+            line_start = content.rfind('\n', 0, match.start()) + 1
+            pos = content.find('\n', match.start()) + 1 or len(content)
+            line = content[line_start:pos]
+            if any(_regex.search(line) for _regex in confirm):
+                return match.start()
+        return len(content)
+
+    def _get_obfuscated_file_names(self, filename, short_name):
+        """Get the obfuscated path of a file within the archive, and for
+        symlinks the obfuscated link target
+
+        :returns:   The obfuscated path and link target, or None if the file
+                    is not a symlink
+        :rtype:     ``tuple``
+        """
         _ob_short_name = self.obfuscate_string(short_name.split('/')[-1])
         _ob_filename = short_name.replace(short_name.split('/')[-1],
                                           _ob_short_name)
+        _target_ob = None
+        if _ob_filename != short_name and os.path.islink(filename):
+            # generate the obfuscated name of the link target
+            _target_ob = self.obfuscate_string(os.readlink(filename))
+        return _ob_filename, _target_ob
+
+    def _replace_obfuscated_file(self, filename, short_name, subs, tname,
+                                 _ob_filename, _target_ob):
+        """Replace a file with its obfuscated content from the temp file, if
+        any substitutions were made, and rename it to its obfuscated name
+        """
+        if tname:
+            if subs:
+                self._replace_file_content(filename, tname)
+            else:
+                os.unlink(tname)
 
         if _ob_filename != short_name:
             arc_path = filename.split(short_name)[0]
@@ -810,8 +1831,6 @@ third party.
             if not os.path.islink(filename):
                 os.rename(filename, _ob_path)
             else:
-                # generate the obfuscated name of the link target
-                _target_ob = self.obfuscate_string(os.readlink(filename))
                 # remove the unobfuscated original symlink first, in case the
                 # symlink name hasn't changed but the target has
                 os.remove(filename)
@@ -820,7 +1839,23 @@ third party.
                 # when the actual file is obfuscated, will be created
                 os.symlink(_target_ob, _ob_path)
 
-        return subs
+    def _replace_file_content(self, filename, tname):
+        """Atomically replace a file with the temp file holding its obfuscated
+        content, keeping the permissions and ownership of the file. Files with
+        several hard links are overwritten instead, so that the content of
+        all the links is obfuscated.
+        """
+        fstat = os.stat(filename)
+        if fstat.st_nlink > 1:
+            shutil.copyfile(tname, filename)
+            os.unlink(tname)
+            return
+        os.chmod(tname, stat.S_IMODE(fstat.st_mode))
+        try:
+            os.chown(tname, fstat.st_uid, fstat.st_gid)
+        except OSError:
+            pass
+        os.replace(tname, filename)
 
     def obfuscate_symlinks(self, archive):
         """Iterate over symlinks in the archive and obfuscate their names.
@@ -932,5 +1967,8 @@ third party.
         for parser in self.parsers:
             _sec = parse_sec.add_section(parser.name.replace(' ', '_').lower())
             _sec.add_field('entries', len(parser.mapping.dataset.keys()))
+            if parser.regex_patterns:
+                _sec.add_field('lines_parsed', parser.lines_parsed)
+                _sec.add_field('lines_rejected', parser.lines_rejected)
 
 # vim: set et ts=4 sw=4 :
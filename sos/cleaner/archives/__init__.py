@@ -8,22 +8,133 @@
 #
 # See the LICENSE file in the source distribution for further information.
 
+import bz2
+import gzip
 import logging
+import lzma
 import os
 import shutil
 import stat
 import tarfile
+import tempfile
 import re
 
 from concurrent.futures import ProcessPoolExecutor
-from sos.utilities import file_is_binary
+from sos.utilities import content_is_binary, file_is_binary
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def is_tarfile(path):
+    """Check if path is a tarball, including zstd compressed tarballs which
+    python's tarfile does not support, if the zstandard module is available
+
+    :param path:    The path of the file to check
+    :type path:     ``str``
+
+    :returns:   True if the file is a tarball we can read
+    :rtype:     ``bool``
+    """
+    try:
+        if not path.endswith('.zst'):
+            return tarfile.is_tarfile(path)
+        if zstandard is None:
+            return False
+        with open(path, 'rb') as zfile:
+            _reader = zstandard.ZstdDecompressor().stream_reader(zfile)
+            with tarfile.open(fileobj=_reader, mode='r|') as tar:
+                return tar.next() is not None
+    except Exception:
+        return False
+
+
+def open_tarfile(path, tmpdir=None):
+    """Open a tarball for reading. A zstd compressed tarball is decompressed
+    to a temp file in tmpdir first, as members are read from tarballs out of
+    order, which a zstd stream does not allow. The temp file is removed right
+    away, and its space is freed once the returned tarfile is closed.
+
+    :param path:    The path of the tarball
+    :type path:     ``str``
+
+    :param tmpdir:  The directory to decompress zstd compressed tarballs in
+    :type tmpdir:   ``str``
+
+    :returns:   The tarfile open for reading
+    :rtype:     ``tarfile.TarFile``
+    """
+    if not path.endswith('.zst'):
+        return tarfile.open(path)
+    with tempfile.TemporaryFile(dir=tmpdir) as _tmp:
+        with open(path, 'rb') as zfile:
+            zstandard.ZstdDecompressor().copy_stream(zfile, _tmp)
+        _tmp.seek(0)
+        fileobj = os.fdopen(os.dup(_tmp.fileno()), 'rb')
+    tar = tarfile.open(fileobj=fileobj)
+    # have closing the tarfile close the temp file, as tarfile itself does
+    # for the files of compressed tarballs
+    tar._extfileobj = False  # pylint: disable=protected-access
+    return tar
+
+
+# the modules used to (de)compress single compressed files, rather than
+# archives, by file extension, so that their content can be obfuscated
+COMPRESSED_FILE_MODULES = {
+    '.gz': gzip,
+    '.xz': lzma,
+    '.bz2': bz2,
+    '.bzip2': bz2
+}
+
+
+def get_file_compression(fname):
+    """Get the module that a single compressed file is compressed with, based
+    on its extension
+
+    :param fname:   The name of the file
+    :type fname:    ``str``
+
+    :returns:   The ``gzip``, ``lzma`` or ``bz2`` module, or None if the file
+                is not compressed
+    :rtype:     ``module``
+    """
+    for _ext, _module in COMPRESSED_FILE_MODULES.items():
+        if fname.endswith(_ext):
+            return _module
+    return None
+
+
+def open_compressed_file(module, fileobj, mode='rb'):
+    """Open a binary file object, to read or write its content through the
+    (de)compression of module. The file object is not closed along with the
+    returned one. The name of fileobj, e.g. a temp file, is not recorded in
+    gzip headers.
+
+    :param module:  The module returned by get_file_compression()
+    :type module:   ``module``
+
+    :param fileobj: The file object holding the compressed content
+    :type fileobj:  file object
+
+    :param mode:    'rb' or 'wb'
+    :type mode:     ``str``
+
+    :returns:   The (de)compressing file object
+    :rtype:     file object
+    """
+    if module is gzip:
+        return gzip.GzipFile(filename='', mode=mode, fileobj=fileobj)
+    return module.open(fileobj, mode)
 
 
 # python older than 3.8 will hit a pickling error when we go to spawn a new
 # process for extraction if this method is a part of the SoSObfuscationArchive
 # class. So, the simplest solution is to remove it from the class.
 def extract_archive(archive_path, tmpdir):
-    archive = tarfile.open(archive_path)
+    archive = open_tarfile(archive_path, tmpdir)
     path = os.path.join(tmpdir, 'cleaner')
     # set extract filter since python 3.12 (see PEP-706 for more)
     # Because python 3.10 and 3.11 raises false alarms as exceptions
@@ -33,7 +144,7 @@ def extract_archive(archive_path, tmpdir):
                                         (lambda member, path: member))
     archive.extractall(path)
     archive.close()
-    return os.path.join(path, archive.name.split('/')[-1].split('.tar')[0])
+    return os.path.join(path, archive_path.split('/')[-1].split('.tar')[0])
 
 
 class SoSObfuscationArchive():
@@ -62,6 +173,8 @@ class SoSObfuscationArchive():
         self.ui_log = logging.getLogger('sos_ui')
         self.skip_list = self._load_skip_list()
         self.is_extracted = False
+        # contents returned by get_file_content(), by filename
+        self.file_content_cache = {}
         self._load_self()
         self.archive_root = ''
         self.log_info(
@@ -83,7 +196,7 @@ class SoSObfuscationArchive():
 
     def _load_self(self):
         if self.is_tarfile:
-            self.tarobj = tarfile.open(self.archive_path)
+            self.tarobj = open_tarfile(self.archive_path, self.tmpdir)
 
     def get_nested_archives(self):
         """Return a list of ObfuscationArchives that represent additional
@@ -99,7 +212,9 @@ class SoSObfuscationArchive():
         filenames given to methods in this class.
         """
         if self.is_tarfile:
-            toplevel = self.tarobj.firstmember
+            # firstmember is only set until the members are first read
+            toplevel = (self.tarobj.firstmember or
+                        self.tarobj.getmembers()[0])
             if toplevel.isdir():
                 return toplevel.name
             else:
@@ -135,10 +250,7 @@ class SoSObfuscationArchive():
 
     @property
     def is_tarfile(self):
-        try:
-            return tarfile.is_tarfile(self.archive_path)
-        except Exception:
-            return False
+        return is_tarfile(self.archive_path)
 
     def remove_file(self, fname):
         """Remove a file from the archive. This is used when cleaner encounters
@@ -166,7 +278,23 @@ class SoSObfuscationArchive():
     def get_file_content(self, fname):
         """Return the content from the specified fname. Particularly useful for
         tarball-type archives so we can retrieve prep file contents prior to
-        extracting the entire archive
+        extracting the entire archive.
+
+        The content is cached, as the same files are read for several parsers
+        and preppers, until clear_file_content_cache() is called.
+        """
+        if fname not in self.file_content_cache:
+            self.file_content_cache[fname] = self._read_file_content(fname)
+        return self.file_content_cache[fname]
+
+    def clear_file_content_cache(self):
+        """Drop the contents cached by get_file_content(), e.g. once the files
+        may be changed by obfuscating them
+        """
+        self.file_content_cache = {}
+
+    def _read_file_content(self, fname):
+        """Read the content of fname from the archive, see get_file_content()
         """
         if self.is_extracted is False and self.is_tarfile:
             filename = self.format_file_name(fname)
@@ -240,15 +368,45 @@ class SoSObfuscationArchive():
         if self.is_tarfile:
             if self.archive_path.endswith('xz'):
                 return 'xz'
+            if self.archive_path.endswith('zst'):
+                return 'zst'
             return 'gz'
         return None
 
     def build_tar_file(self, method):
         """Pack the extracted archive as a tarfile to then be re-compressed
         """
+        tar, tarpath = self.open_tar_file(self.extracted_path, method)
+        tar.add(self.extracted_path,
+                arcname=os.path.split(self.archive_name)[1])
+        tar.close()
+        return tarpath
+
+    def open_tar_file(self, path, method):
+        """Open the tarfile that the obfuscated archive is written to
+
+        :param path:    The path of the archive, without the extension
+        :type path:     ``str``
+
+        :param method:  The compression method to use, if any
+        :type method:   ``str``
+
+        :returns:   The tarfile open for writing, and its path
+        :rtype:     ``tuple``
+        """
         mode = 'w'
-        tarpath = self.extracted_path + '-obfuscated.tar'
+        tarpath = path + '-obfuscated.tar'
         compr_args = {}
+        if method == 'zst':
+            tarpath += '.zst'
+            self.log_debug(f"Building tar file {tarpath}")
+            _comp = zstandard.ZstdCompressor(level=3).stream_writer(
+                open(tarpath, 'wb')
+            )
+            tar = tarfile.open(fileobj=_comp, mode=mode)
+            # closing the tarfile closes the compressor, and so the file
+            tar._extfileobj = False  # pylint: disable=protected-access
+            return tar, tarpath
         if method:
             mode += f":{method}"
             tarpath += f".{method}"
@@ -257,11 +415,7 @@ class SoSObfuscationArchive():
             else:
                 compr_args = {'compresslevel': 6}
         self.log_debug(f"Building tar file {tarpath}")
-        tar = tarfile.open(tarpath, mode=mode, **compr_args)
-        tar.add(self.extracted_path,
-                arcname=os.path.split(self.archive_name)[1])
-        tar.close()
-        return tarpath
+        return tarfile.open(tarpath, mode=mode, **compr_args), tarpath
 
     def compress(self, method):
         """Execute the compression command, and set the appropriate final
@@ -365,7 +519,16 @@ class SoSObfuscationArchive():
         if (not os.path.isfile(self.get_file_path(filename)) and not
                 os.path.islink(self.get_file_path(filename))):
             return True
+        return self.in_skip_list(filename)
+
+    def in_skip_list(self, filename):
+        """Checks the provided filename against self.skip_list only, without
+        checking the file itself, e.g. for a member of a tarball that is not
+        extracted
 
+        :param filename:    Filename relative to the archive root
+        :type filename:     ``str``
+        """
         for _skip in self.skip_list:
             if filename.startswith(_skip) or re.match(_skip, filename):
                 return True
@@ -381,10 +544,49 @@ class SoSObfuscationArchive():
         :returns:   ``True`` if the file cannot be reliably obfuscated
         :rtype:     ``bool``
         """
+        if self._is_obvious_remove(fname):
+            return True
+
+        _full_path = self.get_file_path(fname)
+        if os.path.isfile(_full_path):
+            _module = get_file_compression(fname)
+            if _module:
+                # check the decompressed content, which is what is obfuscated
+                try:
+                    with _module.open(_full_path, 'rb') as _cfile:
+                        return content_is_binary(_cfile.read(1 << 20))
+                except Exception as err:
+                    self.log_debug(f"Unable to decompress {fname}: {err}")
+                    return True
+            return file_is_binary(_full_path)
+        # don't fail on dir-level symlinks
+        return False
+
+    def should_remove_member(self, fname, content):
+        """Determine if a member of a tarball that is not extracted should be
+        removed or not, in the same way as ``should_remove_file()``.
+
+        :param fname:       Filename relative to the archive root
+        :type fname:        ``str``
+
+        :param content:     The start of the member's content, decompressed
+                            for single compressed files, or None if it could
+                            not be decompressed
+        :type content:      ``bytes``
+
+        :returns:   ``True`` if the file cannot be reliably obfuscated
+        :rtype:     ``bool``
+        """
+        return (
+            self._is_obvious_remove(fname) or content is None or
+            content_is_binary(content)
+        )
+
+    def _is_obvious_remove(self, fname):
+        """Check if the file should be removed based on its name alone"""
+        # single compressed files are obfuscated through decompressing them,
+        # see get_file_compression()
         obvious_removes = [
-            r'.*\.gz$',  # TODO: support flat gz/xz extraction
-            r'.*\.xz$',
-            r'.*\.bzip2$',
             r'.*\.tar\..*',  # TODO: support archive unpacking
             r'.*\.txz$',
             r'.*\.tgz$',
@@ -398,11 +600,6 @@ class SoSObfuscationArchive():
         for _arc_reg in obvious_removes:
             if re.match(_arc_reg, fname):
                 return True
-
-        _full_path = self.get_file_path(fname)
-        if os.path.isfile(_full_path):
-            return file_is_binary(_full_path)
-        # don't fail on dir-level symlinks
         return False
 
 # vim: set et ts=4 sw=4 :
@@ -9,9 +9,8 @@
 # See the LICENSE file in the source distribution for further information.
 
 import os
-import tarfile
 
-from sos.cleaner.archives import SoSObfuscationArchive
+from sos.cleaner.archives import SoSObfuscationArchive, is_tarfile
 
 
 class DataDirArchive(SoSObfuscationArchive):
@@ -41,7 +40,7 @@ class TarballArchive(SoSObfuscationArchive):
     @classmethod
     def check_is_type(cls, arc_path):
         try:
-            return tarfile.is_tarfile(arc_path)
+            return is_tarfile(arc_path)
         except Exception:
             return False
 
@@ -8,9 +8,7 @@
 #
 # See the LICENSE file in the source distribution for further information.
 
-import tarfile
-
-from sos.cleaner.archives import SoSObfuscationArchive
+from sos.cleaner.archives import SoSObfuscationArchive, is_tarfile
 
 
 class InsightsArchive(SoSObfuscationArchive):
@@ -24,7 +22,7 @@ class InsightsArchive(SoSObfuscationArchive):
     @classmethod
     def check_is_type(cls, arc_path):
         try:
-            return tarfile.is_tarfile(arc_path) and 'insights-' in arc_path
+            return is_tarfile(arc_path) and 'insights-' in arc_path
         except Exception:
             return False
 
@@ -10,8 +10,12 @@
 
 import re
 
+from bisect import bisect_right
+from functools import lru_cache
 from threading import Lock
 
+from sos.cleaner.matcher import SoSItemMatcher, SoSLazyPattern
+
 
 class SoSMap():
     """Standardized way to store items with their obfuscated counterparts.
@@ -27,24 +31,73 @@ class SoSMap():
     compile_regexes = True
     ignore_short_items = False
     match_full_words_only = False
+    # how many items to remember the ignore_item() checks of
+    ignore_cache_size = 65536
 
     def __init__(self):
         self.dataset = {}
         self._regexes_made = set()
         self.compiled_regexes = []
+        # the negated lengths of the items in compiled_regexes, in the same
+        # order, used to find where new items belong in the list
+        self._regex_lengths = []
+        self.matcher = SoSItemMatcher(self)
         self.lock = Lock()
+        # when set to a list, new items are recorded here as they are added
+        self.discoveries = None
+        # when set to a dict of items and their obfuscated values generated
+        # by another process, only these items may be added to the map
+        self.reserved = None
+        self._compile_ignore_matches()
+        self._is_ignored_item = lru_cache(maxsize=self.ignore_cache_size)(
+            self._check_ignored_item
+        )
+
+    @classmethod
+    def _compile_ignore_matches(cls):
+        """Compile the ignore_matches of the map class once, to be shared by
+        all instances of the map
+        """
+        if '_ignore_regexes' in cls.__dict__:
+            return
+        cls._ignore_regexes = [
+            re.compile(skip, re.I) for skip in cls.ignore_matches
+        ]
+
+    def add_ignore_match(self, pattern):
+        """Add a pattern to the ignore_matches of the map, so that items it
+        matches are no longer obfuscated
+
+        :param pattern: The regex pattern of the items to ignore
+        :type pattern:  ``str``
+        """
+        self.ignore_matches.append(pattern)
+        self._ignore_regexes.append(re.compile(pattern, re.I))
+        self._is_ignored_item.cache_clear()
 
     def ignore_item(self, item):
         """Some items need to be completely ignored, for example link-local or
         loopback addresses should not be obfuscated
         """
-        if not item or item in self.skip_keys or item in self.dataset.values()\
-                or (self.ignore_short_items and len(item) <= 3):
+        if not item or item in self.dataset.values():
+            return True
+        return self._is_ignored_item(item)
+
+    def _check_ignored_item(self, item):
+        """Check the parts of ignore_item() that only depend on the item
+        itself, and not on the contents of the map. The result of these checks
+        is cached, as the same items are seen over and over in a report.
+
+        :param item:    The item to check
+        :type item:     ``str``
+
+        :returns:       True if the item should be ignored
+        :rtype:         ``bool``
+        """
+        if item in self.skip_keys or \
+                (self.ignore_short_items and len(item) <= 3):
             return True
-        for skip in self.ignore_matches:
-            if re.match(skip, item, re.I):
-                return True
-        return False
+        return any(skip.match(item) for skip in self._ignore_regexes)
 
     def add(self, item):
         """Add a particular item to the map, generating an obfuscated pair
@@ -56,15 +109,27 @@ class SoSMap():
         """
         if self.ignore_item(item):
             return item
+        if self.discoveries is not None:
+            self.discoveries.append(item)
+        if self.reserved is not None and item not in self.reserved:
+            return item
         with self.lock:
-            self.dataset[item] = self.sanitize_item(item)
+            if self.reserved is not None and not self.compile_regexes:
+                # items of maps that don't use regexes are only looked up
+                # where they are found, so the reserved value can be used
+                # directly. Other maps must generate the value themselves,
+                # to set up the same regexes as the process that reserved it
+                self.dataset[item] = self.reserved[item]
+            else:
+                self.dataset[item] = self.sanitize_item(item)
             if self.compile_regexes:
                 self.add_regex_item(item)
             return self.dataset[item]
 
     def add_regex_item(self, item):
-        """Add an item to the regexes dict and then re-sort the list that the
-        parsers will use during parse_line()
+        """Add an item to the regexes dict and then insert it in the list that
+        the parsers will use during parse_line(), after all items at least as
+        long as it is
 
         :param item:    The unobfuscated item to generate a regex for
         :type item:     ``str``
@@ -77,13 +142,80 @@ class SoSMap():
             # through the actual compiled_regexes list, especially for very
             # large collections of entries
             self._regexes_made.add(item)
-            # add the item, Pattern tuple directly to the compiled_regexes list
-            # and then sort the existing list, rather than rebuild the list
-            # from scratch every time we add something like we would do if we
-            # tracked/saved the item and the Pattern() object in a dict or in
-            # the set above
-            self.compiled_regexes.append((item, self.get_regex_result(item)))
-            self.compiled_regexes.sort(key=lambda x: len(x[0]), reverse=True)
+            # insert the item, Pattern tuple directly at its place in the
+            # compiled_regexes list, which is kept sorted longest item first,
+            # rather than re-sorting the whole list every time we add
+            # something
+            _regex = self.get_regex_result(item)
+            _pos = bisect_right(self._regex_lengths, -len(item))
+            self._regex_lengths.insert(_pos, -len(item))
+            self.compiled_regexes.insert(_pos, (item, _regex))
+            self.matcher.add(item, _regex)
+
+    def add_regex_items(self, items):
+        """Add many items to the regexes dict at once, e.g. all the items
+        loaded from a map file, sorting the list that the parsers will use
+        during parse_line() only once for all of them
+
+        :param items:   The unobfuscated items to generate regexes for
+        :type items:    ``list``
+        """
+        _values = set(self.dataset.values())
+        _new = []
+        for item in items:
+            if not item or item in _values or item in self._regexes_made \
+                    or self._is_ignored_item(item):
+                continue
+            self._regexes_made.add(item)
+            _new.append((item, self.get_regex_result(item)))
+        if not _new:
+            return
+        # the sort is stable, so items of the same length are kept in the
+        # order they were added, as add_regex_item() would have done
+        self.compiled_regexes.extend(_new)
+        self.compiled_regexes.sort(key=lambda x: len(x[0]), reverse=True)
+        self._regex_lengths = [-len(x[0]) for x in self.compiled_regexes]
+        self.matcher.add_items(_new)
+
+    def get_regex_index(self):
+        """Get the items of the map that add_regex_items() would generate
+        regexes for if the map was loaded from a map file, in the same order,
+        along with the combined regex pattern of the matcher for them. This
+        can be saved and then given to load_regex_index() when the same map
+        is loaded again.
+
+        :returns:   The items and the pattern of the matcher
+        :rtype:     ``dict``
+        """
+        _values = set(self.dataset.values())
+        _items = [
+            item for item in self.dataset
+            if item and item not in _values and not self._is_ignored_item(item)
+        ]
+        _items.sort(key=len, reverse=True)
+        _matcher = SoSItemMatcher(self)
+        for item in _items:
+            _matcher._add_entry(item, None)
+        return {'items': _items, 'pattern': _matcher.build_pattern()}
+
+    def load_regex_index(self, index):
+        """Load the regexes of the map's items from an index returned by
+        get_regex_index() for the same map contents, instead of generating
+        them. The Pattern() of each item is only compiled once it is used.
+
+        :param index:   The index of the items of the map
+        :type index:    ``dict``
+        """
+        if self.compiled_regexes:
+            # the saved pattern does not cover the items already added
+            self.add_regex_items(index['items'])
+            return
+        self._regexes_made.update(index['items'])
+        self.compiled_regexes = [
+            (item, SoSLazyPattern(self, item)) for item in index['items']
+        ]
+        self._regex_lengths = [-len(item) for item in index['items']]
+        self.matcher.load(self.compiled_regexes, index['pattern'])
 
     def get_regex_result(self, item):
         """Generate the object/value that is used by the parser when iterating
@@ -98,11 +230,51 @@ class SoSMap():
         :returns:       A compiled regex pattern for the item
         :rtype:         ``re.Pattern``
         """
+        return re.compile(
+            self.get_item_pattern(
+                ''.join(self.get_char_pattern(c) for c in item)
+            ),
+            re.I
+        )
+
+    def get_char_pattern(self, char):
+        """Get the regex pattern that matches a single character of an item,
+        used to build both the Pattern() of individual items and the combined
+        regex of the map's ``SoSItemMatcher``.
+
+        :param char:    A character of an item
+        :type char:     ``str``
+
+        :returns:       The pattern matching the character
+        :rtype:         ``str``
+        """
+        return re.escape(char)
+
+    def get_item_pattern(self, pattern):
+        """Wrap the pattern matching the characters of an item, or of several
+        items, with any checks on its surroundings.
+
+        :param pattern: The pattern matching the item(s)
+        :type pattern:  ``str``
+
+        :returns:       The pattern to compile
+        :rtype:         ``str``
+        """
         if self.match_full_words_only:
-            item = rf'(?=\b|_|-){re.escape(item)}(?=\b|_|-)'
-        else:
-            item = re.escape(item)
-        return re.compile(item, re.I)
+            return rf'(?=\b|_|-){pattern}(?=\b|_|-)'
+        return pattern
+
+    def get_match_key(self, item):
+        """Normalize an item, or the text matched by its regex, so that all
+        the ways the item can appear in a line map back to the item.
+
+        :param item:    The item or matched text
+        :type item:     ``str``
+
+        :returns:       The normalized item
+        :rtype:         ``str``
+        """
+        return item.lower()
 
     def sanitize_item(self, item):
         """Perform the obfuscation relevant to the item being added to the map.
@@ -82,14 +82,23 @@ class SoSHostnameMap(SoSMap):
                         self._domains[_domain_to_inject] = _ob_domain
         self.set_initial_counts()
 
-    def get_regex_result(self, item):
-        """Override the base get_regex_result() to provide a regex that, if
-        this is an FQDN or a straight domain, will include an underscore
-        formatted regex as well.
+    def get_char_pattern(self, char):
+        """Override the base get_char_pattern() so that, if this is an FQDN
+        or a straight domain, the regex will match an underscore formatted
+        item as well.
         """
-        if '.' in item:
-            item = item.replace('.', '(\\.|_)')
-        return re.compile(item, re.I)
+        if char == '.':
+            return r'(?:\.|_)'
+        return re.escape(char)
+
+    def get_item_pattern(self, pattern):
+        """Hostnames are matched within words as well, as they frequently
+        appear as parts of longer names such as file names.
+        """
+        return pattern
+
+    def get_match_key(self, item):
+        return item.lower().replace('_', '.')
 
     def set_initial_counts(self):
         """Set the initial counter for host and domain obfuscation numbers
@@ -113,7 +113,7 @@ class SoSIPMap(SoSMap):
             addr = ipaddress.ip_interface(item)
         except ValueError:
             # not an IP, add it to the skip list to avoid flooding logs
-            self.ignore_matches.append(item)
+            self.add_ignore_match(item)
             raise
         network = addr.network
 
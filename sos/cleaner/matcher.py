@@ -0,0 +1,234 @@
+# Copyright 2026 Red Hat, Inc.
+
+# This file is part of the sos project: https://github.com/sosreport/sos
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# version 2 of the GNU General Public License.
+#
+# See the LICENSE file in the source distribution for further information.
+
+import re
+
+
+class SoSItemMatcher():
+    """Find which of the items known to a SoSMap() appear in a line with a
+    single scan of the line, regardless of how many items the map holds.
+
+    All known items are compiled into one regex built from a trie of the
+    items, so that at every position of a line the longest item starting at
+    that position is found without trying each item in turn. Any shorter
+    items starting at the same position are prefixes of that match. The
+    items found are then returned longest first, in the same order as the
+    map's ``compiled_regexes`` list, so that parsers can apply only their
+    Pattern() objects instead of searching the line with every Pattern() of
+    the map.
+
+    Rebuilding the combined regex is comparatively expensive, so items added
+    to the map are first kept in a pending list that is searched item by
+    item, and only folded into a regex once enough of them have accumulated.
+    That regex is a second, smaller one for only the items added since the
+    main regex was last built, so that adding a few items to a large map,
+    e.g. one loaded from an index, does not rebuild the regex of all items.
+    Both are merged again once the smaller one grows too large.
+
+    :param mapping: The map whose items should be matched
+    :type mapping: ``SoSMap``
+    """
+
+    #: How many pending items to accumulate before rebuilding the regex
+    rebuild_threshold = 64
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+        self.regex = None
+        self.pattern = None
+        # the regex of the match keys added since self.regex was built
+        self.recent_regex = None
+        self.recent_keys = set()
+        # match key -> [(insertion index, item, Pattern)]
+        self.entries = {}
+        self.pending = []
+        self.count = 0
+
+    def add(self, item, regex):
+        """Add an item and its Pattern() to the matcher
+
+        :param item:    The unobfuscated item
+        :type item:     ``str``
+
+        :param regex:   The Pattern() used to substitute the item
+        :type regex:    ``re.Pattern``
+        """
+        self.pending.append(self._add_entry(item, regex))
+        if len(self.pending) >= self.rebuild_threshold:
+            self._fold_pending()
+
+    def add_items(self, items):
+        """Add many items and their Pattern() objects to the matcher at once,
+        rebuilding the combined regex only once for all of them
+
+        :param items:   The (item, Pattern) tuples to add
+        :type items:    ``list``
+        """
+        for item, regex in items:
+            self.pending.append(self._add_entry(item, regex))
+        self._fold_pending()
+
+    def _fold_pending(self):
+        """Fold the pending items into the regex of the recently added items,
+        or rebuild the regex of all items if there are now too many of those
+        """
+        self.recent_keys.update(
+            self.mapping.get_match_key(entry[1]) for entry in self.pending
+        )
+        if len(self.recent_keys) * 4 > len(self.entries):
+            self.build()
+        else:
+            self.recent_regex = re.compile(
+                self.build_pattern(self.recent_keys), re.I
+            )
+            self.pending = []
+
+    def _add_entry(self, item, regex):
+        entry = (self.count, item, regex)
+        self.count += 1
+        self.entries.setdefault(self.mapping.get_match_key(item), []).append(
+            entry
+        )
+        return entry
+
+    def build(self):
+        """(Re)build the combined regex from all items added so far"""
+        self.pattern = self.build_pattern()
+        if self.pattern:
+            self.regex = re.compile(self.pattern, re.I)
+        self.recent_regex = None
+        self.recent_keys = set()
+        self.pending = []
+
+    def build_pattern(self, keys=None):
+        """Build the combined regex pattern for the match keys of items,
+        without compiling it
+
+        :param keys:    The match keys, or ``None`` for all items added
+        :type keys:     ``iterable``
+
+        :returns:   The pattern, or ``None`` if there are no items
+        :rtype:     ``str``
+        """
+        trie = {}
+        for key in self.entries if keys is None else keys:
+            node = trie
+            for char in key:
+                node = node.setdefault(char, {})
+            node[''] = True
+        pattern = self._trie_pattern(trie)
+        if not pattern:
+            return None
+        return f"(?=({self.mapping.get_item_pattern(pattern)}))"
+
+    def load(self, items, pattern):
+        """Load items along with the combined regex pattern that was built
+        for exactly these items, e.g. by a previous run, so that the pattern
+        does not need to be built again
+
+        :param items:   The (item, Pattern) tuples the pattern was built for
+        :type items:    ``list``
+
+        :param pattern: The pattern returned by ``build_pattern()``
+        :type pattern:  ``str``
+        """
+        for item, regex in items:
+            self._add_entry(item, regex)
+        self.pending = []
+        self.pattern = pattern
+        if pattern:
+            self.regex = re.compile(pattern, re.I)
+
+    def _trie_pattern(self, node):
+        """Build the regex for a node of the trie. Children are tried before
+        ending the match at a node, so that the longest item starting at a
+        given position is the one matched.
+        """
+        alts = [
+            self.mapping.get_char_pattern(char) + self._trie_pattern(child)
+            for char, child in sorted(node.items()) if char
+        ]
+        if not alts:
+            return ''
+        pattern = alts[0] if len(alts) == 1 else f"(?:{'|'.join(alts)})"
+        if '' in node:
+            pattern = f"(?:{pattern})?"
+        return pattern
+
+    def get_regexes(self):
+        """Get the regexes that together match every item of the matcher,
+        e.g. to quickly find the lines of a file that contain any item
+
+        :returns:   The combined regexes and the Pattern() of pending items
+        :rtype:     ``list``
+        """
+        regexes = [
+            _regex for _regex in (self.regex, self.recent_regex) if _regex
+        ]
+        regexes.extend(entry[2] for entry in self.pending)
+        return regexes
+
+    def find(self, line):
+        """Find the items that appear in the line
+
+        :param line:    The line to search
+        :type line:     ``str``
+
+        :returns:   The (item, Pattern) tuples for the items found, longest
+                    item first, or ``None`` if a match could not be related
+                    back to an item and the line needs to be checked against
+                    every item instead
+        :rtype:     ``list`` or ``None``
+        """
+        found = {}
+        for _regex in (self.regex, self.recent_regex):
+            if _regex is None:
+                continue
+            for match in _regex.finditer(line):
+                key = self.mapping.get_match_key(match.group(1))
+                if key not in self.entries:
+                    return None
+                for end in range(len(key), 0, -1):
+                    for entry in self.entries.get(key[:end], ()):
+                        found[entry[0]] = entry
+        for entry in self.pending:
+            if entry[2].search(line):
+                found[entry[0]] = entry
+        return [
+            (item, regex) for _, item, regex in
+            sorted(found.values(), key=lambda x: (-len(x[1]), x[0]))
+        ]
+
+
+class SoSLazyPattern():
+    """Stands in for the Pattern() of an item, and only compiles it when it
+    is first used. This is used for the items of large maps loaded from an
+    index, most of which are never found in the files of any one archive.
+
+    :param mapping: The map the item belongs to
+    :type mapping:  ``SoSMap``
+
+    :param item:    The unobfuscated item
+    :type item:     ``str``
+    """
+
+    __slots__ = ('mapping', 'item', 'regex')
+
+    def __init__(self, mapping, item):
+        self.mapping = mapping
+        self.item = item
+        self.regex = None
+
+    def __getattr__(self, name):
+        if self.regex is None:
+            self.regex = self.mapping.get_regex_result(self.item)
+        return getattr(self.regex, name)
+
+# vim: set et ts=4 sw=4 :
@@ -12,6 +12,9 @@
 
 import re
 
+# matches the start of every line of a block of several lines
+ALL_LINES = re.compile('^', re.M)
+
 
 class SoSCleanerParser():
     """Parsers are used to build objects that will take a line as input,
@@ -32,6 +35,12 @@ class SoSCleanerParser():
                             line processed
     :vartype regex_patterns: ``list``
 
+    :cvar prefilter:    A regex pattern that matches every line that any of
+                        the ``regex_patterns`` can match, while being much
+                        cheaper to search for. Lines it does not match skip
+                        the ``regex_patterns`` entirely
+    :vartype prefilter: ``str``
+
     :cvar mapping: Used by the parser to store and obfuscate matches
     :vartype mapping: ``SoSMap()``
 
@@ -43,6 +52,7 @@ class SoSCleanerParser():
 
     name = 'Undefined Parser'
     regex_patterns = []
+    prefilter = None
     skip_line_patterns = []
     parser_skip_files = []  # list of skip files relevant to a parser
     skip_cleaning_files = []   # list of global skip files from cmdline args
@@ -54,6 +64,41 @@ class SoSCleanerParser():
             self.mapping.conf_update(config[self.map_file_key])
         self.skip_cleaning_files = skip_cleaning_files
         self._generate_skip_regexes()
+        self._compile_patterns()
+        # number of lines checked against the regex_patterns, and the number
+        # of those that were rejected by the prefilter
+        self.lines_parsed = 0
+        self.lines_rejected = 0
+
+    @classmethod
+    def _compile_patterns(cls):
+        """Compile the regex_patterns, skip_line_patterns and prefilter of
+        the parser class. These are the same for every instance of a parser,
+        so they are only compiled once per class rather than having the re
+        module look them up again for every line that is parsed.
+        """
+        if '_regexes' in cls.__dict__:
+            return
+        cls._regexes = [re.compile(p, re.I) for p in cls.regex_patterns]
+        cls._skip_line_regexes = [
+            re.compile(p, re.I) for p in cls.skip_line_patterns
+        ]
+        cls._prefilter = None
+        # within a block of several lines, this matches once for every line
+        # that the prefilter matches, by consuming the rest of the line
+        cls._prefilter_lines = None
+        if cls.prefilter:
+            cls._prefilter = re.compile(cls.prefilter, re.I)
+            cls._prefilter_lines = re.compile(
+                rf"(?:{cls.prefilter})[^\n]*()", re.I
+            )
+        # and this matches the start of lines that skip_line_patterns match
+        cls._skip_lines_regex = None
+        if cls.skip_line_patterns:
+            cls._skip_lines_regex = re.compile(
+                '|'.join(f"^(?:{p})" for p in cls.skip_line_patterns),
+                re.I | re.M
+            )
 
     def _generate_skip_regexes(self):
         """Generate the regexes for the parser's configured parser_skip_files
@@ -73,8 +118,7 @@ class SoSCleanerParser():
         """
         if not self.compile_regexes:
             return
-        for obitem in self.mapping.dataset:
-            self.mapping.add_regex_item(obitem)
+        self.mapping.add_regex_items(list(self.mapping.dataset))
 
     def parse_line(self, line):
         """This will be called for every line in every file we process, so that
@@ -86,8 +130,8 @@ class SoSCleanerParser():
         line again looking for new matches.
         """
         count = 0
-        for skip_pattern in self.skip_line_patterns:
-            if re.match(skip_pattern, line, re.I):
+        for skip_pattern in self._skip_line_regexes:
+            if skip_pattern.match(line):
                 return line, count
         if self.compile_regexes:
             line, _rcount = self._parse_line_with_compiled_regexes(line)
@@ -96,6 +140,50 @@ class SoSCleanerParser():
         count += _count
         return line, count
 
+    def get_line_candidate_regexes(self):
+        """Get the regexes that match somewhere in every line that
+        parse_line() may change, or that it skips, so that the other lines of
+        a file do not need to be parsed one by one. The regexes may change as
+        items are added to the parser's map.
+
+        Some regexes are only cheap checks, and a line they match may only be
+        changed if it also matches any of a list of regexes searched for
+        within the line.
+
+        :returns:   The regexes, each with the regexes that a line must also
+                    match, or None
+        :rtype:     ``list`` of ``tuple``
+        """
+        regexes = []
+        if self.regex_patterns:
+            regexes.append((self._prefilter or ALL_LINES, self._regexes))
+        if self._skip_lines_regex:
+            regexes.append((self._skip_lines_regex, None))
+        if self.compile_regexes:
+            regexes.extend(
+                (_regex, None) for _regex in self.mapping.matcher.get_regexes()
+            )
+        return regexes
+
+    def count_unparsed_lines(self, lines, num):
+        """Count lines that were not passed to parse_line(), as none of the
+        regexes from get_line_candidate_regexes() match them, in
+        lines_parsed and lines_rejected as if they had been parsed
+
+        :param lines:   The lines
+        :type lines:    ``str``
+
+        :param num:     The number of lines that are not blank
+        :type num:      ``int``
+        """
+        if not self.regex_patterns:
+            return
+        self.lines_parsed += num
+        if self._prefilter_lines:
+            self.lines_rejected += (
+                num - len(self._prefilter_lines.findall(lines))
+            )
+
     def _parse_line_with_compiled_regexes(self, line):
         """Check the provided line against known items we have encountered
         before and have pre-generated regex Pattern() objects for.
@@ -107,7 +195,12 @@ class SoSCleanerParser():
         :rtype:     ``str``, ``int``
         """
         count = 0
-        for item, reg in self.mapping.compiled_regexes:
+        # only the items found by the map's matcher need to be checked,
+        # rather than searching the line for every item in the map
+        regexes = self.mapping.matcher.find(line)
+        if regexes is None:
+            regexes = self.mapping.compiled_regexes
+        for item, reg in regexes:
             if reg.search(line):
                 line, _count = reg.subn(self.mapping.get(item.lower()), line)
                 count += _count
@@ -124,8 +217,10 @@ class SoSCleanerParser():
         :rtype: ``tuple``, ``(str, int))``
         """
         count = 0
-        for pattern in self.regex_patterns:
-            matches = [m[0] for m in re.findall(pattern, line, re.I)]
+        if not self._line_may_match(line):
+            return line, count
+        for pattern in self._regexes:
+            matches = [m[0] for m in pattern.findall(line)]
             if matches:
                 matches.sort(reverse=True, key=len)
                 count += len(matches)
@@ -138,6 +233,24 @@ class SoSCleanerParser():
                         line = line.replace(match, new_match)
         return line, count
 
+    def _line_may_match(self, line):
+        """Check if any of the regex_patterns may match the line, using the
+        parser's prefilter, and keep count of the lines rejected.
+
+        :param line:    The line about to be parsed with the regex_patterns
+        :type line:     ``str``
+
+        :returns:   False if none of the regex_patterns can match the line
+        :rtype:     ``bool``
+        """
+        if not self.regex_patterns:
+            return False
+        self.lines_parsed += 1
+        if self._prefilter and not self._prefilter.search(line):
+            self.lines_rejected += 1
+            return False
+        return True
+
     def parse_string_for_keys(self, string_data):
         """Parse a given string for instances of any obfuscated items, without
         applying the normal regex comparisons first. This is mainly used to
@@ -153,10 +266,9 @@ class SoSCleanerParser():
         :rtype: ``str``
         """
         if self.compile_regexes:
-            for item, reg in self.mapping.compiled_regexes:
-                if reg.search(string_data):
-                    string_data = reg.sub(self.mapping.get(item.lower()),
-                                          string_data)
+            string_data, _ = self._parse_line_with_compiled_regexes(
+                string_data
+            )
         else:
             for k, ob in sorted(self.mapping.dataset.items(), reverse=True,
                                 key=lambda x: len(x[0])):
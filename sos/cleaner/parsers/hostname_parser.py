@@ -8,7 +8,6 @@
 #
 # See the LICENSE file in the source distribution for further information.
 
-import re
 from sos.cleaner.parsers import SoSCleanerParser
 from sos.cleaner.mappings.hostname_map import SoSHostnameMap
 
@@ -20,6 +19,7 @@ class SoSHostnameParser(SoSCleanerParser):
     regex_patterns = [
         r'(((\b|_)[a-zA-Z0-9-\.]{1,200}\.[a-zA-Z]{1,63}(\b|_)))'
     ]
+    prefilter = r'\.[a-z]'
 
     def __init__(self, config, skip_cleaning_files=[]):
         self.mapping = SoSHostnameMap()
@@ -33,8 +33,8 @@ class SoSHostnameParser(SoSCleanerParser):
         _parse_line_with_compiled_regexes and _parse_line calls.
         """
         count = 0
-        for skip_pattern in self.skip_line_patterns:
-            if re.match(skip_pattern, line, re.I):
+        for skip_pattern in self._skip_line_regexes:
+            if skip_pattern.match(line):
                 return line, count
         line, _count = self._parse_line(line)
         count += _count
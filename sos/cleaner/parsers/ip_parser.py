@@ -20,6 +20,7 @@ class SoSIPParser(SoSCleanerParser):
         # IPv4 with or without CIDR
         r'((?<!(-|\.|\d))([0-9]{1,3}\.){3}([0-9]){1,3}(\/([0-9]{1,2}))?)'
     ]
+    prefilter = r'[0-9]\.[0-9]'
     skip_line_patterns = [
         # don't match package versions recorded in journals
         r'.*dnf\[.*\]:'
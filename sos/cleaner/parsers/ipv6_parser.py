@@ -29,6 +29,8 @@ class SoSIPv6Parser(SoSCleanerParser):
         r"(([0-9a-f]{1,4}(:[0-9a-f]{0,4}){0,5}))([^.])::(([0-9a-f]{1,4}"
         r"(:[0-9a-f]{1,4}){0,5})?))(/\d{1,3})?(?![:\\a-z0-9])"
     ]
+    # either eight hextets separated by colons, or a compressed address
+    prefilter = r'[0-9a-f]:[0-9a-f]|::'
     parser_skip_files = [
         'etc/dnsmasq.conf.*',
         '.*modinfo.*',
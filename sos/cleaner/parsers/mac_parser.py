@@ -8,8 +8,6 @@
 #
 # See the LICENSE file in the source distribution for further information.
 
-import re
-
 from sos.cleaner.parsers import SoSCleanerParser
 from sos.cleaner.mappings.mac_map import SoSMacMap
 
@@ -40,6 +38,8 @@ class SoSMacParser(SoSCleanerParser):
         IPV6_REG_4HEX,
         IPV4_REG
     ]
+    # all patterns need two hex digits, a delimiter and two more hex digits
+    prefilter = r'[0-9a-f]{2}[:_-][0-9a-f]{2}'
     obfuscated_patterns = (
         '53:4f:53',
         '534f:53'
@@ -67,8 +67,10 @@ class SoSMacParser(SoSCleanerParser):
 
     def _parse_line(self, line):
         count = 0
-        for pattern in self.regex_patterns:
-            matches = [m[0] for m in re.findall(pattern, line, re.I)]
+        if not self._line_may_match(line):
+            return line, count
+        for pattern in self._regexes:
+            matches = [m[0] for m in pattern.findall(line)]
             if matches:
                 count += len(matches)
                 for match in matches:
@@ -28,7 +28,9 @@ from pathlib import Path
 from shlex import quote
 from textwrap import fill
 from sos.cleaner import SoSCleaner
+from sos.collector.orchestrator import NodeOrchestrator
 from sos.collector.sosnode import SosNode
+from sos.collector.transfers import TransferScheduler
 from sos.options import ClusterOption, str_to_bool
 from sos.component import SoSComponent
 from sos.utilities import bold
@@ -80,12 +82,14 @@ class SoSCollector(SoSComponent):
         'clean': False,
         'cluster_options': [],
         'cluster_type': None,
+        'connect_jobs': None,
         'container_runtime': 'auto',
         'domains': [],
         'disable_parsers': [],
         'enable_plugins': [],
         'encrypt_key': '',
         'encrypt_pass': '',
+        'exec_jobs': None,
         'group': None,
         'image': '',
         'force_pull_image': True,
@@ -103,6 +107,8 @@ class SoSCollector(SoSComponent):
         'primary': '',
         'namespaces': None,
         'nodes': [],
+        'node_transfer_rate': 0,
+        'no_batch_probe': False,
         'no_env_vars': False,
         'no_local': False,
         'nopasswd_sudo': False,
@@ -111,6 +117,7 @@ class SoSCollector(SoSComponent):
         'only_plugins': [],
         'password': False,
         'password_per_node': False,
+        'pipeline': False,
         'plugopts': [],
         'plugin_timeout': None,
         'cmd_timeout': None,
@@ -118,6 +125,7 @@ class SoSCollector(SoSComponent):
         'registry_user': None,
         'registry_password': None,
         'registry_authfile': None,
+        'retrieve_jobs': None,
         'save_group': '',
         'since': '',
         'skip_commands': [],
@@ -126,7 +134,12 @@ class SoSCollector(SoSComponent):
         'ssh_key': '',
         'ssh_port': 22,
         'ssh_user': 'root',
+        'stream_archives': False,
         'timeout': 600,
+        'transfer_chunk_size': 64,
+        'transfer_jobs': 1,
+        'transfer_order': 'completion',
+        'transfer_rate': 0,
         'transport': 'auto',
         'verify': False,
         'usernames': [],
@@ -395,6 +408,17 @@ class SoSCollector(SoSComponent):
         collect_grp.add_argument('-i', '--ssh-key', help='Specify an ssh key')
         collect_grp.add_argument('-j', '--jobs', default=4, type=int,
                                  help='Number of concurrent nodes to collect')
+        collect_grp.add_argument('--connect-jobs', type=int, default=None,
+                                 help=('Number of nodes to connect to '
+                                       'concurrently with --pipeline. '
+                                       'Defaults to --jobs'))
+        collect_grp.add_argument('--exec-jobs', type=int, default=None,
+                                 help=('Number of nodes to run sos report on '
+                                       'concurrently with --pipeline. '
+                                       'Defaults to --jobs'))
+        collect_grp.add_argument('--retrieve-jobs', type=int, default=None,
+                                 help=('Number of archives to retrieve '
+                                       'concurrently. Defaults to --jobs'))
         collect_grp.add_argument('-l', '--list-options', action="store_true",
                                  help='List options available for profiles')
         collect_grp.add_argument('--label',
@@ -408,6 +432,10 @@ class SoSCollector(SoSComponent):
         collect_grp.add_argument('--nodes', action="append",
                                  help=('Provide a comma delimited list of '
                                        'nodes, or a regex to match against'))
+        collect_grp.add_argument('--no-batch-probe', action='store_true',
+                                 help=('Run the commands that set up each '
+                                       'node one at a time instead of in a '
+                                       'single batch'))
         collect_grp.add_argument('--no-pkg-check', action='store_true',
                                  help=('Do not run package checks. Use this '
                                        'with --cluster-type if there are rpm '
@@ -422,12 +450,41 @@ class SoSCollector(SoSComponent):
         collect_grp.add_argument('--password-per-node', action='store_true',
                                  default=False,
                                  help='Prompt for password for each node')
+        collect_grp.add_argument('--pipeline', action='store_true',
+                                 default=False,
+                                 help=('Collect from each node as soon as it '
+                                       'is connected, instead of connecting '
+                                       'to all nodes first'))
         collect_grp.add_argument('--preset', default='', required=False,
                                  help='Specify a sos preset to use')
         collect_grp.add_argument('--ssh-user',
                                  help='Specify an SSH user. Default root')
+        collect_grp.add_argument('--stream-archives', action='store_true',
+                                 default=False,
+                                 help=('Receive archives from nodes while '
+                                       'sos report writes them, without '
+                                       'saving them on the nodes'))
         collect_grp.add_argument('--timeout', type=int, required=False,
                                  help='Timeout for sosreport on each node.')
+        collect_grp.add_argument('--transfer-chunk-size', default=64, type=int,
+                                 help=('Copy archives larger than this many '
+                                       'MiB from nodes in verified chunks of '
+                                       'this size, 0 to copy them whole'))
+        collect_grp.add_argument('--transfer-jobs', default=1, type=int,
+                                 help=('Number of chunks of an archive to '
+                                       'copy concurrently'))
+        collect_grp.add_argument('--transfer-order', default='completion',
+                                 choices=TransferScheduler.orders,
+                                 help=('Order to retrieve archives in when '
+                                       'more nodes are ready than '
+                                       '--retrieve-jobs'))
+        collect_grp.add_argument('--transfer-rate', default=0, type=float,
+                                 help=('Limit retrieving archives from all '
+                                       'nodes together to this many MiB/s'))
+        collect_grp.add_argument('--node-transfer-rate', default=0,
+                                 type=float,
+                                 help=('Limit retrieving an archive from a '
+                                       'node to this many MiB/s'))
         collect_grp.add_argument('--transport', default='auto', type=str,
                                  help='Remote connection transport to use')
         collect_grp.add_argument("--upload", action="store_true",
@@ -1155,11 +1212,12 @@ class SoSCollector(SoSComponent):
                 self.collect_md.nodes.add_section(node[0])
                 client.set_node_manifest(getattr(self.collect_md.nodes,
                                                  node[0]))
-            else:
-                client.disconnect()
+                return client
+            client.disconnect()
         except Exception:
             # all exception logging is handled within SoSNode
             pass
+        return None
 
     def intro(self):
         """Print the intro message and prompts for a case ID if one is not
@@ -1227,6 +1285,14 @@ this utility or remote systems that it connects to.
                  not self.cluster.strict_node_list):
             self.client_list.append(self.primary)
 
+        self.transfers = TransferScheduler(
+            self.opts.retrieve_jobs or self.opts.jobs,
+            order=self.opts.transfer_order,
+            rate=int(self.opts.transfer_rate * 1024**2),
+            node_rate=int(self.opts.node_transfer_rate * 1024**2)
+        )
+        self.commons['transfers'] = self.transfers
+
         self.ui_log.info("\nConnecting to nodes...")
         nodes = [(n, None) for n in self.node_list if n not in filters]
 
@@ -1240,39 +1306,10 @@ this utility or remote systems that it connects to.
             nodes = _nodes
 
         try:
-            pool = ThreadPoolExecutor(self.opts.jobs)
-            pool.map(self._connect_to_node, nodes, chunksize=1)
-            pool.shutdown(wait=True)
-
-            if (self.opts.no_local and
-                    self.client_list[0].address == 'localhost'):
-                self.client_list.pop(0)
-
-            self.report_num = len(self.client_list)
-
-            if self.report_num == 0:
-                self.exit("No nodes connected. Aborting...", 1)
-            elif self.report_num == 1:
-                if self.client_list[0].address == 'localhost':
-                    self.exit(
-                        "Collection would only gather from localhost due to "
-                        "failure to either enumerate or connect to cluster "
-                        "nodes. Assuming single collection from localhost is "
-                        "not desired.\n"
-                        "Aborting...", 1
-                    )
-
-            self.ui_log.info("\nBeginning collection of sosreports from "
-                             f"{self.report_num} nodes, collecting a maximum "
-                             f"of {self.opts.jobs} concurrently\n")
-
-            npool = ThreadPoolExecutor(self.opts.jobs)
-            npool.map(self._finalize_sos_cmd, self.client_list, chunksize=1)
-            npool.shutdown(wait=True)
-
-            pool = ThreadPoolExecutor(self.opts.jobs)
-            pool.map(self._collect, self.client_list, chunksize=1)
-            pool.shutdown(wait=True)
+            if self.opts.pipeline:
+                self._pipeline_collect(nodes)
+            else:
+                self._phased_collect(nodes)
         except KeyboardInterrupt:
             self.exit("Exiting on user cancel\n", 130, force=True)
         except Exception as err:
@@ -1286,6 +1323,7 @@ this utility or remote systems that it connects to.
                 self.primary.collect_extra_cmd(files)
         msg = '\nSuccessfully captured %s of %s sosreports'
         self.log_info(msg % (self.retrieved, self.report_num))
+        self._record_transfer_metrics()
         self.close_all_connections()
         if self.retrieved > 0:
             arc_name = self.create_cluster_archive()
@@ -1301,6 +1339,92 @@ this utility or remote systems that it connects to.
             except Exception as err:
                 self.ui_log.error(f"Upload attempt failed: {err}")
 
+    def _check_connected_nodes(self):
+        """Exit if we could not connect to any node, or if only the local
+        node would be collected
+        """
+        if self.report_num == 0:
+            self.exit("No nodes connected. Aborting...", 1)
+        elif self.report_num == 1:
+            if self.client_list[0].address == 'localhost':
+                self.exit(
+                    "Collection would only gather from localhost due to "
+                    "failure to either enumerate or connect to cluster "
+                    "nodes. Assuming single collection from localhost is "
+                    "not desired.\n"
+                    "Aborting...", 1
+                )
+
+    def _phased_collect(self, nodes):
+        """Connect to all nodes, then finalize the sos command of all nodes,
+        then run sos report on and collect from all nodes
+        """
+        pool = ThreadPoolExecutor(self.opts.jobs)
+        pool.map(self._connect_to_node, nodes, chunksize=1)
+        pool.shutdown(wait=True)
+
+        if (self.opts.no_local and
+                self.client_list[0].address == 'localhost'):
+            self.client_list.pop(0)
+
+        self.report_num = len(self.client_list)
+        self._check_connected_nodes()
+
+        self.ui_log.info("\nBeginning collection of sosreports from "
+                         f"{self.report_num} nodes, collecting a maximum "
+                         f"of {self.opts.jobs} concurrently\n")
+
+        npool = ThreadPoolExecutor(self.opts.jobs)
+        npool.map(self._finalize_sos_cmd, self.client_list, chunksize=1)
+        npool.shutdown(wait=True)
+
+        pool = ThreadPoolExecutor(self.opts.jobs)
+        pool.map(self._collect, self.client_list, chunksize=1)
+        pool.shutdown(wait=True)
+
+    def _pipeline_collect(self, nodes):
+        """Collect from each node as soon as it is connected, see --pipeline
+        """
+        jobs = self.opts.jobs
+        orchestrator = NodeOrchestrator(
+            self._connect_to_node,
+            connect_jobs=self.opts.connect_jobs or jobs,
+            exec_jobs=self.opts.exec_jobs or jobs,
+            retrieve_jobs=self.opts.retrieve_jobs or jobs,
+            transfers=self.transfers
+        )
+        # nodes are added to client_list as they connect, so take a copy
+        clients = list(self.client_list)
+        if self.opts.no_local:
+            clients = [c for c in clients if c.address != 'localhost']
+        self.ui_log.info(
+            "\nBeginning collection of sosreports from up to "
+            f"{len(nodes) + len(clients)} nodes, connecting to a maximum of "
+            f"{orchestrator.connect_jobs}, running sos on a maximum of "
+            f"{orchestrator.exec_jobs} and retrieving from a maximum of "
+            f"{orchestrator.retrieve_jobs} concurrently\n"
+        )
+        self.client_list = orchestrator.run(nodes, clients)
+        self.report_num = len(self.client_list)
+        self.retrieved = orchestrator.retrieved
+        if self.report_num == 0 and clients:
+            self.report_num = 1
+            self.client_list = clients
+        self._check_connected_nodes()
+
+    def _record_transfer_metrics(self):
+        """Record the throughput of retrieving the archives from all nodes in
+        the manifest, and log a summary of it
+        """
+        metrics = self.transfers.get_metrics()
+        self.collect_md.add_field('transfers', metrics)
+        if metrics['archives']:
+            self.log_info(
+                f"Retrieved {metrics['bytes'] / 1024**2:.1f}MiB from "
+                f"{metrics['archives']} nodes in {metrics['seconds']:.1f}s, "
+                f"{metrics['bytes_per_second'] / 1024**2:.1f}MiB/s"
+            )
+
     def _finalize_sos_cmd(self, client):
         """Calls finalize_sos_cmd() on each node so that we have the final
         command before we thread out the actual execution of sos
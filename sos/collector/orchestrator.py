@@ -0,0 +1,235 @@
+# This file is part of the sos project: https://github.com/sosreport/sos
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# version 2 of the GNU General Public License.
+#
+# See the LICENSE file in the source distribution for further information.
+
+import asyncio
+import heapq
+import itertools
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PrioritySlots():
+    """Limits how many coroutines may hold a slot at once, like an
+    ``asyncio.Semaphore``, but lets waiting coroutines in lowest key first
+    instead of in the order they started waiting
+
+    :param limit:   How many slots there are
+    :type limit:    ``int``
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._waiting = []
+
+    async def acquire(self, key):
+        """Wait for a slot
+
+        :param key:     The key to be let in by, unique for each waiter
+        :type key:      ``tuple``
+        """
+        if self.active < self.limit and not self._waiting:
+            self.active += 1
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiting, (key, waiter))
+        # the slot is handed over by release()
+        await waiter
+
+    def release(self):
+        """Release a slot, handing it to the next waiter if there is one"""
+        if self._waiting:
+            _, waiter = heapq.heappop(self._waiting)
+            waiter.set_result(None)
+        else:
+            self.active -= 1
+
+
+class NodeOrchestrator():
+    """Collects sos reports from many nodes at once, as a separate pipeline
+    for each node: connecting to and setting up the node, running sos report
+    on it, and retrieving the archive. Each node moves on to its next step as
+    soon as it is done with the previous one, instead of waiting for every
+    other node to finish that step first, so a single slow node only delays
+    itself.
+
+    Each step has its own limit on how many nodes may be in it at the same
+    time, so that e.g. many nodes finishing sos report at once do not all
+    retrieve their archives at once, and slow retrievals do not keep other
+    nodes from starting sos report. Nodes waiting for a step only hold a
+    coroutine. The calls into ``SosNode`` and its transport block, so they run
+    in a thread pool that is as large as all limits combined, regardless of
+    how many nodes there are.
+
+    :param connect:     Connects to a node given its (address, password)
+                        tuple, returning the ``SosNode`` or ``None``
+    :type connect:      ``callable``
+
+    :param connect_jobs:    How many nodes to connect to and set up at once
+    :type connect_jobs:     ``int``
+
+    :param exec_jobs:       How many nodes to run sos report on at once
+    :type exec_jobs:        ``int``
+
+    :param retrieve_jobs:   How many archives to retrieve at once
+    :type retrieve_jobs:    ``int``
+
+    :param transfers:   The scheduler that decides the order in which nodes
+                        retrieve their archives, which should allow as many
+                        concurrent retrievals as ``retrieve_jobs``. Nodes are
+                        given their turn here in that order, and so are not
+                        queued by the scheduler again
+    :type transfers:    ``TransferScheduler``
+    """
+
+    def __init__(self, connect, connect_jobs=4, exec_jobs=4, retrieve_jobs=4,
+                 transfers=None):
+        self.connect = connect
+        self.connect_jobs = max(connect_jobs, 1)
+        self.exec_jobs = max(exec_jobs, 1)
+        self.retrieve_jobs = max(retrieve_jobs, 1)
+        self.transfers = transfers
+        self._seq = itertools.count()
+        self.clients = []
+        self.retrieved = 0
+
+    def run(self, nodes, clients=None):
+        """Collect sos reports from all nodes
+
+        Nodes in ``clients`` that are local only start their sos report once
+        any node of ``nodes`` is connected, and are skipped if none of them
+        can be connected, as collecting only from the local node is not what
+        was asked for.
+
+        :param nodes:   The (address, password) tuples of the nodes to connect
+                        to and collect from
+        :type nodes:    ``list``
+
+        :param clients: Nodes that are already connected, e.g. the primary
+        :type clients:  ``list`` of ``SosNode``
+
+        :returns:   The nodes that were collected from, in the order they
+                    were connected and set up
+        :rtype:     ``list`` of ``SosNode``
+        """
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(
+            self.connect_jobs + self.exec_jobs + self.retrieve_jobs
+        )
+        try:
+            loop.run_until_complete(
+                self._run(loop, executor, nodes, clients or [])
+            )
+        finally:
+            # don't wait on commands still running if we were interrupted
+            executor.shutdown(wait=False)
+            loop.close()
+        return self.clients
+
+    async def _run(self, loop, executor, nodes, clients):
+        self._loop = loop
+        self._executor = executor
+        self._connect_limit = asyncio.Semaphore(self.connect_jobs)
+        self._exec_limit = asyncio.Semaphore(self.exec_jobs)
+        self._retrieve_limit = PrioritySlots(self.retrieve_jobs)
+        self._connecting = len(nodes)
+        self._connected = 0
+        self._connect_done = asyncio.Event()
+        if not nodes:
+            self._connect_done.set()
+        tasks = [self._connect_node(node) for node in nodes]
+        tasks.extend(self._collect_node(client) for client in clients)
+        await asyncio.gather(*tasks)
+
+    async def _call(self, func, *args):
+        """Run a blocking call in the thread pool"""
+        return await self._loop.run_in_executor(self._executor, func, *args)
+
+    async def _retrieve_key(self, client=None):
+        """Get the key that a node is let in to retrieve its archive by,
+        which is only by archive size if the scheduler orders by it and the
+        archive already exists
+        """
+        if self.transfers is None:
+            return (next(self._seq), )
+        size = None
+        if client is not None and self.transfers.order == 'size':
+            size = await self._call(client.get_archive_size)
+        return self.transfers.sort_key(size)
+
+    async def _acquire_retrieve(self, client=None):
+        """Wait for the turn of a node to retrieve its archive. The node is
+        then not queued again by the transfer scheduler.
+
+        :returns:   How long the node waited for its turn
+        :rtype:     ``float``
+        """
+        key = await self._retrieve_key(client)
+        start = time.monotonic()
+        await self._retrieve_limit.acquire(key)
+        return time.monotonic() - start
+
+    async def _connect_node(self, node):
+        client = None
+        try:
+            async with self._connect_limit:
+                client = await self._call(self.connect, node)
+        finally:
+            self._connecting -= 1
+            if client is not None:
+                self._connected += 1
+            if client is not None or self._connecting == 0:
+                self._connect_done.set()
+        if client is not None:
+            await self._collect_node(client)
+
+    async def _collect_node(self, client):
+        if client.local:
+            await self._connect_done.wait()
+            if not self._connected:
+                client.log_debug('No other nodes connected, skipping')
+                return
+        try:
+            async with self._connect_limit:
+                await self._call(client.finalize_sos_cmd)
+        except Exception as err:
+            client.log_error(f"Could not finalize sos command: {err}")
+        self.clients.append(client)
+        try:
+            if client.stream:
+                async with self._exec_limit:
+                    waited = await self._acquire_retrieve()
+                    try:
+                        await self._call(client.sosreport, waited)
+                    finally:
+                        self._retrieve_limit.release()
+            else:
+                await self._run_and_retrieve(client)
+        except Exception as err:
+            client.log_error(f"Error running sosreport: {err}")
+        if client.retrieved:
+            self.retrieved += 1
+
+    async def _run_and_retrieve(self, client):
+        try:
+            async with self._exec_limit:
+                ready = await self._call(client.run_sosreport)
+            if ready:
+                waited = await self._acquire_retrieve(client)
+                try:
+                    client.retrieved = await self._call(
+                        client.retrieve_sosreport, waited
+                    )
+                finally:
+                    self._retrieve_limit.release()
+        except Exception as err:
+            client.log_error(f"Error during sos execution: {err}")
+        await self._call(client.cleanup)
+
+# vim: set et ts=4 sw=4 :
@@ -12,6 +12,7 @@
 
 import fnmatch
 import inspect
+import json
 import logging
 import os
 import re
@@ -19,6 +20,10 @@ import re
 from shlex import quote
 from sos.policies import load
 from sos.policies.init_systems import InitSystem
+from sos.policies.package_managers.dpkg import DpkgPackageManager
+from sos.policies.package_managers.flatpak import FlatpakPackageManager
+from sos.policies.package_managers.rpm import RpmPackageManager
+from sos.policies.package_managers.snap import SnapPackageManager
 from sos.collector.transports.juju import JujuSSH
 from sos.collector.transports.control_persist import SSHControlPersist
 from sos.collector.transports.local import LocalTransport
@@ -38,6 +43,38 @@ TRANSPORTS = {
     'juju': JujuSSH,
 }
 
+# Prefixes the JSON document printed by PROBE_SCRIPT, so that it can be told
+# apart from anything else written to the session, e.g. sudo prompts
+PROBE_MARKER = 'SOS_NODE_PROBE:'
+
+# Runs several commands on a node and prints all of their results as a single
+# JSON document. Each entry of argv[1] is a list of alternative commands, of
+# which the first one whose binary exists is run. This needs to work with both
+# python 2 and python 3, as it runs with whatever python the node provides.
+PROBE_SCRIPT = f'''
+import json, subprocess, sys
+res = {{}}
+for cmds in json.loads(sys.argv[1]):
+    for cmd in cmds:
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        out = proc.communicate()[0]
+        if proc.returncode != 127:
+            break
+    res[cmd] = {{"status": proc.returncode,
+                "output": out.decode("utf-8", "replace")}}
+sys.stdout.write("{PROBE_MARKER}" + json.dumps(res) + "\\n")
+'''
+
+# The interpreters tried, in order, to run PROBE_SCRIPT on a node
+PROBE_PYTHONS = ['python3', '/usr/libexec/platform-python', 'python']
+
+# The package managers whose packages any host policy may need to query
+PROBE_PACKAGE_MANAGERS = [
+    RpmPackageManager, DpkgPackageManager, FlatpakPackageManager,
+    SnapPackageManager
+]
+
 
 class SosNode():
 
@@ -57,6 +94,7 @@ class SosNode():
         self.hostname = None
         self.sos_env_vars = {}
         self._env_vars = {}
+        self._probed = {}
         self._password = password or self.opts.password
         if not self.opts.nopasswd_sudo and not self.opts.sudo_pw:
             self.opts.sudo_pw = self._password
@@ -64,6 +102,9 @@ class SosNode():
         if local_sudo:
             self.opts.sudo_pw = local_sudo
         self.sos_path = None
+        self.archive_size = None
+        self.stream = False
+        self.archive_saved = False
         self.retrieved = False
         self.hash_retrieved = False
         self.file_list = []
@@ -88,6 +129,8 @@ class SosNode():
         except Exception as err:
             self.log_error(f'Unable to open remote session: {err}')
             raise
+        if not self.local and not self.opts.no_batch_probe:
+            self.probe_node(load_facts)
         # load the host policy now, even if we don't want to load further
         # host information. This is necessary if we're running locally on the
         # cluster primary but do not want a local report as we still need to do
@@ -136,6 +179,78 @@ class SosNode():
             raise InvalidTransportException(self.opts.transport)
         return SSHControlPersist(self.address, commons)
 
+    def probe_node(self, load_facts=True):
+        """Run the commands needed to set up this node, e.g. to determine its
+        host policy and installed packages, and to load the sos plugins and
+        presets, all at once in a single command on the node instead of one
+        command each. The results are kept, and returned by ``run_command()``
+        and ``read_file()`` the first time the same command is run instead of
+        running it again.
+
+        If the node cannot run the probe, e.g. because it has no python
+        interpreter, nothing is kept and the commands are run individually.
+
+        :param load_facts: Should the sos plugins and presets also be probed
+        :type load_facts:  ``bool``
+
+        :returns:   True if the node was probed, else False
+        :rtype:     ``bool``
+        """
+        cmds = [['cat /etc/os-release']]
+        cmds.extend([pm.query_command] for pm in PROBE_PACKAGE_MANAGERS)
+        if load_facts:
+            # which of these applies depends on the sos version installed,
+            # which is not known yet, so let the probe pick the one that exists
+            cmds.append(['sos report -l', 'sosreport -l'])
+            cmds.append(['sos report --list-presets',
+                         'sosreport --list-presets'])
+        script = f"{quote(PROBE_SCRIPT)} {quote(json.dumps(cmds))}"
+        pythons = ' '.join(PROBE_PYTHONS)
+        probe = (
+            f"for py in {pythons}; do command -v $py >/dev/null && "
+            f"exec $py -c {script}; done; exit 127"
+        )
+        try:
+            res = self.run_command(f"/bin/sh -c {quote(probe)}", timeout=300,
+                                   need_root=True)
+        except Exception as err:
+            self.log_debug(f"Error while probing node: {err}")
+            return False
+        if res['status'] != 0 or PROBE_MARKER not in res['output']:
+            self.log_debug(
+                f"Unable to probe node (status {res['status']}), running "
+                "setup commands individually"
+            )
+            return False
+        try:
+            _out = res['output'].split(PROBE_MARKER, 1)[1]
+            self._probed = json.loads(_out.strip())
+        except ValueError as err:
+            self.log_debug(f"Unable to parse probe results: {err}")
+            return False
+        self.log_debug(f"Probed results of {len(self._probed)} commands")
+        return True
+
+    def _pop_probed(self, cmd):
+        """Get the probed result of cmd, if there is one. Results are only
+        returned once, so that running a command again does run it.
+        """
+        res = self._probed.pop(cmd, None)
+        if res is not None:
+            self.log_debug(f"Using probed result of '{cmd}'")
+        return res
+
+    def _run_policy_command(self, cmd, timeout=180, need_root=False, env=None,
+                            use_shell='auto'):
+        """Run a command for the host policy of this node, e.g. to query its
+        packages, using the probed result of the command if there is one
+        """
+        res = self._pop_probed(cmd)
+        if res is not None:
+            return res
+        return self._transport.run_command(cmd, timeout, need_root, env,
+                                           use_shell)
+
     def _fmt_msg(self, msg):
         return f"{self._hostname:<{self.hostlen + 1}} : {msg}"
 
@@ -378,6 +493,9 @@ class SosNode():
 
     def read_file(self, to_read):
         """Reads the specified file and returns the contents"""
+        res = self._pop_probed(f"cat {to_read}")
+        if res is not None:
+            return res['output'] if res['status'] == 0 else ''
         try:
             self.log_info(f"Reading file {to_read}")
             return self._transport.read_file(to_read)
@@ -395,7 +513,7 @@ class SosNode():
             return self.commons['policy']
         host = load(cache={}, sysroot=self.opts.sysroot, init=InitSystem(),
                     probe_runtime=True,
-                    remote_exec=self._transport.run_command,
+                    remote_exec=self._run_policy_command,
                     remote_check=self.read_file('/etc/os-release'))
         if host:
             self.log_info(f"loaded policy {host.distro} for host")
@@ -459,6 +577,10 @@ class SosNode():
                 raise
         if use_container and self.host.containerized:
             cmd = self.host.format_container_command(cmd)
+        else:
+            res = self._pop_probed(cmd)
+            if res is not None:
+                return res
         if need_root:
             cmd = self._format_cmd(cmd)
         if env:
@@ -467,20 +589,37 @@ class SosNode():
         return self._transport.run_command(cmd, timeout, need_root, env,
                                            use_shell)
 
-    def sosreport(self):
-        """Run an sos report on the node, then collect it"""
+    def sosreport(self, waited=None):
+        """Run an sos report on the node, then collect it
+
+        :param waited:  How long the node waited for its turn to retrieve the
+                        archive, if the caller gave it one already
+        :type waited:   ``float``
+        """
+        if self.stream:
+            self.retrieved = self.stream_sosreport(waited)
+            self.cleanup()
+            return
         try:
-            path = self.execute_sos_command()
-            if path:
-                self.finalize_sos_path(path)
-            else:
-                self.log_error('Unable to determine path of sos archive')
-            if self.sos_path:
+            if self.run_sosreport():
                 self.retrieved = self.retrieve_sosreport()
         except Exception as err:
             self.log_error(f"Error during sos execution: {err}")
         self.cleanup()
 
+    def run_sosreport(self):
+        """Run an sos report on the node, without collecting it yet
+
+        :returns:   True if the archive is ready to be retrieved, else False
+        :rtype:     ``bool``
+        """
+        path = self.execute_sos_command()
+        if path:
+            self.finalize_sos_path(path)
+        else:
+            self.log_error('Unable to determine path of sos archive')
+        return bool(self.sos_path)
+
     def _preset_exists(self, preset):
         """Verifies if the given preset exists on the node"""
         return preset in self.sos_info['presets']
@@ -642,6 +781,9 @@ class SosNode():
             if self.opts.low_priority:
                 sos_opts.append('--low-priority')
 
+        if self.opts.stream_archives:
+            self.stream = self._can_stream_archive()
+
         self.update_cmd_from_cluster()
 
         sos_cmd = sos_cmd.replace(
@@ -754,18 +896,30 @@ class SosNode():
         else:
             return f'sos exited with code {rc}'
 
-    def execute_sos_command(self):
-        """Run sos report and capture the resulting file path"""
+    def execute_sos_command(self, stream_to=None):
+        """Run sos report and capture the resulting file path
+
+        :param stream_to:   The FIFO on the node that sos report should write
+                            the archive to, if it is streamed
+        :type stream_to:    ``str``
+        """
         self.ui_msg('Generating sos report...')
         try:
             path = False
             checksum = False
-            res = self.run_command(self.sos_cmd,
+            sos_cmd = self.sos_cmd
+            if stream_to:
+                sos_cmd += f" --stream-to={quote(stream_to)}"
+            res = self.run_command(sos_cmd,
                                    timeout=self.opts.timeout,
                                    use_shell=True,
                                    need_root=True,
                                    use_container=True,
                                    env=self.sos_env_vars)
+            if stream_to:
+                # sos report does not stream the archive, but saves it on the
+                # node, when e.g. sos.conf enables uploading or encryption
+                self.archive_saved = 'saved in' in res['output']
             if res['status'] == 0:
                 for line in res['output'].splitlines():
                     if fnmatch.fnmatch(line, '*sosreport-*tar*'):
@@ -799,14 +953,21 @@ class SosNode():
             self.ui_msg(f"Error running sos report: {err}")
             raise
 
-    def retrieve_file(self, path):
-        """Copies the specified file from the host to our temp dir"""
+    def retrieve_file(self, path, checksum=None):
+        """Copies the specified file from the host to our temp dir
+
+        :param path:        The path of the file on the node
+        :type path:         ``str``
+
+        :param checksum:    The sha256 checksum to verify the copy against
+        :type checksum:     ``str``
+        """
         destdir = self.tmpdir + '/'
         dest = os.path.join(destdir, path.split('/')[-1])
         try:
             if self.file_exists(path):
                 self.log_info(f"Copying remote {path} to local {destdir}")
-                return self._transport.retrieve_file(path, dest)
+                return self._transport.retrieve_file(path, dest, checksum)
             else:
                 self.log_debug(f"Attempting to copy remote file {path}, but it"
                                " does not exist on filesystem")
@@ -838,18 +999,31 @@ class SosNode():
             self.log_debug(f'Failed to remove {path}: {e}')
             return False
 
-    def retrieve_sosreport(self):
-        """Collect the sosreport archive from the node"""
+    def retrieve_sosreport(self, waited=None):
+        """Collect the sosreport archive from the node
+
+        :param waited:  How long the node waited for its turn to retrieve the
+                        archive, if the caller gave it one already instead of
+                        the transfer scheduler
+        :type waited:   ``float``
+        """
         if self.need_sudo or self.opts.become_root:
             try:
                 self.make_archive_readable(self.sos_path)
             except Exception:
                 self.log_error('Failed to make archive readable')
                 return False
-        self.log_info(f'Retrieving sos report from {self.address}')
-        self.ui_msg('Retrieving sos report...')
+        checksum = None
+        if getattr(self.manifest, 'checksum_type', None) == 'sha256':
+            checksum = self.manifest.checksum
+        transfers = self.commons.get('transfers')
         try:
-            ret = self.retrieve_file(self.sos_path)
+            if transfers is None:
+                self.log_info(f'Retrieving sos report from {self.address}')
+                self.ui_msg('Retrieving sos report...')
+                ret = self.retrieve_file(self.sos_path, checksum)
+            else:
+                ret = self._scheduled_retrieve(transfers, checksum, waited)
         except Exception as err:
             self.log_error(err)
             return False
@@ -861,12 +1035,224 @@ class SosNode():
             self.ui_msg('Failed to retrieve sos report')
             return False
 
+    def get_archive_size(self):
+        """Get the size of the sos archive on the node, once sos report has
+        finished
+
+        :returns:   The size in bytes, or None if it is not known
+        :rtype:     ``int``
+        """
+        if self.archive_size is None and self.sos_path:
+            self.archive_size = self._transport.get_file_size(self.sos_path)
+        return self.archive_size
+
+    def _scheduled_retrieve(self, transfers, checksum, waited=None):
+        """Retrieve the sos archive once it is this node's turn to, and
+        within the bandwidth limits set, see --transfer-order and
+        --transfer-rate, recording the metrics of the transfer in the manifest
+
+        If `waited` is given, the caller already gave the node its turn.
+        """
+        size = None
+        if waited is None and transfers.order == 'size':
+            size = self.get_archive_size()
+        with transfers.transfer(self.address, size,
+                                waited=waited) as transfer:
+            self.log_info(f'Retrieving sos report from {self.address}')
+            self.ui_msg('Retrieving sos report...')
+            # retrieving from the local node does not use the network
+            if not self.local:
+                self._transport.limiter = transfer
+            try:
+                ret = self.retrieve_file(self.sos_path, checksum)
+            finally:
+                self._transport.limiter = None
+            if ret:
+                transfer.finish(os.path.getsize(
+                    os.path.join(self.tmpdir, self.sos_path.split('/')[-1])
+                ))
+        self.manifest.add_field('transfer', transfer.get_metrics())
+        return ret
+
+    def _can_stream_archive(self):
+        """Check if the archive can be streamed from the node while sos report
+        is running, see --stream-archives
+        """
+        if not self._transport.supports_streaming:
+            self.log_info(f"Transport {self._transport.name} does not support "
+                          "streaming, the archive will be copied instead")
+            return False
+        # released versions of sos do not necessarily support it, so check
+        # for the option rather than for a version
+        res = self.run_command(f"{self.sos_bin} --help", use_container=True,
+                               need_root=True)
+        if res['status'] != 0 or '--stream-to' not in res['output']:
+            self.log_info("sos on the node does not support --stream-to, the "
+                          "archive will be copied instead")
+            return False
+        if self.host.containerized:
+            self.log_info("Not streaming the archive from a containerized "
+                          "host, the archive will be copied instead")
+            return False
+        return True
+
+    def make_stream_fifo(self):
+        """Create the FIFO that sos report writes the archive to when it is
+        streamed, within a new directory only accessible to the user we
+        connect as
+
+        :returns:   The path of the FIFO, or None if it could not be created
+        :rtype:     ``str``
+        """
+        res = self.run_command('mktemp -d /var/tmp/sos-stream.XXXXXXXX',
+                               timeout=10)
+        if res['status'] != 0:
+            self.log_error(f"Unable to create directory for streaming the "
+                           f"archive: {res['output']}")
+            return None
+        fifo = os.path.join(res['output'].strip(), 'archive')
+        res = self.run_command(f"mkfifo -m 0600 {quote(fifo)}", timeout=10)
+        if res['status'] != 0:
+            self.log_error(f"Unable to create FIFO for streaming the archive: "
+                           f"{res['output']}")
+            self.remove_stream_fifo(fifo)
+            return None
+        return fifo
+
+    def remove_stream_fifo(self, fifo, unblock=False):
+        """Remove the FIFO created by make_stream_fifo() and its directory
+
+        :param fifo:    The path of the FIFO
+        :type fifo:     ``str``
+
+        :param unblock: Open the FIFO for writing first, so that a reader that
+                        is still waiting for sos report to open it sees the
+                        end of the file instead of waiting forever
+        :type unblock:  ``bool``
+        """
+        cmds = [
+            f"rm -f {quote(fifo)}",
+            f"rmdir {quote(os.path.dirname(fifo))}"
+        ]
+        if unblock:
+            cmds.insert(0, f"dd if=/dev/null of={quote(fifo)} oflag=nonblock "
+                           "2>/dev/null")
+        try:
+            res = self.run_command('; '.join(cmds), timeout=10,
+                                   use_shell=True)
+            if res['status'] != 0:
+                self.log_debug(f"Failed to remove {fifo}: {res['output']}")
+        except Exception as err:
+            self.log_debug(f"Failed to remove {fifo}: {err}")
+
+    def stream_sosreport(self, waited=None):
+        """Run sos report on the node with the archive written to a FIFO, and
+        receive the archive while sos report is still running instead of
+        copying it once sos report has finished. The archive is verified
+        against the checksum reported by sos report.
+
+        :param waited:  How long the node waited for a turn to retrieve the
+                        archive that the caller gave it, if any
+        :type waited:   ``float``
+
+        :returns:   True if the archive was received and verified, else False
+        :rtype:     ``bool``
+        """
+        fifo = self.make_stream_fifo()
+        if not fifo:
+            return False
+        dest = os.path.join(self.tmpdir, f".{self.address}-stream")
+        self.log_info(f"Streaming sos report from {self.address}")
+        transfers = self.commons.get('transfers')
+        if transfers is not None:
+            # streams are received while sos report runs, so only limit them
+            # instead of waiting for a turn
+            with transfers.transfer(self.address, queue=False,
+                                    waited=waited) as transfer:
+                if not self.local:
+                    self._transport.limiter = transfer
+                try:
+                    received, stream = self._receive_stream(fifo, dest)
+                finally:
+                    self._transport.limiter = None
+                if received:
+                    transfer.finish(stream.size)
+            self.manifest.add_field('transfer', transfer.get_metrics())
+        else:
+            received, stream = self._receive_stream(fifo, dest)
+        if self.sos_path and (self.archive_saved or
+                              (received and not stream.size)):
+            self.log_info("sos report saved the archive instead of streaming "
+                          "it, copying it instead")
+            if os.path.exists(dest):
+                os.unlink(dest)
+            # so that the archive is removed from the node afterwards
+            self.stream = False
+            return self.retrieve_sosreport(waited)
+        if received and self._verify_stream(stream):
+            os.rename(dest, os.path.join(self.tmpdir, self.archive))
+            self.ui_msg('Successfully collected sos report')
+            self.file_list.append(self.archive)
+            return True
+        if os.path.exists(dest):
+            os.unlink(dest)
+        self.ui_msg('Failed to retrieve sos report')
+        return False
+
+    def _receive_stream(self, fifo, dest):
+        """Run sos report with its archive written to fifo, and receive the
+        archive into dest
+
+        :returns:   If the whole archive was received, and the stream
+        :rtype:     ``tuple``
+        """
+        stream = self._transport.stream_file(fifo, dest)
+        received = False
+        try:
+            path = self.execute_sos_command(stream_to=fifo)
+            # sos report has exited, so the reader gets to the end of the
+            # FIFO right away even if sos report never opened it
+            self.remove_stream_fifo(fifo, unblock=True)
+            fifo = None
+            if path:
+                self.finalize_sos_path(path)
+                received = stream.wait(self.opts.timeout)
+            else:
+                self.log_error('Unable to determine name of sos archive')
+        except Exception as err:
+            self.log_error(f"Error during sos execution: {err}")
+        finally:
+            if fifo:
+                self.remove_stream_fifo(fifo, unblock=True)
+            if not received:
+                stream.cancel()
+        return received, stream
+
+    def _verify_stream(self, stream):
+        """Compare the checksum of a streamed archive to the one reported by
+        sos report
+        """
+        if stream.error:
+            self.log_error(f"Error receiving archive: {stream.error}")
+            return False
+        if self.manifest.checksum_type != 'sha256':
+            self.log_error("No sha256 checksum reported for streamed archive")
+            return False
+        if stream.hexdigest() != self.manifest.checksum:
+            self.log_error(f"Checksum mismatch for streamed archive, received "
+                           f"{stream.size} bytes with checksum "
+                           f"{stream.hexdigest()}")
+            return False
+        self.log_info(f"Received {stream.size} bytes, checksum verified")
+        return True
+
     def remove_sos_archive(self):
         """Remove the sosreport archive from the node, since we have
         collected it and it would be wasted space otherwise"""
-        if self.sos_path is None or self.local:
-            # local transport moves the archive rather than copies it, so there
-            # is no archive at the original location to remove
+        if self.sos_path is None or self.local or self.stream:
+            # local transport moves the archive rather than copies it, and a
+            # streamed archive is never written to disk, so there is no
+            # archive at the original location to remove
             return
         if 'sosreport' not in self.sos_path:
             self.log_debug(f"Node sos report path {self.sos_path} looks "
@@ -879,7 +1265,7 @@ class SosNode():
     def cleanup(self):
         """Remove the sos archive from the node once we have it locally"""
         self.remove_sos_archive()
-        if self.sos_path:
+        if self.sos_path and not self.stream:
             for ext in ['.sha256', '.md5']:
                 if self.remove_file(self.sos_path + ext):
                     break
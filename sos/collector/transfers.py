@@ -0,0 +1,263 @@
+# This file is part of the sos project: https://github.com/sosreport/sos
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# version 2 of the GNU General Public License.
+#
+# See the LICENSE file in the source distribution for further information.
+
+import heapq
+import itertools
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+class RateLimiter():
+    """Limits the rate at which data is transferred by any number of threads
+    to ``rate`` bytes per second, as a token bucket that allows bursts of at
+    most a tenth of a second worth of data.
+
+    Data is accounted for after it has been transferred, and the thread that
+    transferred it is made to sleep for as long as it takes the bucket to
+    refill, so that the average rate over time does not exceed the limit.
+
+    :param rate:    The maximum rate in bytes per second
+    :type rate:     ``int``
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = rate / 10
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """Account for nbytes transferred, waiting until the rate allows it
+
+        :param nbytes:  The number of bytes transferred
+        :type nbytes:   ``int``
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Transfer():
+    """A single retrieval of a file from a node, which measures how much data
+    was transferred and how long it took, and limits its rate by any number
+    of ``RateLimiter`` objects, e.g. one for the node and one shared by all
+    nodes.
+
+    :param name:        The name of the node the file is retrieved from
+    :type name:         ``str``
+
+    :param limiters:    The limiters the rate of the transfer is limited by
+    :type limiters:     ``list``
+
+    :param wait_time:   How long the transfer waited for its turn
+    :type wait_time:    ``float``
+    """
+
+    def __init__(self, name, limiters=None, wait_time=0):
+        self.name = name
+        self.limiters = limiters or []
+        self.wait_time = wait_time
+        self.transferred = 0
+        self.size = None
+        self.start = time.monotonic()
+        self.end = None
+
+    @property
+    def rate(self):
+        """The lowest rate limit of the transfer in bytes per second, or 0 if
+        its rate is not limited
+        """
+        return min((lim.rate for lim in self.limiters), default=0)
+
+    def consume(self, nbytes):
+        """Account for nbytes transferred, waiting until the rate limits of
+        the transfer allow it. This is called by transports as they receive
+        data.
+
+        :param nbytes:  The number of bytes transferred
+        :type nbytes:   ``int``
+        """
+        self.transferred += nbytes
+        for limiter in self.limiters:
+            limiter.consume(nbytes)
+
+    def finish(self, size=None):
+        """Mark the transfer as done
+
+        :param size:    The size of the file retrieved, if it was retrieved
+        :type size:     ``int``
+        """
+        self.end = time.monotonic()
+        self.size = size
+
+    @property
+    def seconds(self):
+        return (self.end or time.monotonic()) - self.start
+
+    def get_metrics(self):
+        """Get the metrics of the transfer, as recorded in the manifest
+
+        :returns:   The size, timing and throughput of the transfer
+        :rtype:     ``dict``
+        """
+        size = self.size or 0
+        return {
+            'bytes': size,
+            'bytes_transferred': self.transferred,
+            'wait_time': round(self.wait_time, 3),
+            'seconds': round(self.seconds, 3),
+            'bytes_per_second': int(size / self.seconds) if size else 0,
+            'rate_limit': self.rate,
+        }
+
+
+class TransferScheduler():
+    """Decides when archives are retrieved from nodes during sos collect, and
+    limits the bandwidth that retrieving them may use, see --retrieve-jobs,
+    --transfer-order, --transfer-rate and --node-transfer-rate.
+
+    At most ``jobs`` archives are retrieved at once. The nodes waiting for
+    their turn are let in either in the order they finished sos report, or
+    smallest archive first so that as many archives as possible are available
+    early. The rate of every transfer is limited by a ``RateLimiter`` shared
+    by all nodes, and one for each node.
+
+    :param jobs:        How many archives may be retrieved at once
+    :type jobs:         ``int``
+
+    :param order:       'completion' or 'size', see above
+    :type order:        ``str``
+
+    :param rate:        The maximum rate in bytes per second of all transfers
+                        together, or 0 for no limit
+    :type rate:         ``int``
+
+    :param node_rate:   The maximum rate in bytes per second of each node, or
+                        0 for no limit
+    :type node_rate:    ``int``
+    """
+
+    orders = ('completion', 'size')
+
+    def __init__(self, jobs, order='completion', rate=0, node_rate=0):
+        if order not in self.orders:
+            raise ValueError(f"Unknown transfer order '{order}'")
+        self.jobs = max(jobs, 1)
+        self.order = order
+        self.limiter = RateLimiter(rate) if rate > 0 else None
+        self.node_rate = max(node_rate, 0)
+        self.transfers = []
+        self.active = 0
+        self.peak = 0
+        self._seq = itertools.count()
+        self._waiting = []
+        self._cond = threading.Condition()
+
+    def sort_key(self, size=None):
+        """Get the key that a retrieval is let in by, lowest first
+
+        :param size:    The size of the archive, if it is known
+        :type size:     ``int``
+
+        :returns:   The key, unique for each retrieval
+        :rtype:     ``tuple``
+        """
+        if self.order == 'size':
+            return (float('inf') if size is None else size, next(self._seq))
+        return (next(self._seq), )
+
+    def _get_limiters(self):
+        limiters = [RateLimiter(self.node_rate)] if self.node_rate else []
+        if self.limiter:
+            limiters.append(self.limiter)
+        return limiters
+
+    @contextmanager
+    def transfer(self, name, size=None, queue=True, waited=None):
+        """Wait for the turn of a node to retrieve its archive, and provide
+        the ``Transfer`` that limits and measures the retrieval
+
+        :param name:    The name of the node
+        :type name:     ``str``
+
+        :param size:    The size of the archive, if known
+        :type size:     ``int``
+
+        :param queue:   Wait for a turn, or start right away but still limit
+                        and measure the transfer, e.g. for streamed archives
+        :type queue:    ``bool``
+
+        :param waited:  How long the node already waited for a turn that was
+                        given by the caller instead, e.g. by the pipeline of
+                        sos collect. The retrieval is then not queued again,
+                        but still counted as taking a turn
+        :type waited:   ``float``
+        """
+        queued = time.monotonic()
+        held = waited is not None
+        if queue or held:
+            key = self.sort_key(size) if not held else None
+            with self._cond:
+                if not held:
+                    heapq.heappush(self._waiting, key)
+                    self._cond.wait_for(
+                        lambda: self.active < self.jobs and
+                        self._waiting[0] == key
+                    )
+                    heapq.heappop(self._waiting)
+                self.active += 1
+                self.peak = max(self.peak, self.active)
+                # let the next in line in as well if there is room
+                self._cond.notify_all()
+        transfer = Transfer(name, self._get_limiters(),
+                            waited if held else time.monotonic() - queued)
+        try:
+            yield transfer
+        finally:
+            if transfer.end is None:
+                transfer.finish()
+            with self._cond:
+                if queue or held:
+                    self.active -= 1
+                self.transfers.append(transfer)
+                self._cond.notify_all()
+
+    def get_metrics(self):
+        """Get the metrics of all transfers, as recorded in the manifest
+
+        :returns:   The settings, total size, timing and throughput of all
+                    transfers
+        :rtype:     ``dict``
+        """
+        done = [t for t in self.transfers if t.size]
+        size = sum(t.size for t in done)
+        seconds = 0
+        if done:
+            seconds = max(t.end for t in done) - min(t.start for t in done)
+        return {
+            'order': self.order,
+            'jobs': self.jobs,
+            'rate_limit': self.limiter.rate if self.limiter else 0,
+            'node_rate_limit': self.node_rate,
+            'archives': len(done),
+            'bytes': size,
+            'seconds': round(seconds, 3),
+            'bytes_per_second': int(size / seconds) if seconds else 0,
+            'peak_concurrent': self.peak,
+        }
+
+# vim: set et ts=4 sw=4 :
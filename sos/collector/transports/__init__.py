@@ -8,10 +8,15 @@
 #
 # See the LICENSE file in the source distribution for further information.
 
+import hashlib
 import inspect
 import logging
+import os
 import re
-from shlex import quote
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from shlex import quote, split
+from threading import Thread, Timer
 
 import pexpect
 
@@ -31,6 +36,11 @@ class RemoteTransport():
 
     name = 'undefined'
     default_user = None
+    #: Can the transport stream a remote file, see `stream_file()`
+    supports_streaming = False
+    #: The largest chunk the transport can retrieve at once, if limited, or 0
+    #: if files are always copied whole
+    max_chunk_size = None
 
     def __init__(self, address, commons):
         self.address = address
@@ -38,6 +48,8 @@ class RemoteTransport():
         self.tmpdir = commons['tmpdir']
         self.need_sudo = commons['need_sudo']
         self._hostname = None
+        # the Transfer that retrievals are currently limited by, if any
+        self.limiter = None
         self.soslog = logging.getLogger('sos')
         self.ui_log = logging.getLogger('sos_ui')
 
@@ -352,24 +364,48 @@ class RemoteTransport():
         self.log_info(f"Hostname set to {self._hostname}")
         return self._hostname
 
-    def retrieve_file(self, fname, dest):
+    def retrieve_file(self, fname, dest, checksum=None):
         """Copy a remote file, fname, to dest on the local node
 
+        Files larger than the chunk size set by --transfer-chunk-size are
+        copied in chunks, see `_retrieve_file_chunked()`, so that a failed
+        transfer resumes from the chunks already received instead of
+        starting over. Other files are copied whole, unless the rate of the
+        transfer is limited by `limiter`, as data can only be limited as it
+        is received when copied in chunks. For files copied whole, the limit
+        only applies on average, by waiting after the copy.
+
         :param fname:   The name of the file to retrieve
         :type fname:    ``str``
 
         :param dest:    Where to save the file to locally
         :type dest:     ``str``
 
+        :param checksum:    The sha256 checksum of the file, if known, that
+                            the copied file is verified against
+        :type checksum:     ``str``
+
         :returns:   True if file was successfully copied from remote, or False
         :rtype:     ``bool``
         """
+        chunk_size = self.opts.transfer_chunk_size * 1024**2
+        if self.max_chunk_size is not None:
+            chunk_size = min(chunk_size, self.max_chunk_size)
+        if chunk_size:
+            size = self._get_file_size(fname)
+            if size and (size > chunk_size or self.limiter is not None):
+                ret = self._retrieve_file_chunked(fname, dest, size,
+                                                  chunk_size, checksum)
+                if ret is not None:
+                    return ret
         attempts = 0
         try:
             while attempts < 5:
                 attempts += 1
                 ret = self._retrieve_file(fname, dest)
                 if ret:
+                    self._throttle(os.path.getsize(dest))
+                if ret and self._verify_file(dest, checksum):
                     return True
                 self.log_info(f"File retrieval attempt {attempts} failed")
             self.log_info("File retrieval failed after 5 attempts")
@@ -379,10 +415,221 @@ class RemoteTransport():
                            f"{attempts} for {fname}: {err}")
             raise err
 
+    def _verify_file(self, fname, checksum):
+        """Verify a local file against its sha256 checksum, if known"""
+        if not checksum:
+            return True
+        digest = hashlib.sha256()
+        with open(fname, 'rb') as lfile:
+            for data in iter(lambda: lfile.read(1 << 20), b''):
+                digest.update(data)
+        if digest.hexdigest() != checksum:
+            self.log_error(f"Checksum mismatch for {fname}, expected "
+                           f"{checksum} but got {digest.hexdigest()}")
+            return False
+        return True
+
+    def _retrieve_file_chunked(self, fname, dest, size, chunk_size,
+                               checksum=None):
+        """Copy a remote file in chunks of chunk_size. The sha256 checksum
+        of each chunk is computed on the remote node first, and each chunk
+        received is verified against it. Chunks that fail to transfer or
+        verify are fetched again, up to 5 attempts, while chunks that were
+        already received are kept. Chunks are fetched by as many concurrent
+        jobs as set by --transfer-jobs.
+
+        :returns:   True if the file was copied, False if not, or None if the
+                    checksums of the chunks could not be determined and the
+                    file should be copied whole instead
+        :rtype:     ``bool`` or ``None``
+        """
+        checksums = self._get_chunk_checksums(fname, size, chunk_size)
+        if not checksums:
+            self.log_info(f"Unable to checksum chunks of {fname}, copying "
+                          "the whole file instead")
+            return None
+        received = set()
+        fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+        def _fetch(chunk):
+            try:
+                data = self._retrieve_range(fname, chunk * chunk_size,
+                                            chunk_size)
+            except Exception as err:
+                self.log_debug(f"Failed to retrieve chunk {chunk} of "
+                               f"{fname}: {err}")
+                return False
+            if data is None or \
+                    hashlib.sha256(data).hexdigest() != checksums[chunk]:
+                self.log_debug(f"Chunk {chunk} of {fname} failed to verify")
+                return False
+            os.pwrite(fd, data, chunk * chunk_size)
+            return True
+
+        try:
+            for attempt in range(1, 6):
+                missing = [c for c in range(len(checksums))
+                           if c not in received]
+                if attempt > 1:
+                    self.log_info(f"Resuming retrieval of {fname} at offset "
+                                  f"{missing[0] * chunk_size}, "
+                                  f"{len(missing)} chunks remaining")
+                with ThreadPoolExecutor(self.opts.transfer_jobs) as pool:
+                    for chunk, ok in zip(missing, pool.map(_fetch, missing)):
+                        if ok:
+                            received.add(chunk)
+                if len(received) < len(checksums):
+                    self.log_info(f"File retrieval attempt {attempt} failed")
+                    continue
+                os.fsync(fd)
+                if self._verify_file(dest, checksum):
+                    return True
+                # every chunk matched, so either the file changed while it was
+                # copied, in which case only the changed chunks are fetched
+                # again, or the checksum we were given does not match it
+                _checksums = self._get_chunk_checksums(fname, size,
+                                                       chunk_size)
+                if not _checksums or _checksums == checksums:
+                    return False
+                received = set(c for c in received
+                               if _checksums[c] == checksums[c])
+                checksums = _checksums
+            self.log_info("File retrieval failed after 5 attempts")
+            return False
+        finally:
+            os.close(fd)
+
+    def _throttle(self, nbytes):
+        """Account for nbytes received, waiting for as long as the rate limit
+        of the current transfer requires, if there is one. Implementations of
+        `_retrieve_range()` call this as they receive data.
+        """
+        if self.limiter is not None:
+            self.limiter.consume(nbytes)
+
+    def get_file_size(self, fname):
+        """Get the size of a remote file
+
+        :param fname:   The name of the file
+        :type fname:    ``str``
+
+        :returns:   The size in bytes, or None if it could not be determined
+        :rtype:     ``int``
+        """
+        size = self._get_file_size(fname)
+        if size is None:
+            self.log_debug(f"Unable to determine size of {fname}")
+        return size
+
+    def _get_file_size(self, fname):
+        """Get the size of a remote file
+
+        :returns:   The size in bytes, or None if it could not be determined
+        :rtype:     ``int``
+        """
+        res = self.run_command(f"stat -c %s {quote(fname)}", timeout=10)
+        try:
+            return int(res['output'].strip()) if res['status'] == 0 else None
+        except ValueError:
+            return None
+
+    def _get_chunk_checksums(self, fname, size, chunk_size):
+        """Compute the sha256 checksum of each chunk of a remote file, on the
+        remote node
+
+        :returns:   The checksums of the chunks in order, or None on failure
+        :rtype:     ``list``
+        """
+        count = -(-size // chunk_size)
+        cmd = (f"i=0; while [ $i -lt {count} ]; do dd if={quote(fname)} "
+               f"bs={chunk_size} skip=$i count=1 2>/dev/null | sha256sum; "
+               "i=$((i+1)); done")
+        # allow for hashing at no more than 10MiB/s
+        res = self.run_command(cmd, timeout=180 + size // (10 * 1024**2),
+                               use_shell=True)
+        if res['status'] != 0:
+            return None
+        checksums = re.findall(r'^([0-9a-f]{64})\b', res['output'], re.M)
+        return checksums if len(checksums) == count else None
+
+    def _retrieve_range(self, fname, offset, length):
+        """Read length bytes at offset of a remote file. Offsets are always a
+        multiple of length.
+
+        Transports that cannot pass binary data through the command defined
+        by `remote_exec` should override this, and pass the amount of data
+        received to `_throttle()`.
+
+        :returns:   The data read
+        :rtype:     ``bytes``
+        """
+        cmd = self._format_cmd_for_exec(
+            f"dd if={quote(fname)} bs={length} skip={offset // length} "
+            "count=1"
+        )
+        timeout = 180 + length // (1024**2)
+        if self.limiter is not None and self.limiter.rate:
+            timeout += length // self.limiter.rate
+        proc = subprocess.Popen(split(cmd), stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+        watchdog = Timer(timeout, proc.kill)
+        watchdog.start()
+        data = []
+        try:
+            # read in blocks, so that the rate of the transfer can be limited
+            # while the chunk is received
+            while True:
+                block = proc.stdout.read1(RemoteFileStream.chunk_size)
+                if not block:
+                    break
+                data.append(block)
+                self._throttle(len(block))
+        finally:
+            watchdog.cancel()
+            proc.stdout.close()
+        return b''.join(data) if proc.wait() == 0 else None
+
     def _retrieve_file(self, fname, dest):
         raise NotImplementedError(
             f"Transport {self.name} does not support file copying")
 
+    def stream_file(self, fname, dest, hash_name='sha256'):
+        """Start copying a remote file, fname, to dest on the local node in
+        the background. This is intended for a FIFO that is still being
+        written to on the remote node, so that the file is received while it
+        is being produced. The checksum of the file is computed as it is
+        received.
+
+        :param fname:       The name of the file to stream
+        :type fname:        ``str``
+
+        :param dest:        Where to save the file to locally
+        :type dest:         ``str``
+
+        :param hash_name:   The hashlib algorithm of the checksum to compute
+        :type hash_name:    ``str``
+
+        :returns:   The stream, used to wait for the copy to finish
+        :rtype:     ``RemoteFileStream``
+        """
+        self.log_debug(f"Streaming remote {fname} to local {dest}")
+        return RemoteFileStream(self._stream_file(fname), dest, hash_name,
+                                limiter=self.limiter)
+
+    def _stream_file(self, fname):
+        """Start a local process that writes the content of the remote file
+        fname to its stdout. Transports that set `supports_streaming` may
+        override this if `cat` via `remote_exec` is not suitable for them.
+
+        :returns:   The process reading the file
+        :rtype:     ``subprocess.Popen``
+        """
+        cmd = self._format_cmd_for_exec(f"cat {quote(fname)}")
+        return subprocess.Popen(split(cmd), stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+
     def read_file(self, fname):
         """Read the given file fname and return its contents
 
@@ -407,4 +654,82 @@ class RemoteTransport():
                                f"{res['output'].split(':')[1:]}")
             return ''
 
+
+class RemoteFileStream():
+    """Receives the output of a process that reads a remote file, see
+    `RemoteTransport.stream_file()`, into a local file in a background thread,
+    computing the checksum of the file as it is received.
+
+    :param proc:        The process reading the remote file
+    :type proc:         ``subprocess.Popen``
+
+    :param dest:        Where to save the file to locally
+    :type dest:         ``str``
+
+    :param hash_name:   The hashlib algorithm of the checksum to compute
+    :type hash_name:    ``str``
+
+    :param limiter:     The Transfer to limit the rate of the stream by
+    :type limiter:      ``Transfer``
+    """
+
+    #: The maximum amount of data read from the process at once
+    chunk_size = 1 << 20
+
+    def __init__(self, proc, dest, hash_name='sha256', limiter=None):
+        self.proc = proc
+        self.dest = dest
+        self.limiter = limiter
+        self.digest = hashlib.new(hash_name)
+        self.size = 0
+        self.error = None
+        self._thread = Thread(target=self._receive, daemon=True,
+                              name=f"sos-stream-{proc.pid}")
+        self._thread.start()
+
+    def _receive(self):
+        try:
+            with open(self.dest, 'wb') as out:
+                while True:
+                    chunk = self.proc.stdout.read1(self.chunk_size)
+                    if not chunk:
+                        break
+                    self.digest.update(chunk)
+                    out.write(chunk)
+                    self.size += len(chunk)
+                    if self.limiter is not None:
+                        self.limiter.consume(len(chunk))
+        except Exception as err:
+            self.error = err
+        finally:
+            self.proc.stdout.close()
+
+    def wait(self, timeout=None):
+        """Wait for the whole file to be received, or cancel the stream if
+        that takes longer than timeout
+
+        :param timeout: How long to wait in seconds, or ``None`` to wait until
+                        the file is received
+        :type timeout:  ``int``
+
+        :returns:   True if the whole file was received, else False
+        :rtype:     ``bool``
+        """
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self.cancel()
+            return False
+        return self.proc.wait() == 0 and self.error is None
+
+    def cancel(self):
+        """Stop receiving the file, e.g. because nothing will write to it"""
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        self.proc.wait()
+        self._thread.join()
+
+    def hexdigest(self):
+        """Get the checksum of the data received so far"""
+        return self.digest.hexdigest()
+
 # vim: set et ts=4 sw=4 :
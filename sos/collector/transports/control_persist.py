@@ -41,6 +41,7 @@ class SSHControlPersist(RemoteTransport):
     """
 
     name = 'control_persist'
+    supports_streaming = True
 
     def _check_for_control_persist(self):
         """Checks to see if the local system supported SSH ControlPersist.
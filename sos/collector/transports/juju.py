@@ -72,6 +72,10 @@ class JujuSSH(RemoteTransport):
         option = f"{model_option} {target_option}"
         return f"juju ssh {option}"
 
+    def _get_chunk_checksums(self, fname, size, chunk_size):
+        self._chmod(fname)  # reading chunks needs the file to be readable
+        return super()._get_chunk_checksums(fname, size, chunk_size)
+
     def _retrieve_file(self, fname, dest):
         self._chmod(fname)  # juju scp needs the archive to be world-readable
         model, unit = self.address.split(":")
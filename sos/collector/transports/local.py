@@ -22,6 +22,10 @@ class LocalTransport(RemoteTransport):
     """
 
     name = 'local_node'
+    supports_streaming = True
+    # copying a local file cannot fail part way the way a network transfer
+    # can, so it is not worth checksumming it in chunks
+    max_chunk_size = 0
 
     def _connect(self, password):
         return True
@@ -38,6 +42,19 @@ class LocalTransport(RemoteTransport):
         shutil.copy(fname, dest)
         return True
 
+    def _get_file_size(self, fname):
+        try:
+            return os.stat(fname).st_size
+        except OSError:
+            return None
+
+    def _retrieve_range(self, fname, offset, length):
+        with open(fname, 'rb') as rfile:
+            rfile.seek(offset)
+            data = rfile.read(length)
+        self._throttle(len(data))
+        return data
+
     def _format_cmd_for_exec(self, cmd):
         return cmd
 
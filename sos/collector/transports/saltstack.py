@@ -8,10 +8,13 @@
 #
 # See the LICENSE file in the source distribution for further information.
 
+import base64
+import binascii
 import contextlib
 import json
 import os
 import shutil
+from shlex import quote
 from sos.collector.transports import RemoteTransport
 from sos.collector.exceptions import (ConnectionException,
                                       SaltStackMasterUnsupportedException)
@@ -29,6 +32,8 @@ class SaltStackMaster(RemoteTransport):
     """
 
     name = 'saltstack'
+    # chunks are passed base64 encoded through salt's JSON output
+    max_chunk_size = 8 * 1024**2
 
     def _convert_output_json(self, json_output):
         return list(json.loads(json_output).values())[0]
@@ -135,4 +140,22 @@ class SaltStackMaster(RemoteTransport):
             else False
         )
 
+    def _retrieve_range(self, fname, offset, length):
+        """Read a range of a file on the minion. cmd.shell only returns text,
+        so the data is base64 encoded on the minion.
+        """
+        res = self.run_command(
+            f"dd if={quote(fname)} bs={length} skip={offset // length} "
+            "count=1 2>/dev/null | base64 -w0",
+            timeout=180 + length // (1024**2), use_shell=True
+        )
+        if res['status'] != 0:
+            return None
+        try:
+            data = base64.b64decode(res['output'].strip(), validate=True)
+        except (binascii.Error, ValueError):
+            return None
+        self._throttle(len(data))
+        return data
+
 # vim: set et ts=4 sw=4 :
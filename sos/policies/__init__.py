@@ -406,7 +406,7 @@ any third party.
             )
 
     def display_results(self, archive, directory, checksum, archivestat=None,
-                        map_file=None):
+                        map_file=None, stream=None):
         """Display final information about a generated archive
 
         :param archive: The name of the archive that was generated
@@ -424,6 +424,10 @@ any third party.
         :param map_file: If sos clean was invoked, the location of the mapping
                          file for this run
         :type map_file: ``str``
+
+        :param stream: If the archive was written to a FIFO or file instead of
+                       being saved, the stream it was written to
+        :type stream: ``sos.archive.ArchiveStream``
         """
         # Logging is shut down, but there are some edge cases where automation
         # does not capture printed output (e.g. avocado CI). Use the ui_log to
@@ -439,7 +443,15 @@ any third party.
                   f"\n\t{map_file}")
             )
 
-        if archive:
+        if archive and stream:
+            self.ui_log.info(
+                _(f"\nYour sosreport has been generated and written to "
+                  f"{stream.path} as:\n\t{archive}\n")
+            )
+            self.ui_log.info(
+                _(f" Size\t{get_human_readable(stream.size)}")
+            )
+        elif archive:
             self.ui_log.info(
                 _(f"\nYour sosreport has been generated and saved in:"
                   f"\n\t{archive}\n")
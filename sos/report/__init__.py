@@ -19,6 +19,7 @@ import hashlib
 import pdb
 from datetime import datetime
 import glob
+import threading
 
 from shutil import rmtree
 from concurrent.futures import ThreadPoolExecutor, TimeoutError
@@ -27,6 +28,7 @@ import sos.report.plugins
 from sos.utilities import (ImporterHelper, SoSTimeoutError, bold,
                            sos_get_command_output, TIMEOUT_DEFAULT, listdir,
                            is_executable)
+from sos.report.scheduler import PluginScheduler
 
 from sos import _sos as _
 from sos import __version__
@@ -86,6 +88,8 @@ class SoSReport(SoSComponent):
         'case_id': '',
         'chroot': 'auto',
         'clean': False,
+        'cmd_output': 'stream',
+        'cmd_threads': 0,
         'container_runtime': 'auto',
         'keep_binary_files': False,
         'desc': '',
@@ -118,10 +122,13 @@ class SoSReport(SoSComponent):
         'note': '',
         'only_plugins': [],
         'preset': 'auto',
+        'pipelined_archive': False,
+        'plugin_order': 'runtime',
         'plugin_timeout': TIMEOUT_DEFAULT,
         'cmd_timeout': TIMEOUT_DEFAULT,
         'profiles': [],
         'since': None,
+        'stream_to': None,
         'verify': False,
         'allow_system_changes': False,
         'usernames': [],
@@ -152,6 +159,8 @@ class SoSReport(SoSComponent):
         self._args = args
         self.sysroot = "/"
         self.estimated_plugsizes = {}
+        self.archive_pipeline = False
+        self.pipelined_plugins = set()
 
         self.print_header()
         self._set_debug()
@@ -178,6 +187,7 @@ class SoSReport(SoSComponent):
             self.tempfile_util.clean()
             self._exit(1)
 
+        self._set_cmd_budget()
         self._check_container_runtime()
         self._get_namespaces()
         self._get_hardware_devices()
@@ -210,6 +220,17 @@ class SoSReport(SoSComponent):
                                 dest="chroot", default='auto',
                                 help="chroot executed commands to SYSROOT "
                                      "[auto, always, never] (default=auto)")
+        report_grp.add_argument("--cmd-output", default='stream',
+                                dest="cmd_output",
+                                choices=['stream', 'memory'],
+                                help="stream command output directly into "
+                                     "the archive, or hold it in memory "
+                                     "first (default=stream)")
+        report_grp.add_argument("--cmd-threads", default=0, type=int,
+                                dest="cmd_threads",
+                                help="maximum number of commands that plugins "
+                                     "supporting it may run concurrently, "
+                                     "0 for the number of CPUs")
         report_grp.add_argument("--container-runtime", default="auto",
                                 help="Default container runtime to use for "
                                      "collections. 'auto' for policy control.")
@@ -281,6 +302,15 @@ class SoSReport(SoSComponent):
                                 help="enable these plugins only", default=[])
         report_grp.add_argument("--preset", action="store", type=str,
                                 help="A preset identifier", default="auto")
+        report_grp.add_argument("--pipelined-archive", action="store_true",
+                                dest="pipelined_archive", default=False,
+                                help="add the output of each plugin to the "
+                                     "compressed archive as soon as the "
+                                     "plugin finishes")
+        report_grp.add_argument("--plugin-order", default='runtime',
+                                choices=['runtime', 'name'],
+                                help="Order in which plugins are run: longest "
+                                     "expected run time first, or by name")
         report_grp.add_argument("--plugin-timeout", default=None,
                                 help="set a timeout for all plugins")
         report_grp.add_argument("--cmd-timeout", default=None,
@@ -296,6 +326,11 @@ class SoSReport(SoSComponent):
         report_grp.add_argument('--skip-files', default=[], action='extend',
                                 dest='skip_files',
                                 help="do not collect these files")
+        report_grp.add_argument("--stream-to", default=None, dest="stream_to",
+                                metavar="PATH",
+                                help="write the compressed archive to this "
+                                     "FIFO or file instead of keeping it in "
+                                     "the temporary directory")
         report_grp.add_argument("--verify", action="store_true",
                                 dest="verify", default=False,
                                 help="perform data verification during "
@@ -457,6 +492,15 @@ class SoSReport(SoSComponent):
             'fstype': self._get_devices_by_fstype()
         }
 
+    def _set_cmd_budget(self):
+        """Setup the budget of concurrently running commands that is shared
+        by all plugins which run their queued commands in parallel.
+        """
+        self.cmd_threads = self.opts.cmd_threads or os.cpu_count() or 1
+        self.cmd_budget = threading.BoundedSemaphore(self.cmd_threads)
+        self.soslog.debug(f"set command concurrency budget to "
+                          f"{self.cmd_threads}")
+
     def _check_container_runtime(self):
         """Check the loaded container runtimes, and the policy default runtime
         (if set), against any requested --container-runtime value. This can be
@@ -715,7 +759,9 @@ class SoSReport(SoSComponent):
             'verbosity': self.opts.verbosity,
             'cmdlineopts': self.opts,
             'devices': self.devices,
-            'namespaces': self.namespaces
+            'namespaces': self.namespaces,
+            'cmd_threads': self.cmd_threads,
+            'cmd_budget': self.cmd_budget
         }
 
     def get_temp_file(self):
@@ -1218,6 +1264,7 @@ class SoSReport(SoSComponent):
             self.ui_log.info(_(" Setting up archive ..."))
             self.setup_archive()
             self._make_archive_paths()
+            self._setup_archive_stream()
             return
         except (OSError, IOError) as e:
             # we must not use the logging subsystem here as it is potentially
@@ -1247,6 +1294,9 @@ class SoSReport(SoSComponent):
                 start = datetime.now()
                 plug.manifest.add_field('setup_start', start)
                 plug.archive = self.archive
+                if plug.get_option('postproc'):
+                    # apply all substitutions in one pass after postproc()
+                    plug.batch_file_subs()
                 plug.add_default_collections()
                 plug.setup()
                 self.env_vars.update(plug._env_vars)
@@ -1288,6 +1338,16 @@ class SoSReport(SoSComponent):
         for i in self.loaded_plugins:
             plugruncount += 1
             self.pluglist.append((plugruncount, i[0]))
+        scheduler = PluginScheduler()
+        if self.opts.plugin_order == 'runtime':
+            self.pluglist = scheduler.order(self.pluglist,
+                                            self.loaded_plugins)
+            self.soslog.debug(
+                "Running plugins in order: "
+                f"{' '.join(p[1] for p in self.pluglist)}"
+            )
+        self.plugin_scheduler = scheduler
+        self._start_archive_pipeline()
         try:
             results = []
             with ThreadPoolExecutor(self.opts.threads) as executor:
@@ -1296,6 +1356,9 @@ class SoSReport(SoSComponent):
             for res in results:
                 if not res:
                     self.soslog.debug(f"Unexpected plugin task result: {res}")
+            # run times from dry runs or estimates are not representative
+            if not (self.opts.dry_run or self.opts.estimate_only):
+                scheduler.write_history()
             self.ui_log.info("")
         except KeyboardInterrupt:
             # We may not be at a newline when the user issues Ctrl-C
@@ -1318,6 +1381,9 @@ class SoSReport(SoSComponent):
                 end = datetime.now()
                 _plug.manifest.add_field('end_time', end)
                 _plug.manifest.add_field('run_time', end - start)
+                self.plugin_scheduler.record(plugin[1],
+                                             (end - start).total_seconds())
+                self._pipeline_plugin(plugin[1], _plug)
             except TimeoutError:
                 msg = f"Plugin {plugin[1]} timed out"
                 # log to ui_log.error to show the user, log to soslog.info
@@ -1327,6 +1393,7 @@ class SoSReport(SoSComponent):
                 self.soslog.info(msg)
                 self.running_plugs.remove(plugin[1])
                 self.loaded_plugins[plugin[0]-1][1].set_timeout_hit()
+                self.plugin_scheduler.record(plugin[1], timeout)
                 pool.shutdown(wait=True)
                 pool._threads.clear()
         if self.opts.estimate_only:
@@ -1479,24 +1546,126 @@ class SoSReport(SoSComponent):
                     self.ui_log.error("")
                     self._exit(1)
 
+    def _postproc_plugin(self, plugname, plug):
+        try:
+            if plug.get_option('postproc'):
+                try:
+                    plug.postproc()
+                finally:
+                    # scrub what was queued even if postproc() failed
+                    plug.apply_file_subs()
+            else:
+                self.soslog.info(
+                    f"Skipping postproc for plugin {plugname}")
+        except (OSError, IOError) as e:
+            if e.errno in fatal_fs_errors:
+                self.ui_log.error("")
+                self.ui_log.error(
+                    f" {e.strerror} while post-processing plugin data")
+                self.ui_log.error("")
+                self._exit(1)
+            self.handle_exception(plugname, "postproc")
+        except Exception:
+            self.handle_exception(plugname, "postproc")
+
     def postproc(self):
         for plugname, plug in self.loaded_plugins:
-            try:
-                if plug.get_option('postproc'):
-                    plug.postproc()
-                else:
-                    self.soslog.info(
-                        f"Skipping postproc for plugin {plugname}")
-            except (OSError, IOError) as e:
-                if e.errno in fatal_fs_errors:
-                    self.ui_log.error("")
-                    self.ui_log.error(
-                        f" {e.strerror} while post-processing plugin data")
-                    self.ui_log.error("")
-                    self._exit(1)
-                self.handle_exception(plugname, "postproc")
-            except Exception:
-                self.handle_exception(plugname, "postproc")
+            # already done while building a pipelined archive
+            if plugname in self.pipelined_plugins:
+                continue
+            self._postproc_plugin(plugname, plug)
+
+    def _start_archive_pipeline(self):
+        """If requested, start building the compressed archive while plugins
+        are still running, see `_pipeline_plugin()`.
+        """
+        if not self.opts.pipelined_archive:
+            return
+        for opt, reason in [('build', '--build'), ('clean', '--clean'),
+                            ('dry_run', '--dry-run'),
+                            ('estimate_only', '--estimate-only')]:
+            if getattr(self.opts, opt):
+                self.soslog.info(f"Not building a pipelined archive with "
+                                 f"{reason}")
+                return
+        if not hasattr(self.archive, 'start_pipeline'):
+            self.soslog.info("Archive type does not support pipelining")
+            return
+        # files that more than one plugin may collect may be rewritten by the
+        # postproc() of a plugin that finishes later, so note which plugins
+        # will collect each path
+        self._copy_path_owners = {}
+        for plugname, plug in self.loaded_plugins:
+            _paths = list(plug.copy_paths)
+            _paths.extend(_tail[0] for _tail in plug._tail_files_list)
+            for path in _paths:
+                self._copy_path_owners.setdefault(path, set()).add(plugname)
+        self.archive.start_pipeline(self.opts.compression_type)
+        self.archive_pipeline = True
+
+    def _setup_archive_stream(self):
+        """If requested, write the compressed archive to a FIFO or file
+        instead of to the temporary directory, see `--stream-to`
+        """
+        if not self.opts.stream_to:
+            return
+        reasons = [reason for opt, reason in [
+            ('build', '--build'), ('estimate_only', '--estimate-only'),
+            ('upload', '--upload'), ('upload_url', '--upload-url'),
+            ('upload_s3_endpoint', '--upload-s3-endpoint')
+        ] if getattr(self.opts, opt)]
+        if self.archive.enc_opts['encrypt']:
+            reasons.append('encryption')
+        if reasons:
+            self.ui_log.warning(f"Not streaming the archive with "
+                                f"{', '.join(reasons)}")
+            return
+        if not hasattr(self.archive, 'stream_to'):
+            self.soslog.info("Archive type does not support streaming")
+            return
+        self.archive.stream_to(self.opts.stream_to,
+                               self.policy.get_preferred_hash_name())
+
+    def _is_shared_path(self, path, plugname):
+        """Check if the given path, or any of its parent directories, is
+        collected by a plugin other than `plugname`
+        """
+        while True:
+            owners = self._copy_path_owners.get(path)
+            if owners and owners - {plugname}:
+                return True
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
+
+    def _pipeline_plugin(self, plugname, plug):
+        """When building a pipelined archive, run postproc for a plugin that
+        finished collecting and add its output to the archive.
+
+        Files that other plugins may also collect, and so rewrite during their
+        own postproc, are left in place to be added when the archive is
+        finalized.
+        """
+        if not self.archive_pipeline:
+            return
+        if not self.opts.no_postproc:
+            self._postproc_plugin(plugname, plug)
+        self.pipelined_plugins.add(plugname)
+        paths = [
+            os.path.join(self.cmddir, plug.name()),
+            os.path.join('sos_strings', plug.name())
+        ]
+        deferred = 0
+        for _file in plug.copied_files:
+            if self._is_shared_path(_file['srcpath'], plugname):
+                deferred += 1
+                continue
+            paths.append(_file['dstpath'])
+        if deferred:
+            self.soslog.debug(f"Deferring {deferred} files collected by "
+                              f"{plugname} until the archive is finalized")
+        self.archive.append_paths(paths)
 
     def _create_checksum(self, archive, hash_name):
         if not archive:
@@ -1650,6 +1819,20 @@ class SoSReport(SoSComponent):
             # skip generating checksum
             if not archive:
                 print("Creating archive tarball failed.")
+            elif self.archive.stream is not None:
+                stream = self.archive.stream
+                if not stream.complete:
+                    print(_(f"Error writing archive to {stream.path}"))
+                    return False
+                # there is no file, only the name the archive would have had
+                base_archive = os.path.basename(archive)
+                if do_clean:
+                    base_archive = cleaner.obfuscate_string(
+                            base_archive.replace('.tar', '-obfuscated.tar')
+                    )
+                self.policy.display_results(base_archive, directory,
+                                            stream.hexdigest(),
+                                            map_file=map_file, stream=stream)
             else:
                 try:
                     # compute and store the archive checksum
@@ -22,16 +22,18 @@ import logging
 import fnmatch
 import errno
 import textwrap
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from sos.utilities import (sos_get_command_output, import_module, grep,
-                           fileobj, tail, is_executable, TIMEOUT_DEFAULT,
+                           fileobj, is_executable, TIMEOUT_DEFAULT,
                            path_exists, path_isdir, path_isfile, path_islink,
                            listdir, path_join, bold, file_is_binary,
                            recursive_dict_values_by_key)
 
-from sos.archive import P_FILE, P_LINK
+from sos.archive import P_FILE, P_LINK, compile_sub_regex
 
 
 def regex_findall(regex, fname):
@@ -522,6 +524,12 @@ class Plugin():
 
     :cvar cmd_timeout:  Timeout in seconds for individual commands
     :vartype cmd_timeout:   ``int``
+
+    :cvar cmd_workers:  Maximum number of queued commands this plugin may run
+                        concurrently. Plugins that queue many short, read-only
+                        commands may raise this to opt in to parallel command
+                        execution
+    :vartype cmd_workers:   ``int``
     """
 
     plugin_name = None
@@ -537,6 +545,7 @@ class Plugin():
     sysroot = '/'
     plugin_timeout = TIMEOUT_DEFAULT
     cmd_timeout = TIMEOUT_DEFAULT
+    cmd_workers = 1
     _timeout_hit = False
     cmdtags = {}
     filetags = {}
@@ -569,6 +578,8 @@ class Plugin():
         self.skip_commands = commons['cmdlineopts'].skip_commands
         self.default_environment = {}
         self._tail_files_list = []
+        self._cmd_local = threading.local()
+        self._queued_subs = None
 
         self.soslog = self.commons['soslog'] if 'soslog' in self.commons \
             else logging.getLogger('sos')
@@ -597,6 +608,11 @@ class Plugin():
             'postproc': PluginOpt(
                 'postproc', default=True, val_type=bool,
                 desc='Enable post-processing of collected data'
+            ),
+            'cmd-output': PluginOpt(
+                'cmd-output', default='', val_type=str,
+                desc=('Write command output to the archive via a stream or '
+                      'from memory')
             )
         }
 
@@ -733,6 +749,17 @@ class Plugin():
                                                 self.cmd_timeout)
         return _cmdtimeout
 
+    @property
+    def stream_cmd_output(self):
+        """Returns True if command output should be streamed directly into
+        the archive, based on the value provided on the commandline via
+        -k plugin.cmd-output=value, or the value of the global --cmd-output
+        option.
+        """
+        _mode = (self.get_option('cmd-output') or
+                 getattr(self.commons['cmdlineopts'], 'cmd_output', 'stream'))
+        return _mode == 'stream'
+
     def set_timeout_hit(self):
         self._timeout_hit = True
         self.manifest.add_field('end_time', datetime.now())
@@ -1165,7 +1192,7 @@ class Plugin():
         :returns: Number of replacements made
         :rtype: ``int``
         """
-        if not self.executed_commands:
+        if not self.executed_commands and self._queued_subs is None:
             return 0
 
         self._log_debug(
@@ -1203,33 +1230,11 @@ class Plugin():
             f"substituting '{subst}' for '{pattern}' in commands matching "
             f"'{globstr}'")
 
-        if not self.executed_commands:
+        if not self.executed_commands and self._queued_subs is None:
             return 0
 
-        replacements = None
-        try:
-            for called in self.executed_commands:
-                # was anything collected?
-                if called['file'] is None:
-                    continue
-                if called['binary'] == 'yes':
-                    self._log_warn("Cannot apply regex substitution to binary"
-                                   f" output: '{called['exe']}'")
-                    continue
-                if fnmatch.fnmatch(called['cmd'], globstr):
-                    path = os.path.join(self.commons['cmddir'], called['file'])
-                    self._log_debug(f"applying substitution to '{path}'")
-                    readable = self.archive.open_file(path)
-                    result, replacements = re.subn(
-                        regexp, subst, readable.read())
-                    if replacements:
-                        self.archive.add_string(result, path)
-
-        except Exception as e:
-            msg = "regex substitution failed for '%s' with: '%s'"
-            self._log_error(msg % (called['exe'], e))
-            replacements = None
-        return replacements
+        return self._add_file_sub('cmd', globstr,
+                                  compile_sub_regex(regexp, 0), subst)
 
     def do_file_private_sub(self, pathregex, desc=""):
         """Scrub certificate/key/etc information from files collected by sos.
@@ -1274,26 +1279,12 @@ class Plugin():
         :returns: Number of replacements made
         :rtype: ``int``
         """
-        try:
-            path = self._get_dest_for_srcpath(srcpath)
-            self._log_debug(f"substituting scrpath '{srcpath}'")
-            self._log_debug(f"substituting '{subst}' for '%s' in '{path}'"
-                            % regexp.pattern if hasattr(regexp, "pattern")
-                            else regexp)
-            if not path:
-                return 0
-            replacements = self.archive.do_file_sub(path, regexp, subst)
-        except (OSError, IOError) as e:
-            # if trying to regexp a nonexisting file, dont log it as an
-            # error to stdout
-            if e.errno == errno.ENOENT:
-                msg = "file '%s' not collected, substitution skipped"
-                self._log_debug(msg % path)
-            else:
-                msg = "regex substitution failed for '%s' with: '%s'"
-                self._log_error(msg % (path, e))
-            replacements = 0
-        return replacements
+        self._log_debug(f"substituting scrpath '{srcpath}'")
+        self._log_debug(f"substituting '{subst}' for '%s'"
+                        % regexp.pattern if hasattr(regexp, "pattern")
+                        else regexp)
+        return self._add_file_sub('file', srcpath, compile_sub_regex(regexp),
+                                  subst)
 
     def do_path_regex_sub(self, pathexp, regexp, subst):
         """Apply a regexp substituation to a set of files archived by
@@ -1311,10 +1302,111 @@ class Plugin():
         """
         if not hasattr(pathexp, "match"):
             pathexp = re.compile(pathexp)
-        match = pathexp.match
-        file_list = [f for f in self.copied_files if match(f['srcpath'])]
-        for file in file_list:
-            self.do_file_sub(file['srcpath'], regexp, subst)
+        self._log_debug(f"substituting '{subst}' in files matching "
+                        f"'{pathexp.pattern}'")
+        return self._add_file_sub('path', pathexp.match,
+                                  compile_sub_regex(regexp), subst)
+
+    def batch_file_subs(self):
+        """Start queueing the substitutions requested via `do_file_sub()`,
+        `do_path_regex_sub()`, `do_cmd_output_sub()` and their private
+        variants instead of applying them immediately. Queued substitutions
+        are applied by `apply_file_subs()`, which sos calls once the plugin's
+        `postproc()` has run, so that every affected file is read and
+        written only once however many substitutions apply to it.
+
+        While batching, the substitution methods return 0 as the number of
+        replacements is not known until the substitutions are applied.
+        """
+        if self._queued_subs is None:
+            self._queued_subs = []
+
+    def apply_file_subs(self):
+        """Apply all substitutions queued since `batch_file_subs()` was
+        called and stop batching.
+
+        :returns: Number of replacements made
+        :rtype: ``int``
+        """
+        subs, self._queued_subs = self._queued_subs, None
+        if not subs:
+            return 0
+        return self._apply_file_subs(subs)
+
+    def _add_file_sub(self, kind, target, regexp, subst):
+        """Queue a substitution if batching, otherwise apply it right away.
+        See `_get_file_sub_paths()` for the meaning of `kind` and `target`.
+        """
+        sub = (kind, target, regexp, subst)
+        if self._queued_subs is not None:
+            self._queued_subs.append(sub)
+            return 0
+        return self._apply_file_subs([sub])
+
+    def _get_file_sub_paths(self, kind, target):
+        """Resolve the archive paths a substitution applies to. Paths are
+        resolved when the substitution is applied, so a substitution may be
+        queued before the files it applies to have been collected.
+
+        :param kind:    'file' for a single source path, 'path' for a match
+                        callable for source paths, or 'cmd' for a glob of
+                        command names
+        :type kind: ``str``
+
+        :param target:  The source path, match callable or glob
+        :type target: ``str`` or callable
+        """
+        paths = []
+        if kind == 'cmd':
+            for called in self.executed_commands:
+                # was anything collected?
+                if called['file'] is None:
+                    continue
+                if not fnmatch.fnmatch(called['cmd'], target):
+                    continue
+                if called['binary'] == 'yes':
+                    self._log_warn("Cannot apply regex substitution to binary"
+                                   f" output: '{called['exe']}'")
+                    continue
+                paths.append(
+                    os.path.join(self.commons['cmddir'], called['file'])
+                )
+        elif kind == 'path':
+            for copied in self.copied_files:
+                if target(copied['srcpath']):
+                    paths.append(self._get_dest_for_srcpath(copied['srcpath']))
+        else:
+            paths.append(self._get_dest_for_srcpath(target))
+        return [path for path in dict.fromkeys(paths) if path]
+
+    def _apply_file_subs(self, subs):
+        """Apply the given substitutions, grouped by the archive path they
+        apply to so that each file is processed in a single pass.
+        """
+        path_subs = {}
+        for kind, target, regexp, subst in subs:
+            for path in self._get_file_sub_paths(kind, target):
+                path_subs.setdefault(path, []).append((regexp, subst))
+
+        replacements = 0
+        for path, _subs in path_subs.items():
+            self._log_debug(f"applying {len(_subs)} substitution(s) to "
+                            f"'{path}'")
+            try:
+                replacements += self.archive.do_file_subs(path, _subs)
+            except (OSError, IOError) as e:
+                # if trying to regexp a nonexisting file, dont log it as an
+                # error to stdout
+                if e.errno == errno.ENOENT:
+                    msg = "file '%s' not collected, substitution skipped"
+                    self._log_debug(msg % path)
+                else:
+                    msg = "regex substitution failed for '%s' with: '%s'"
+                    self._log_error(msg % (path, e))
+            except Exception as e:
+                msg = "regex substitution failed for '%s' with: '%s'"
+                self._log_error(msg % (path, e))
+        return replacements
 
     def do_regex_find_all(self, regex, fname):
         return regex_findall(regex, fname)
@@ -2349,8 +2441,12 @@ class Plugin():
 
         outfn_strip = outfn[len(self.commons['cmddir'])+1:]
 
-        if to_file:
-            self._log_debug(f"collecting '{cmd}' output directly to disk")
+        # output that is not written by the command itself is streamed into
+        # the archive by sos, unless the plugin holds it in memory instead
+        stream = not to_file and self.stream_cmd_output
+        if to_file or stream:
+            if to_file:
+                self._log_debug(f"collecting '{cmd}' output directly to disk")
             self.archive.check_path(outfn, P_FILE)
             out_file = os.path.join(self.archive.get_archive_path(), outfn)
         else:
@@ -2362,7 +2458,8 @@ class Plugin():
             cmd, timeout=timeout, stderr=stderr, chroot=root,
             chdir=runat, env=_env, binary=binary, sizelimit=sizelimit,
             poller=self.check_timeout, foreground=foreground,
-            to_file=out_file, runas=runas
+            to_file=out_file if to_file else False,
+            stream=out_file if stream else False, runas=runas
         )
 
         end = time()
@@ -2371,7 +2468,7 @@ class Plugin():
         if result['status'] == 124:
             warn = f"command '{cmd}' timed out after {timeout}s"
             self._log_warn(warn)
-            if to_file:
+            if to_file or stream:
                 msg = (" - output up until the timeout may be available at "
                        f"{outfn}")
                 self._log_debug(f"{warn}{msg}")
@@ -2380,7 +2477,7 @@ class Plugin():
             'command': cmd.split(' ')[0],
             'parameters': cmd.split(' ')[1:],
             'exec': cmd,
-            'filepath': outfn if to_file else None,
+            'filepath': outfn if to_file or stream else None,
             'truncated': result['truncated'],
             'return_code': result['status'],
             'priority': priority,
@@ -2400,15 +2497,20 @@ class Plugin():
                     result = sos_get_command_output(
                         cmd, timeout=timeout, chroot=False, chdir=runat,
                         env=env, binary=binary, sizelimit=sizelimit,
-                        poller=self.check_timeout, to_file=out_file
+                        poller=self.check_timeout,
+                        to_file=out_file if to_file else False,
+                        stream=out_file if stream else False
                     )
                     run_time = time() - start
             self._log_debug(f"could not run '{cmd}': command not found")
             # Exit here if the command was not found in the chroot check above
             # as otherwise we will create a blank file in the archive
             if result['status'] in [126, 127]:
+                if stream and os.path.exists(out_file):
+                    os.unlink(out_file)
                 if self.manifest:
-                    self.manifest.commands.append(manifest_cmd)
+                    self._record_cmd_result(self.manifest.commands,
+                                            manifest_cmd)
                     return result
 
         self._log_debug(f"collected output of '{cmd.split()[0]}' in {run_time}"
@@ -2419,8 +2521,13 @@ class Plugin():
                            "truncated")
             linkfn = outfn
             outfn = outfn.replace('sos_commands', 'sos_strings') + '.tailed'
+            if stream:
+                # output was already tailed on disk, move it into place
+                self.archive.check_path(outfn, P_FILE)
+                os.rename(out_file, os.path.join(
+                    self.archive.get_archive_path(), outfn))
 
-        if not to_file:
+        if not (to_file or stream):
             if binary:
                 self.archive.add_binary(result['output'], outfn)
             else:
@@ -2438,8 +2545,11 @@ class Plugin():
             self.archive.add_link(outfn, root_symlink)
 
         # save info for later
-        self.executed_commands.append({'cmd': cmd, 'file': outfn_strip,
-                                       'binary': 'yes' if binary else 'no'})
+        self._record_cmd_result(self.executed_commands, {
+            'cmd': cmd,
+            'file': outfn_strip,
+            'binary': 'yes' if binary else 'no'
+        })
 
         result['filename'] = (
             os.path.join(self.archive.get_archive_path(), outfn) if outfn else
@@ -2449,7 +2559,7 @@ class Plugin():
         if self.manifest:
             manifest_cmd['filepath'] = outfn
             manifest_cmd['run_time'] = run_time
-            self.manifest.commands.append(manifest_cmd)
+            self._record_cmd_result(self.manifest.commands, manifest_cmd)
             if container_cmd:
                 self._add_container_cmd_to_manifest(manifest_cmd.copy(),
                                                     container_cmd)
@@ -2524,12 +2634,24 @@ class Plugin():
                 'filename': ''
             }
 
-        return self._collect_cmd_output(
+        result = self._collect_cmd_output(
             cmd, suggest_filename=suggest_filename, root_symlink=root_symlink,
             timeout=timeout, stderr=stderr, chroot=chroot, runat=runat,
             env=env, binary=binary, sizelimit=sizelimit, foreground=foreground,
             subdir=subdir, tags=tags, runas=runas
         )
+        if (result and self.stream_cmd_output and
+                os.path.isfile(result.get('filename', ''))):
+            # the output was streamed into the archive, so read it back for
+            # the caller
+            if binary:
+                with open(result['filename'], 'rb') as cfile:
+                    result['output'] = cfile.read()
+            else:
+                with open(result['filename'], 'r', encoding='utf-8',
+                          errors='ignore') as cfile:
+                    result['output'] = cfile.read()
+        return result
 
     def exec_cmd(self, cmd, timeout=None, stderr=True, chroot=True,
                  runat=None, env=None, binary=False, pred=None,
@@ -2649,8 +2771,10 @@ class Plugin():
         """
 
         cmd, container = contup
-        if container not in self.manifest.containers:
-            self.manifest.containers[container] = {'files': [], 'commands': []}
+        # this may run concurrently for several commands of the same container
+        con_manifest = self.manifest.containers.setdefault(
+            container, {'files': [], 'commands': []}
+        )
         manifest['exec'] = cmd
         manifest['command'] = cmd.split(' ')[0]
         manifest['parameters'] = cmd.split(' ')[1:]
@@ -2667,7 +2791,7 @@ class Plugin():
             os.symlink(_outloc, self.archive.dest_path(conlnk))
 
         manifest['filepath'] = conlnk
-        self.manifest.containers[container]['commands'].append(manifest)
+        self._record_cmd_result(con_manifest['commands'], manifest)
 
     def _get_container_runtime(self, runtime=None):
         """Based on policy and request by the plugin, return a usable
@@ -3092,18 +3216,135 @@ class Plugin():
                 self._log_info(f"error copying '{path}' from container "
                                f"'{con}': {cpret['output']}")
 
+    def _record_cmd_result(self, target, entry):
+        """Record the result of a command collection to `target`, which is
+        either the list of executed commands or the manifest's command list.
+
+        When commands are being run concurrently, the entries are held back
+        for the current thread so that they can be recorded in the order the
+        commands were queued in, rather than the order they finished in.
+        """
+        pending = getattr(self._cmd_local, 'pending', None)
+        if pending is None:
+            target.append(entry)
+        else:
+            pending.append((target, entry))
+
+    def _get_cmd_workers(self):
+        """Determine how many queued commands may be run concurrently by this
+        plugin, bound by the global budget for concurrent commands.
+        """
+        if not self.commons.get('cmd_budget'):
+            return 1
+        return max(1, min(self.cmd_workers,
+                          self.commons.get('cmd_threads', 1)))
+
+    def _get_cmd_batches(self):
+        """Split the priority-sorted list of queued commands into batches of
+        commands that are safe to run concurrently.
+
+        A batch only ever contains commands of the same priority, so that all
+        commands of a lower priority value finish before any command of a
+        higher value is started. Commands that may change the state of the
+        system are always run on their own, and commands that would write to
+        the same file in the archive are placed in separate batches so that
+        output filenames remain the same as for serial collection.
+
+        :returns:   The batches of commands, in the order they should run
+        :rtype:     ``list`` of ``list``s of ``SoSCommand``
+        """
+        batches = []
+        batch = []
+        names = set()
+        for soscmd in self.collect_cmds:
+            if soscmd.changes:
+                if batch:
+                    batches.append(batch)
+                batches.append([soscmd])
+                batch = []
+                names = set()
+                continue
+            name = os.path.join(
+                getattr(soscmd, 'subdir', None) or '',
+                self._mangle_command(
+                    getattr(soscmd, 'suggest_filename', None) or soscmd.cmd
+                )
+            )
+            if batch and (soscmd.priority != batch[0].priority or
+                          name in names):
+                batches.append(batch)
+                batch = []
+                names = set()
+            batch.append(soscmd)
+            names.add(name)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _collect_soscmd(self, soscmd):
+        self._log_debug("unpacked command: " + soscmd.__str__())
+        user = ""
+        if getattr(soscmd, "runas", None) is not None:
+            user = f", as the {soscmd.runas} user"
+        self._log_info(f"collecting output of '{soscmd.cmd}'{user}")
+        self._collect_cmd_output(**soscmd.__dict__)
+
+    def _collect_cmds_parallel(self, workers):
+        """Run the queued commands using a pool of up to `workers` threads.
+        Each command holds a slot of the global command budget while it runs,
+        so that the total number of concurrent commands across all plugins is
+        bounded regardless of how many plugins are running.
+
+        :param workers: The number of worker threads to use
+        :type workers:  ``int``
+        """
+        budget = self.commons['cmd_budget']
+
+        def _run(soscmd):
+            self._cmd_local.pending = []
+            err = None
+            try:
+                with budget:
+                    if not self._timeout_hit:
+                        self._collect_soscmd(soscmd)
+            except Exception as exc:
+                err = exc
+            finally:
+                pending = self._cmd_local.pending
+                self._cmd_local.pending = None
+            return pending, err
+
+        with ThreadPoolExecutor(
+                workers, thread_name_prefix=f"sos-{self.name()}") as pool:
+            for batch in self._get_cmd_batches():
+                if self._timeout_hit:
+                    break
+                if len(batch) == 1:
+                    self._collect_soscmd(batch[0])
+                    continue
+                errors = []
+                for pending, err in pool.map(_run, batch):
+                    for target, entry in pending:
+                        target.append(entry)
+                    if err:
+                        errors.append(err)
+                if errors:
+                    raise errors[0]
+
     def _collect_cmds(self):
         self.collect_cmds.sort(key=lambda x: x.priority)
+        workers = self._get_cmd_workers()
+        if workers > 1:
+            self._log_debug(f"collecting commands with {workers} workers")
+            self._collect_cmds_parallel(workers)
+            return
         for soscmd in self.collect_cmds:
-            self._log_debug("unpacked command: " + soscmd.__str__())
-            user = ""
-            if getattr(soscmd, "runas", None) is not None:
-                user = f", as the {soscmd.runas} user"
-            self._log_info(f"collecting output of '{soscmd.cmd}'{user}")
-            self._collect_cmd_output(**soscmd.__dict__)
+            self._collect_soscmd(soscmd)
 
     def _collect_tailed_files(self):
         for _file, _size in self._tail_files_list:
+            if self._timeout_hit:
+                return
             self._log_info(f"collecting tail of '{_file}' due to size limit")
             file_name = _file
             if file_name[0] == os.sep:
@@ -3111,7 +3352,18 @@ class Plugin():
             strfile = (
                 file_name.replace(os.path.sep, ".") + ".tailed"
             )
-            self.add_string_as_file(tail(_file, _size), strfile)
+            # copy the tail straight from the file rather than holding it in
+            # memory as a string
+            strpath = os.path.join('sos_strings', self.name(), strfile)
+            try:
+                self.archive.add_tail(_file, strpath, _size)
+            except Exception as e:
+                self._log_debug(f"could not add tail of '{_file}': {e}")
+                continue
+            self.manifest.strings[strfile.replace('.', '_')] = {
+                'path': strpath,
+                'tags': []
+            }
             rel_path = os.path.relpath('/', os.path.dirname(_file))
             link_path = os.path.join(rel_path, 'sos_strings',
                                      self.name(), strfile)
@@ -16,6 +16,7 @@ class Networking(Plugin):
 
     plugin_name = "networking"
     profiles = ('network', 'hardware', 'system')
+    cmd_workers = 4
     trace_host = "www.example.com"
 
     option_list = [
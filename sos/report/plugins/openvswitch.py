@@ -18,6 +18,7 @@ class OpenVSwitch(Plugin):
     short_desc = 'OpenVSwitch networking'
     plugin_name = "openvswitch"
     profiles = ('network', 'virt')
+    cmd_workers = 4
     actl = "ovs-appctl"
     vctl = "ovs-vsctl"
     ofctl = "ovs-ofctl"
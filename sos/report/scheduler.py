@@ -0,0 +1,182 @@
+# Copyright 2026 Red Hat, Inc.
+
+# This file is part of the sos project: https://github.com/sosreport/sos
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# version 2 of the GNU General Public License.
+#
+# See the LICENSE file in the source distribution for further information.
+
+import json
+import logging
+import os
+import tempfile
+
+PLUGIN_HISTORY_PATH = '/var/lib/sos/plugin_runtimes.json'
+
+
+class PluginScheduler():
+    """Determine the order in which loaded plugins are handed to the plugin
+    thread pool.
+
+    With more than one thread, the total run time of `sos report` is bounded
+    by whichever plugin finishes last. Handing plugins to the pool in
+    alphabetical order means that a slow plugin that sorts late is started
+    late and becomes the tail of the run. Instead, order plugins so that the
+    longest running plugins are started first (longest processing time first)
+    and the many short plugins fill in the remaining threads around them.
+
+    Run time estimates are taken from the run times recorded by previous
+    executions of sos on this host, which are persisted to a small JSON cache
+    file. For plugins that have no recorded history, a static estimate based
+    on the amount of collections the plugin queued during setup is used.
+
+    :param path:    The location of the run time history cache
+    :type path:     ``str``
+    """
+
+    #: Bump this if the format of the history file changes
+    version = 1
+
+    #: Estimated cost, in seconds, of each queued command, file copy, etc...
+    #: used when no recorded run time exists for a plugin
+    cmd_cost = 0.5
+    file_cost = 0.01
+    string_cost = 0.001
+
+    #: Weight given to the latest run time over the recorded history
+    smoothing = 0.5
+
+    def __init__(self, path=PLUGIN_HISTORY_PATH):
+        self.path = path
+        self.soslog = logging.getLogger('sos')
+        self.history = self._load_history()
+        self.run_times = {}
+
+    def _load_history(self):
+        """Load previously recorded plugin run times from disk. Any problem
+        with reading the file results in an empty history, as the cache only
+        influences the order of collections, never what is collected.
+        """
+        try:
+            with open(self.path, 'r') as hfile:
+                _hist = json.load(hfile)
+            if _hist.get('version') != self.version:
+                self.soslog.debug(
+                    f"Ignoring plugin run time history at {self.path}: "
+                    "unsupported version"
+                )
+                return {}
+            return {
+                k: float(v) for k, v in _hist.get('plugins', {}).items()
+            }
+        except FileNotFoundError:
+            return {}
+        except Exception as err:
+            self.soslog.debug(
+                f"Could not load plugin run time history from {self.path}: "
+                f"{err}"
+            )
+            return {}
+
+    def static_estimate(self, plugin):
+        """Estimate the run time of a plugin that has no recorded history,
+        based on the collections it queued during its setup() phase.
+
+        :param plugin:  The plugin to estimate the run time for
+        :type plugin:   ``Plugin``
+
+        :returns:       The estimated run time in seconds
+        :rtype:         ``float``
+        """
+        return (
+            len(plugin.collect_cmds) * self.cmd_cost +
+            (len(plugin.copy_paths) + len(plugin._tail_files_list)) *
+            self.file_cost +
+            len(plugin.copy_strings) * self.string_cost
+        )
+
+    def estimate(self, name, plugin):
+        """Return the expected run time of the given plugin, preferring any
+        recorded history over the static estimate
+
+        :param name:    The name of the plugin
+        :type name:     ``str``
+
+        :param plugin:  The loaded plugin
+        :type plugin:   ``Plugin``
+
+        :returns:       The estimated run time in seconds
+        :rtype:         ``float``
+        """
+        if name in self.history:
+            return self.history[name]
+        return self.static_estimate(plugin)
+
+    def order(self, pluglist, loaded_plugins):
+        """Sort the plugin list used by `SoSReport.collect()` so that plugins
+        with the longest expected run time are started first. Plugins with an
+        equal estimate retain their original (alphabetical) order.
+
+        :param pluglist:        The (count, plugin name) tuples to order
+        :type pluglist:         ``list`` of ``tuple``
+
+        :param loaded_plugins:  The (name, plugin) tuples of loaded plugins,
+                                indexed by the count in `pluglist`
+        :type loaded_plugins:   ``list`` of ``tuple``
+
+        :returns:               The re-ordered plugin list
+        :rtype:                 ``list`` of ``tuple``
+        """
+        estimates = {}
+        for count, name in pluglist:
+            estimates[name] = self.estimate(name, loaded_plugins[count-1][1])
+        return sorted(pluglist, key=lambda p: (-estimates[p[1]], p[0]))
+
+    def record(self, name, run_time):
+        """Record the run time of a plugin for this execution of sos
+
+        :param name:        The name of the plugin
+        :type name:         ``str``
+
+        :param run_time:    How long the plugin took to run, in seconds
+        :type run_time:     ``float``
+        """
+        self.run_times[name] = float(run_time)
+
+    def write_history(self):
+        """Merge the run times recorded during this execution into the history
+        and write it back to disk.
+
+        The file is written to a temporary file first and then moved into
+        place, so that concurrent or interrupted runs never leave behind a
+        partially written cache.
+        """
+        if not self.run_times:
+            return
+        for name, run_time in self.run_times.items():
+            if name in self.history:
+                run_time = (self.smoothing * run_time +
+                            (1 - self.smoothing) * self.history[name])
+            self.history[name] = round(run_time, 3)
+        tmpname = None
+        try:
+            _dir = os.path.dirname(self.path)
+            os.makedirs(_dir, mode=0o755, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=_dir, prefix='.plugin_runtimes')
+            with os.fdopen(fd, 'w') as tfile:
+                json.dump({
+                    'version': self.version,
+                    'plugins': dict(sorted(self.history.items()))
+                }, tfile, indent=4)
+            os.replace(tmpname, self.path)
+        except Exception as err:
+            self.soslog.debug(
+                f"Could not write plugin run time history to {self.path}: "
+                f"{err}"
+            )
+            if tmpname and os.path.exists(tmpname):
+                os.unlink(tmpname)
+
+# vim: set et ts=4 sw=4 :
@@ -6,22 +6,24 @@
 #
 # See the LICENSE file in the source distribution for further information.
 
+import fcntl
 import os
 import pwd
 import re
 import inspect
-from subprocess import Popen, PIPE, STDOUT
+import selectors
+import shutil
+from subprocess import Popen, PIPE, STDOUT, TimeoutExpired
 import logging
 import fnmatch
 import errno
 import shlex
 import glob
 import tempfile
-import threading
 import time
 import io
+import codecs
 from contextlib import closing
-from collections import deque
 
 try:
     from packaging.version import parse as parse_version
@@ -47,12 +49,24 @@ recommended to install proper python3-magic package with the module.
 
 TIMEOUT_DEFAULT = 300
 
+# How often, in seconds, a running command checks its poller for a plugin
+# timeout. Command completion is noticed immediately regardless of this value.
+POLLER_INTERVAL = 0.1
+
+# ioctl request to share the extents of a file with another file (reflink)
+FICLONE = 0x40049409
+
+# Largest amount of bytes handed to a single copy_file_range/sendfile call
+COPY_CHUNK = 1 << 30
+
 __all__ = [
     'TIMEOUT_DEFAULT',
     'ImporterHelper',
     'SoSTimeoutError',
     'TempFileUtil',
     'bold',
+    'content_is_binary',
+    'copy_file',
     'file_is_binary',
     'fileobj',
     'find',
@@ -108,6 +122,120 @@ def tail(filename, number_of_bytes):
         return f.read()
 
 
+def copy_file(src, dest, offset=0, count=None, buffered=False):
+    """Copy the content of `src`, optionally starting at `offset` and limited
+    to `count` bytes, to a new file at `dest`.
+
+    The copy is done without the content passing through python where
+    possible: a whole file on the same file system as `dest` is first
+    reflinked, then copied with copy_file_range() within a file system or
+    sendfile() across file systems. If the kernel cannot copy the file, the
+    remainder is copied with ordinary reads and writes.
+
+    :param src:         The path of the file to copy
+    :type src:          ``str``
+
+    :param dest:        The path of the file to create
+    :type dest:         ``str``
+
+    :param offset:      The offset in `src` to start copying from
+    :type offset:       ``int``
+
+    :param count:       The amount of bytes to copy, or `None` to copy up to
+                        the end of `src`, including what is appended to it
+                        while it is copied
+    :type count:        ``int``
+
+    :param buffered:    Only use ordinary reads and writes, as is needed for
+                        pseudo files such as those in /proc and /sys whose
+                        size is not known in advance
+    :type buffered:     ``bool``
+
+    :returns:           The amount of bytes copied
+    :rtype:             ``int``
+    """
+    with open(src, 'rb') as sfile, open(dest, 'wb', buffering=0) as dfile:
+        sfd = sfile.fileno()
+        dfd = dfile.fileno()
+        sstat = os.fstat(sfd)
+        # pseudo files usually report a size of 0 regardless of content
+        if buffered or not sstat.st_size:
+            sfile.seek(offset)
+            return _copy_buffered(sfile, dfile, count)
+        # without a count, copy to EOF even if the file grows while copying,
+        # e.g. a log that is being written to
+        to_eof = count is None
+        if to_eof:
+            count = max(sstat.st_size - offset, 0)
+        same_fs = sstat.st_dev == os.fstat(dfd).st_dev
+        copied = None
+        if same_fs and offset == 0 and count >= sstat.st_size:
+            try:
+                fcntl.ioctl(dfd, FICLONE, sfd)
+                copied = os.fstat(dfd).st_size
+                if not to_eof:
+                    return copied
+                dfile.seek(copied)
+            except OSError:
+                pass
+        if copied is None:
+            copied = _copy_kernel(sfd, dfd, offset, count, same_fs)
+        if copied < count or to_eof:
+            # the kernel could not copy (all of) the file, it shrank, or it
+            # may have grown
+            sfile.seek(offset + copied)
+            copied += _copy_buffered(sfile, dfile,
+                                     None if to_eof else count - copied)
+        return copied
+
+
+def _copy_kernel(sfd, dfd, offset, count, same_fs):
+    """Copy `count` bytes from offset `offset` of `sfd` to the current
+    position of `dfd` inside the kernel, returning the amount of bytes copied
+    which may be short if the kernel does not support copying these files.
+    """
+    copied = 0
+    use_cfr = same_fs and hasattr(os, 'copy_file_range')
+    while copied < count:
+        chunk = min(count - copied, COPY_CHUNK)
+        try:
+            if use_cfr:
+                num = os.copy_file_range(sfd, dfd, chunk, offset + copied)
+            else:
+                num = os.sendfile(dfd, sfd, offset + copied, chunk)
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                                 errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+            if use_cfr:
+                use_cfr = False
+                continue
+            break
+        if not num:
+            break
+        copied += num
+    return copied
+
+
+def _copy_buffered(sfile, dfile, count=None):
+    """Copy up to `count` bytes, or everything if `count` is `None`, from the
+    current position of `sfile` to `dfile` with ordinary reads and writes.
+    """
+    copied = 0
+    while count is None or copied < count:
+        size = io.DEFAULT_BUFFER_SIZE * 16
+        if count is not None:
+            size = min(size, count - copied)
+        buf = sfile.read(size)
+        if not buf:
+            break
+        view = memoryview(buf)
+        while view:
+            view = view[dfile.write(view):]
+        copied += len(buf)
+    return copied
+
+
 def fileobj(path_or_file, mode='r'):
     """Returns a file-like object that can be used as a context manager"""
     if isinstance(path_or_file, str):
@@ -170,6 +298,35 @@ def file_is_binary(fname):
             return True
 
 
+def content_is_binary(content):
+    """Helper to determine if the given content, e.g. the start of a file
+    within a tarball that has not been extracted, is binary or not. This
+    makes the same checks as ``file_is_binary()``.
+
+    :param content: The content, or at least the first MiB of it, to check
+    :type content:  ``bytes``
+
+    :returns:   True if binary, else False
+    :rtype:     ``bool``
+    """
+    if magic_mod:
+        try:
+            _ftup = magic.detect_from_content(content)
+            _mimes = ['text/', 'inode/']
+            return (
+                _ftup.encoding == 'binary' and not
+                any(_ftup.mime_type.startswith(_mt) for _mt in _mimes)
+            )
+        except Exception:
+            pass
+    with io.TextIOWrapper(io.BytesIO(content)) as tfile:
+        try:
+            tfile.read(1)
+            return False
+        except UnicodeDecodeError:
+            return True
+
+
 def find(file_pattern, top_dir, max_depth=None, path_pattern=None):
     """Generator function to find files recursively.
     Usage::
@@ -219,11 +376,16 @@ def is_executable(command, sysroot=None):
 def sos_get_command_output(command, timeout=TIMEOUT_DEFAULT, stderr=False,
                            chroot=None, chdir=None, env=None, foreground=False,
                            binary=False, sizelimit=None, poller=None,
-                           to_file=False, runas=None):
+                           to_file=False, runas=None, stream=False):
     # pylint: disable=too-many-locals,too-many-branches
     """Execute a command and return a dictionary of status and output,
     optionally changing root or current working directory before
     executing command.
+
+    If `to_file` is a path, the command writes its output directly to that
+    file. If `stream` is a path, output is instead streamed to that file by
+    sos as it is read, keeping only the last `sizelimit` MB on disk. In both
+    cases the returned output is empty.
     """
     # Change root or cwd for child only. Exceptions in the prexec_fn
     # closure are caught in the parent (chroot and chdir are bound from
@@ -238,12 +400,6 @@ def sos_get_command_output(command, timeout=TIMEOUT_DEFAULT, stderr=False,
         if (chdir):
             os.chdir(chdir)
 
-    def _check_poller(proc):
-        if poller() or proc.poll() == 124:
-            proc.terminate()
-            raise SoSTimeoutError
-        time.sleep(0.01)
-
     if runas:
         pwd_user = pwd.getpwnam(runas)
         env.update({
@@ -284,6 +440,7 @@ def sos_get_command_output(command, timeout=TIMEOUT_DEFAULT, stderr=False,
         _output = open(to_file, 'w')
     else:
         _output = PIPE
+    _stream = TailedFileWriter(stream, sizelimit, binary) if stream else None
     try:
         p = Popen(expanded_args, shell=False, stdout=_output,
                   stderr=STDOUT if stderr else PIPE,
@@ -291,34 +448,21 @@ def sos_get_command_output(command, timeout=TIMEOUT_DEFAULT, stderr=False,
                   preexec_fn=_child_prep_fn)
 
         if not to_file:
-            reader = AsyncReader(p.stdout, sizelimit, binary)
+            reader = AsyncReader(p.stdout, sizelimit, binary, stream=_stream)
         else:
             reader = FakeReader(p, binary)
 
-        if poller:
-            while reader.running:
-                _check_poller(p)
-        else:
-            try:
-                # override timeout=0 to timeout=None, as Popen will treat the
-                # former as a literal 0-second timeout
-                p.wait(timeout if timeout else None)
-            except Exception:
-                p.terminate()
-                if to_file:
-                    _output.close()
-                # until we separate timeouts from the `timeout` command
-                # handle per-cmd timeouts via Plugin status checks
-                reader.running = False
-                return {'status': 124, 'output': reader.get_contents(),
-                        'truncated': reader.is_full}
+        if not _wait_for_command(p, reader, timeout, poller):
+            p.terminate()
+            if to_file:
+                _output.close()
+            # until we separate timeouts from the `timeout` command
+            # handle per-cmd timeouts via Plugin status checks
+            return {'status': 124, 'output': reader.get_contents(),
+                    'truncated': reader.is_full}
         if to_file:
             _output.close()
 
-        # wait for Popen to set the returncode
-        while p.poll() is None:
-            pass
-
         stdout = reader.get_contents()
         truncated = reader.is_full
 
@@ -329,6 +473,9 @@ def sos_get_command_output(command, timeout=TIMEOUT_DEFAULT, stderr=False,
             return {'status': 127, 'output': "", 'truncated': ''}
         else:
             raise e
+    finally:
+        if _stream:
+            _stream.close()
 
     if p.returncode == 126 or p.returncode == 127:
         stdout = b""
@@ -340,6 +487,86 @@ def sos_get_command_output(command, timeout=TIMEOUT_DEFAULT, stderr=False,
     }
 
 
+def _open_pidfd(pid):
+    """Open a pidfd for the given process, which becomes readable once the
+    process exits. Returns None where pidfds are not supported (non-Linux,
+    kernels older than 5.3, or python older than 3.9).
+    """
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+def _wait_for_command(proc, reader, timeout=None, poller=None):
+    """Wait for a command started by `sos_get_command_output()` to exit,
+    feeding any output written to its stdout pipe to `reader` as it arrives.
+
+    Rather than sleeping and re-polling the process, this blocks in a
+    selector on the output pipe and, where supported, on a pidfd for the
+    process so that both new output and command completion wake us up
+    immediately. A wakeup interval is only used when a poller needs to be
+    checked for a plugin timeout, or when the deadline set by `timeout` draws
+    near.
+
+    :param proc:    The running command
+    :type proc:     ``subprocess.Popen``
+
+    :param reader:  The reader collecting the command's output
+    :type reader:   ``AsyncReader`` or ``FakeReader``
+
+    :param timeout: Seconds to wait for the command before giving up
+    :type timeout:  ``int``
+
+    :param poller:  Callable returning True when the calling plugin has
+                    timed out
+    :type poller:   ``callable``
+
+    :returns:       True if the command completed, False if `timeout` expired
+    :rtype:         ``bool``
+
+    :raises:        ``SoSTimeoutError`` if `poller` reports a timeout
+    """
+    # override timeout=0 to no deadline, rather than a 0-second timeout
+    deadline = time.monotonic() + timeout if timeout else None
+    pidfd = _open_pidfd(proc.pid)
+    sel = selectors.DefaultSelector()
+    try:
+        if reader.fileno() is not None:
+            sel.register(reader.fileno(), selectors.EVENT_READ, reader)
+        if pidfd is not None:
+            sel.register(pidfd, selectors.EVENT_READ, proc)
+        while reader.running or proc.returncode is None:
+            if poller and poller():
+                proc.terminate()
+                raise SoSTimeoutError
+            wait = POLLER_INTERVAL if poller else None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = remaining if wait is None else min(wait, remaining)
+            if not sel.get_map():
+                # output is done, but we have no pidfd to wait on
+                try:
+                    proc.wait(wait)
+                except TimeoutExpired:
+                    pass
+                continue
+            for key, _ in sel.select(wait):
+                if key.data is reader:
+                    if not reader.read():
+                        sel.unregister(key.fd)
+                else:
+                    sel.unregister(key.fd)
+                    proc.poll()
+        return True
+    finally:
+        sel.close()
+        if pidfd is not None:
+            os.close(pidfd)
+
+
 def import_module(module_fqname, superclasses=None):
     """Imports the module module_fqname and returns a list of defined classes
     from that module. If superclasses is defined then the classes returned will
@@ -496,6 +723,10 @@ class FakeReader():
     def is_full(self):
         return False
 
+    def fileno(self):
+        """There is no pipe to read from, the command writes to disk"""
+        return None
+
     def get_contents(self):
         return '' if not self.binary else b''
 
@@ -504,65 +735,236 @@ class FakeReader():
         return self.process.poll() is None
 
 
-class AsyncReader(threading.Thread):
+class AsyncReader():
     """Used to limit command output to a given size without deadlocking
     sos.
 
     Takes a sizelimit value in MB, and will compile stdout from Popen into a
     string that is limited to the given sizelimit.
+
+    Output is read straight into a single bytearray. Until sizelimit is
+    reached the buffer simply grows, after which it is used as a ring buffer
+    where new output overwrites the oldest, so that exactly the last
+    sizelimit bytes of output are retained. The content is only decoded once,
+    in a single pass, when `get_contents()` is called.
+
+    If `stream` is given, output is instead written to that (binary) file
+    object as it is read and nothing is retained in memory. Unless the reader
+    is in binary mode, streamed output is decoded and re-encoded on the way,
+    dropping invalid UTF-8 just like `get_contents()` does, so that both
+    modes write the same content to the archive.
+
+    The reader never blocks on the pipe itself. Instead, `read()` is called
+    by `_wait_for_command()` whenever the selector reports that the pipe has
+    data available.
     """
 
-    def __init__(self, channel, sizelimit, binary):
-        super().__init__()
+    def __init__(self, channel, sizelimit, binary, stream=None):
         self.chan = channel
         self.binary = binary
-        self.chunksize = 2048
-        self.slots = None
-        if sizelimit:
-            sizelimit = sizelimit * 1048576  # convert to bytes
-            self.slots = int(sizelimit / self.chunksize)
-        self.deque = deque(maxlen=self.slots)
+        self.stream = stream
+        self.decoder = None
+        if stream is not None and not binary:
+            self.decoder = codecs.getincrementaldecoder('utf-8')('ignore')
+        self.readsize = 65536
+        self.limit = sizelimit * 1048576 if sizelimit else None
+        self.buf = bytearray()
+        # number of valid bytes in buf
+        self.size = 0
+        # once the ring is full, the offset of the oldest byte in buf
+        self.pos = 0
+        self.wrapped = False
+        self.truncated = False
         self.running = True
-        self.start()
 
-    def run(self):
-        """Reads from the channel (pipe) that is the output pipe for a
-        called Popen. As we are reading from the pipe, the output is added
-        to a deque. After the size of the deque exceeds the sizelimit
-        earlier (older) entries are removed.
+    def fileno(self):
+        return self.chan.fileno()
 
-        This means the returned output is chunksize-sensitive, but is not
-        really byte-sensitive.
+    def _reserve(self, length):
+        """Grow the buffer, geometrically and never beyond the limit, so that
+        at least length bytes are free after the valid content
+        """
+        free = len(self.buf) - self.size
+        if free >= length:
+            return
+        grow = max(length - free, len(self.buf))
+        if self.limit:
+            grow = min(grow, self.limit - len(self.buf))
+        self.buf.extend(bytes(grow))
+
+    def read(self):
+        """Reads the data currently available from the channel (pipe) that is
+        the output pipe for a called Popen, directly into the buffer.
+
+        :returns: False once the pipe has reached EOF, else True
+        :rtype: ``bool``
         """
+        if self.stream is not None:
+            return self._read_to_stream()
+        if self.wrapped:
+            start = self.pos
+            end = min(start + self.readsize, self.limit)
+        else:
+            want = self.readsize
+            if self.limit:
+                want = min(want, self.limit - self.size)
+            self._reserve(want)
+            start = self.size
+            end = start + want
         try:
-            while True:
-                line = self.chan.read(self.chunksize)
-                if not line:
-                    # Pipe can remain open after output has completed
-                    break
-                self.deque.append(line)
-        except (ValueError, IOError):
+            with memoryview(self.buf)[start:end] as view:
+                count = os.readv(self.fileno(), [view])
+        except BlockingIOError:
+            return True
+        except (ValueError, OSError):
             # pipe has closed, meaning command output is done
-            pass
-        self.running = False
+            count = 0
+        if not count:
+            # Pipe can remain open after output has completed
+            self.running = False
+            return False
+        if self.wrapped:
+            self.pos = (self.pos + count) % self.limit
+            self.truncated = True
+        else:
+            self.size += count
+            if self.size == self.limit:
+                self.wrapped = True
+                self.pos = 0
+        return True
+
+    def _read_to_stream(self):
+        try:
+            data = os.read(self.fileno(), self.readsize)
+        except BlockingIOError:
+            return True
+        except (ValueError, OSError):
+            data = b''
+        if not data:
+            self.running = False
+            return False
+        if self.decoder is not None:
+            data = self.decoder.decode(data).encode('utf-8')
+        self.stream.write(data)
+        return True
 
     def get_contents(self):
-        """Returns the contents of the deque as a string"""
-        # block until command completes or timesout (separate from the plugin
-        # hitting a timeout)
-        while self.running:
-            time.sleep(0.01)
-        if not self.binary:
-            return ''.join(ln.decode('utf-8', 'ignore') for ln in self.deque)
-        else:
-            return b''.join(ln for ln in self.deque)
+        """Returns the collected output, decoded to a string unless the
+        reader is in binary mode
+        """
+        if self.wrapped and self.pos:
+            # rotate the ring in place so that the content is contiguous and
+            # can be decoded in a single pass
+            oldest = self.buf[self.pos:]
+            del self.buf[self.pos:]
+            self.buf[0:0] = oldest
+            del oldest
+            self.pos = 0
+        if self.binary:
+            return bytes(self.buf[:self.size])
+        with memoryview(self.buf)[:self.size] as view:
+            return str(view, 'utf-8', 'ignore')
 
     @property
     def is_full(self):
-        """Checks if the deque is full, implying that output was truncated"""
-        if not self.slots:
-            return False
-        return len(self.deque) == self.slots
+        """Checks if older output has been discarded, meaning the output was
+        truncated
+        """
+        if self.stream is not None:
+            return getattr(self.stream, 'truncated', False)
+        return self.truncated
+
+
+class TailedFileWriter():
+    """Writes command output streamed by an AsyncReader to a file on disk,
+    keeping at most the last sizelimit MB of it, without ever holding the
+    output in memory.
+
+    Output is written to `path` until sizelimit is reached. Any further
+    output rotates the file aside and starts a new one, so at most two
+    sizelimit-sized files exist at once. When closed after a rotation, the
+    tail of the rotated file is joined with the current file so that `path`
+    holds exactly the last sizelimit bytes of output.
+
+    :param path:        The file to write output to
+    :type path:         ``str``
+
+    :param sizelimit:   The maximum size in MB of output to keep, if any
+    :type sizelimit:    ``int``
+
+    :param binary:      If the output is not text. Text output that had to be
+                        tailed does not start with a partial UTF-8 character
+    :type binary:       ``bool``
+    """
+
+    copysize = 1048576
+
+    def __init__(self, path, sizelimit=None, binary=True):
+        self.path = path
+        self.binary = binary
+        self.rotated = f"{path}.rotated"
+        self.limit = sizelimit * 1048576 if sizelimit else None
+        self.fobj = open(path, 'wb')
+        self.written = 0
+        self.truncated = False
+
+    def write(self, data):
+        if not self.limit:
+            self.fobj.write(data)
+            return
+        data = memoryview(data)
+        while data:
+            if self.written == self.limit:
+                self._rotate()
+            room = self.limit - self.written
+            self.fobj.write(data[:room])
+            self.written += min(room, len(data))
+            data = data[room:]
+
+    def _rotate(self):
+        self.fobj.close()
+        os.replace(self.path, self.rotated)
+        self.fobj = open(self.path, 'wb')
+        self.written = 0
+        self.truncated = True
+
+    def close(self):
+        """Close the file, assembling the final tail of output if the file
+        was rotated
+        """
+        if self.fobj.closed:
+            return
+        self.fobj.close()
+        if not self.truncated:
+            return
+        tmpname = f"{self.path}.tailed"
+        partial = not self.binary
+        with open(tmpname, 'wb') as tfile:
+            for fname, offset in ((self.rotated, self.written),
+                                  (self.path, 0)):
+                with open(fname, 'rb') as sfile:
+                    sfile.seek(offset)
+                    if partial:
+                        partial = self._skip_partial_char(sfile)
+                    shutil.copyfileobj(sfile, tfile, self.copysize)
+        os.replace(tmpname, self.path)
+        os.unlink(self.rotated)
+
+    @staticmethod
+    def _skip_partial_char(fobj):
+        """Skip the UTF-8 continuation bytes at the current position of fobj,
+        which are what is left of a character that was cut off by tailing.
+
+        :returns:   True if the end of fobj was reached while skipping
+        :rtype:     ``bool``
+        """
+        while True:
+            byte = fobj.read(1)
+            if not byte:
+                return True
+            if byte[0] & 0xc0 != 0x80:
+                fobj.seek(-1, os.SEEK_CUR)
+                return False
 
 
 class ImporterHelper(object):
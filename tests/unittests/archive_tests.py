@@ -6,12 +6,23 @@
 #
 # See the LICENSE file in the source distribution for further information.
 import unittest
+import gzip
+import hashlib
+import io
+import lzma
 import os
+import random
+import re
 import tarfile
 import tempfile
+import threading
+import time
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
 
-from sos.archive import TarFileArchive
+from sos.archive import (TarFileArchive, ParallelCompressor,
+                         compile_sub_regex, P_FILE, P_LINK)
 from sos.utilities import tail
 from sos.policies import Policy
 
@@ -104,6 +115,34 @@ class TarFileArchiveTest(unittest.TestCase):
         afp = self.tf.open_file('tests/string_test.txt')
         self.assertEqual('this is my new content', afp.read())
 
+    def test_file_subs(self):
+        self.tf.add_string('user=admin\npassword=secret\n', 'tests/subs.txt')
+        subs = [(compile_sub_regex(r'(password=)(.*)'), r'\1******'),
+                (compile_sub_regex(r'^USER=.*'), 'user=<redacted>')]
+        self.assertEqual(2, self.tf.do_file_subs('tests/subs.txt', subs))
+        afp = self.tf.open_file('tests/subs.txt')
+        self.assertEqual('user=<redacted>\npassword=******\n', afp.read())
+
+    def test_file_subs_unchanged_not_written(self):
+        self.tf.add_string('password=******\n', 'tests/subs.txt')
+        path = self.tf.dest_path('tests/subs.txt')
+        mtime = os.stat(path).st_mtime_ns
+        subs = [(compile_sub_regex(r'(password=).*'), r'\1******')]
+        self.assertEqual(1, self.tf.do_file_subs('tests/subs.txt', subs))
+        self.assertEqual(mtime, os.stat(path).st_mtime_ns)
+
+    def test_compile_sub_regex_cached(self):
+        regex = compile_sub_regex(r'secret')
+        self.assertIs(regex, compile_sub_regex(r'secret'))
+        self.assertTrue(regex.flags & re.IGNORECASE)
+        self.assertTrue(regex.flags & re.MULTILINE)
+        self.assertFalse(compile_sub_regex(r'secret', 0).flags & re.IGNORECASE)
+
+    def test_add_tail(self):
+        self.tf.add_tail('tests/unittests/tail_test.txt', 'tests/tail', 22)
+        afp = self.tf.open_file('tests/tail')
+        self.assertEqual('this is the last line\n', afp.read())
+
     def test_make_link(self):
         self.tf.add_file('tests/ziptest')
         self.tf.add_link('tests/ziptest', 'link_name')
@@ -114,6 +153,291 @@ class TarFileArchiveTest(unittest.TestCase):
     def test_compress(self):
         self.tf.finalize("auto")
 
+    def test_parallel_compress_order(self):
+        self.tf.compress_workers = 4
+        self.tf.add_string('plugin output', 'sos_commands/foo/bar')
+        self.tf.add_string('version', 'version.txt')
+        self.tf.add_string('{}', 'sos_reports/manifest.json')
+        for method, suffix in (('xz', 'xz'), ('gzip', 'gz')):
+            with self.subTest(method=method):
+                self.tf._suffix = 'tar'
+                self.tf._archive_name = self.tf.name()
+                arc = self.tf._build_archive(method)
+                self.assertTrue(arc.endswith(f'.tar.{suffix}'))
+                with tarfile.open(arc) as rtf:
+                    names = rtf.getnames()
+                self.assertEqual(names[:2],
+                                 ['test/version.txt', 'test/sos_reports'])
+                self.assertIn('test/sos_commands/foo/bar', names)
+
+    def test_pipelined_archive(self):
+        self.tf.compress_workers = 2
+        self.tf.start_pipeline('gzip')
+        self.tf.add_string('collected', 'sos_commands/foo/bar')
+        self.tf.add_string('shared', 'etc/shared')
+        self.tf.append_paths(['sos_commands/foo'])
+        self.tf.append_paths(['/etc/shared'])
+        self.tf._pipeline['pool'].submit(lambda: None).result()
+        # rewritten after being appended, so must replace what was appended
+        self.tf.add_string('scrubbed', 'etc/shared')
+        self.tf.add_string('version', 'version.txt')
+        self.tf.add_string('unowned', 'environment')
+        arc = self.tf.finalize('gzip')
+        self.assertFalse(os.path.exists(arc + '.body'))
+        with tarfile.open(arc) as rtf:
+            names = rtf.getnames()
+            self.assertEqual(names[0], 'test/version.txt')
+            self.assertEqual(names[1], 'test/sos_commands/foo/bar')
+            self.assertEqual(names.count('test/sos_commands/foo/bar'), 1)
+            self.assertIn('test/environment', names)
+            self.assertIn('test/sos_commands/foo', names)
+            self.assertEqual(names.count('test/etc/shared'), 1)
+            self.assertEqual(
+                rtf.extractfile('test/etc/shared').read(), b'scrubbed'
+            )
+
+    def test_pipelined_archive_body_copied(self):
+        self.tf.start_pipeline('xz')
+        self.tf.add_string('collected', 'sos_commands/foo/bar')
+        self.tf.append_paths(['sos_commands/foo'])
+        self.tf._pipeline['pool'].submit(lambda: None).result()
+        with open(self.tf._pipeline_body, 'rb') as body:
+            with patch.object(self.tf, '_copy_body_members') as copy_body:
+                arc = self.tf.finalize('xz')
+            copy_body.assert_not_called()
+            body = body.read()
+        with open(arc, 'rb') as archive:
+            self.assertIn(body, archive.read())
+        with tarfile.open(arc) as rtf:
+            names = rtf.getnames()
+        self.assertEqual(names.count('test/sos_commands/foo/bar'), 1)
+        self.assertIn('test/sos_commands/foo', names)
+
+    def test_stream_to_fifo(self):
+        fifo = os.path.join(tempfile.mkdtemp(dir=self.tmpdir), 'fifo')
+        os.mkfifo(fifo)
+        received = []
+        reader = threading.Thread(
+            target=lambda: received.append(open(fifo, 'rb').read())
+        )
+        reader.start()
+        self.tf.stream_to(fifo, 'sha256')
+        self.tf.add_string('version', 'version.txt')
+        self.tf.add_string('collected', 'sos_commands/foo/bar')
+        arc = self.tf.finalize('gzip')
+        reader.join()
+        self.assertTrue(arc.endswith('test.tar.gz'))
+        self.assertFalse(os.path.exists(arc))
+        self.assertTrue(self.tf.stream.complete)
+        self.assertEqual(self.tf.stream.size, len(received[0]))
+        self.assertEqual(self.tf.stream.hexdigest(),
+                         hashlib.sha256(received[0]).hexdigest())
+        with tarfile.open(fileobj=io.BytesIO(received[0])) as rtf:
+            self.assertEqual(rtf.getnames()[0], 'test/version.txt')
+            self.assertEqual(
+                rtf.extractfile('test/sos_commands/foo/bar').read(),
+                b'collected'
+            )
+
+
+class ParallelCompressorTest(unittest.TestCase):
+
+    def _roundtrip(self, method, decompress):
+        data = os.urandom(1 << 16) * 40
+        out = io.BytesIO()
+        comp = ParallelCompressor(out, method, 4)
+        for idx in range(0, len(data), 100000):
+            comp.write(data[idx:idx + 100000])
+        comp.close()
+        self.assertEqual(comp.tell(), len(data))
+        self.assertEqual(decompress(out.getvalue()), data)
+
+    def test_gzip_members(self):
+        self._roundtrip('gzip', gzip.decompress)
+
+    def test_xz_streams(self):
+        self._roundtrip('xz', lzma.decompress)
+
+    def test_gzip_member_header(self):
+        member = ParallelCompressor._compress_gzip(b'sos')
+        # gzip magic, deflate, and an mtime of 0 for reproducible output
+        self.assertEqual(member[:3], b'\x1f\x8b\x08')
+        self.assertEqual(member[4:8], bytes(4))
+        self.assertEqual(gzip.decompress(member), b'sos')
+
+    def test_close_cancels_on_error(self):
+        class FailingFile(io.BytesIO):
+            def write(self, data):
+                raise OSError('disk full')
+
+        comp = ParallelCompressor(FailingFile(), 'gzip', 2)
+        comp.write(os.urandom(comp.blocksize * 3))
+        with self.assertRaises(OSError):
+            comp.close()
+        self.assertFalse(comp.pending)
+        with self.assertRaises(RuntimeError):
+            comp.pool.submit(print)
+
+
+class SlowFile(io.StringIO):
+    """A file object that is slow to read, like files on a remote or virtual
+    file system can be
+    """
+
+    def __next__(self):
+        time.sleep(0.002)
+        return super().__next__()
+
+
+class ConcurrentAddTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.arc = TarFileArchive('test', self.tmpdir, Policy(), 1,
+                                  {'encrypt': False}, '/')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_same_paths_from_many_threads(self):
+        content = 'line\n' * 10
+        paths = [f'sos_commands/plugin{i % 4}/file{i}' for i in range(100)]
+
+        def add_all():
+            for path in paths:
+                self.arc.add_file(SlowFile(content), dest=path)
+                # the content must be complete once add_file() returns,
+                # whether or not this thread copied it
+                with self.arc.open_file(path) as afile:
+                    self.assertEqual(afile.read(), content)
+
+        threads = [threading.Thread(target=add_all) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.arc._dest_locks, {})
+
+    def test_type_conflict_while_writing(self):
+        dest, lock = self.arc._lock_dest('sos_commands/conflict', P_FILE)
+        try:
+            with self.assertRaises(ValueError):
+                self.arc.check_path('sos_commands/conflict', P_LINK)
+        finally:
+            self.arc._release_dest(dest, lock)
+
+
+class ConcurrentAddBenchmark(unittest.TestCase):
+    """Stress benchmark of many threads adding small files to the archive at
+    once, as plugins do when running with --threads. Measured both with
+    files copied from the local file system, and with slow sources where
+    collection time is dominated by reading the source.
+    """
+
+    files = 2000
+    slow_files = 200
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = tempfile.mkdtemp(dir=self.tmpdir)
+        for num in range(self.files):
+            with open(os.path.join(self.src, f'file{num}'), 'w') as sfile:
+                sfile.write(f'content of file {num}\n' * 20)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _run(self, threads, slow=False):
+        arc = TarFileArchive(os.path.join(self.tmpdir, f'bench-{threads}'),
+                             self.tmpdir, Policy(), threads,
+                             {'encrypt': False}, '/')
+        count = self.slow_files if slow else self.files
+
+        def add(num):
+            if slow:
+                arc.add_file(SlowFile('line\n' * 5),
+                             dest=f'sos_commands/plugin{num % 16}/f{num}')
+            else:
+                arc.add_file(os.path.join(self.src, f'file{num}'))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(add, range(count)))
+        elapsed = time.perf_counter() - start
+        shutil.rmtree(arc.get_archive_path())
+        return elapsed
+
+    def test_add_file_scaling(self):
+        print(f"\nadding {self.files} local / {self.slow_files} slow files:")
+        results = {}
+        for threads in (1, 4, 16):
+            results[threads] = self._run(threads, slow=True)
+            local = self._run(threads)
+            print(f"  threads={threads:<3} local {local:6.3f}s "
+                  f"slow {results[threads]:6.3f}s")
+        # copies are no longer serialized on a single archive wide lock
+        self.assertLess(results[16] * 4, results[1])
+
+
+class CompressionTypeBenchmark(unittest.TestCase):
+    """Benchmark of wall time and compression ratio for each of the
+    --compression-type methods, compressing a synthetic archive tree with a
+    single worker and with all CPUs (at least two, so that block-parallel
+    compression is always measured).
+    """
+
+    words = [f"word{i}" for i in range(2000)] + ['ERROR', 'INFO', 'DEBUG']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tree = tempfile.mkdtemp(dir=self.tmpdir)
+        rand = random.Random(42)
+        for plug in range(8):
+            pdir = os.path.join(self.tree, 'sos_commands', f'plugin{plug}')
+            os.makedirs(pdir)
+            for num in range(4):
+                lines = (' '.join(rand.choices(self.words, k=12))
+                         for _ in range(2500))
+                with open(os.path.join(pdir, f'cmd{num}'), 'w') as cfile:
+                    cfile.write('\n'.join(lines))
+        self.size = sum(
+            os.path.getsize(os.path.join(root, f))
+            for root, _, files in os.walk(self.tree) for f in files
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _build(self, method, workers):
+        arc = TarFileArchive(os.path.join(self.tmpdir, f'bench-{workers}'),
+                             self.tmpdir, Policy(), 1,
+                             {'encrypt': False}, '/')
+        shutil.rmtree(arc.get_archive_path())
+        shutil.copytree(self.tree, arc.get_archive_path())
+        arc.compress_workers = workers
+        start = time.perf_counter()
+        name = arc._build_archive(method)
+        elapsed = time.perf_counter() - start
+        ratio = self.size / os.path.getsize(name)
+        os.unlink(name)
+        shutil.rmtree(arc.get_archive_path())
+        return elapsed, ratio
+
+    def test_compression_types(self):
+        methods = ['xz', 'gzip']
+        try:
+            import zstandard  # noqa: F401
+            methods.append('zstd')
+        except ImportError:
+            pass
+        print(f"\ncompressing {self.size / 1048576:.1f}MiB synthetic tree:")
+        for method in methods:
+            for workers in (1, max(2, os.cpu_count() or 1)):
+                elapsed, ratio = self._build(method, workers)
+                print(f"  {method:5} workers={workers:<3} "
+                      f"{elapsed:6.2f}s ratio {ratio:5.2f}")
+                self.assertGreater(ratio, 1)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -6,9 +6,23 @@
 #
 # See the LICENSE file in the source distribution for further information.
 
+import bz2
+import gzip
+import json
+import lzma
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import tarfile
+import tempfile
+import time
 import unittest
 
 from ipaddress import ip_interface
+from unittest.mock import Mock, patch
+from sos.cleaner import SoSCleaner
 from sos.cleaner.parsers.ip_parser import SoSIPParser
 from sos.cleaner.parsers.mac_parser import SoSMacParser
 from sos.cleaner.parsers.hostname_parser import SoSHostnameParser
@@ -24,6 +38,10 @@ from sos.cleaner.preppers import SoSPrepper
 from sos.cleaner.preppers.hostname import HostnamePrepper
 from sos.cleaner.preppers.ip import IPPrepper
 from sos.cleaner.archives.sos import SoSReportArchive
+from sos.cleaner.archives import (get_file_compression, is_tarfile,
+                                  open_tarfile, zstandard)
+from sos.cleaner.archives.generic import DataDirArchive, TarballArchive
+from sos.component import SoSMetadata
 from sos.options import SoSOptions
 
 
@@ -80,6 +98,48 @@ class CleanerMapTests(unittest.TestCase):
         _test = self.ip_map.get('127.0.0.1')
         self.assertEqual(_test, '127.0.0.1')
 
+    def test_regex_items_longest_first(self):
+        rand = random.Random(0)
+        items = [f"kw{'x' * rand.randint(0, 20)}{num}" for num in range(300)]
+        for item in items:
+            self.kw_map.add_regex_item(item)
+        self.assertEqual(
+            [item for item, _ in self.kw_map.compiled_regexes],
+            sorted(items, key=len, reverse=True)
+        )
+
+    def test_bulk_regex_items_match_incremental(self):
+        rand = random.Random(0)
+        items = [f"kw{'x' * rand.randint(0, 20)}{num}" for num in range(300)]
+        _bulk = SoSKeywordMap()
+        self.kw_map.add_regex_item('kwfirst')
+        _bulk.add_regex_item('kwfirst')
+        for item in items:
+            self.kw_map.add_regex_item(item)
+        _bulk.add_regex_items(items + items[:10])
+        self.assertEqual(
+            [item for item, _ in _bulk.compiled_regexes],
+            [item for item, _ in self.kw_map.compiled_regexes]
+        )
+        line = ' '.join(items[::7])
+        self.assertEqual(
+            [item for item, _ in _bulk.matcher.find(line)],
+            [item for item, _ in self.kw_map.matcher.find(line)]
+        )
+
+    def test_ignore_item_cached(self):
+        self.assertTrue(self.ip_map.ignore_item('127.0.0.1'))
+        self.assertTrue(self.ip_map.ignore_item('127.0.0.1'))
+        self.assertFalse(self.ip_map.ignore_item('10.0.0.1'))
+        self.assertEqual(self.ip_map._is_ignored_item.cache_info().hits, 1)
+
+    def test_add_ignore_match_clears_cache(self):
+        self.addCleanup(SoSIPMap.ignore_matches.remove, '10.9.8.7')
+        self.addCleanup(SoSIPMap._ignore_regexes.pop)
+        self.assertFalse(self.ip_map.ignore_item('10.9.8.7'))
+        self.ip_map.add_ignore_match('10.9.8.7')
+        self.assertTrue(self.ip_map.ignore_item('10.9.8.7'))
+
     def test_hostname_obfuscate_domain_options(self):
         _test = self.host_map.get('www.redhat.com')
         self.assertNotEqual(_test, 'www.redhat.com')
@@ -313,6 +373,52 @@ class CleanerParserTests(unittest.TestCase):
         _test = self.uname_parser.parse_line(line)[0]
         self.assertEqual(line, _test)
 
+    def test_prefilter_rejects_lines(self):
+        for parser in (self.ip_parser, self.ipv6_parser, self.mac_parser,
+                       self.host_parser):
+            line = 'this line has nothing to obfuscate in it'
+            self.assertEqual(parser.parse_line(line), (line, 0))
+            self.assertEqual(parser.lines_parsed, 1)
+            self.assertEqual(parser.lines_rejected, 1)
+
+    def test_prefilter_passes_lines(self):
+        lines = [
+            (self.ip_parser, 'inet 10.0.0.1/24 brd 10.0.0.255'),
+            (self.ipv6_parser, 'inet6 2001:db8::1/64 scope global'),
+            (self.mac_parser, 'link/ether 13:24:35:46:57:68 brd'),
+            (self.host_parser, 'search foobar.com')
+        ]
+        for parser, line in lines:
+            self.assertNotEqual(parser.parse_line(line)[0], line)
+            self.assertEqual(parser.lines_parsed, 1)
+            self.assertEqual(parser.lines_rejected, 0)
+
+    def test_patterns_compiled_once_per_class(self):
+        _second = SoSIPParser(config={})
+        self.assertIs(_second._regexes, self.ip_parser._regexes)
+        self.assertIs(_second._skip_line_regexes,
+                      self.ip_parser._skip_line_regexes)
+        self.assertIsNot(self.mac_parser._regexes, self.ip_parser._regexes)
+        self.assertEqual(
+            [r.pattern for r in self.mac_parser._regexes],
+            self.mac_parser.regex_patterns
+        )
+
+    def test_prefilter_never_rejects_matches(self):
+        rand = random.Random(0)
+        chars = '0123456789abcdefABCDEFxyz:._-/ '
+        for parser in (self.ip_parser, self.ipv6_parser, self.mac_parser,
+                       self.host_parser):
+            for _ in range(5000):
+                line = ''.join(rand.choice(chars)
+                               for _ in range(rand.randint(1, 40)))
+                if parser._prefilter.search(line):
+                    continue
+                for pattern in parser.regex_patterns:
+                    self.assertEqual(re.findall(pattern, line, re.I), [],
+                                     f"{parser.name} prefilter rejected "
+                                     f"'{line}'")
+
 
 class PrepperTests(unittest.TestCase):
     """
@@ -354,3 +460,744 @@ class PrepperTests(unittest.TestCase):
             [],
             self.ipv4_prepper.get_parser_file_list('foobar', self.archive)
         )
+
+
+@unittest.skipIf(zstandard is None, 'zstandard module not available')
+class ZstdArchiveTests(unittest.TestCase):
+    """
+    Ensure that zstd compressed tarballs are cleaned and re-compressed as zstd
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, 'archive', 'etc')
+        os.makedirs(path)
+        with open(os.path.join(path, 'hosts'), 'w') as hfile:
+            hfile.write('10.0.0.3 node3.example.com\n')
+        self.archive = os.path.join(self.tmpdir, 'archive.tar.zst')
+        with open(self.archive, 'wb') as zfile:
+            with zstandard.ZstdCompressor().stream_writer(zfile) as _zw:
+                with tarfile.open(fileobj=_zw, mode='w') as tar:
+                    tar.add(os.path.join(self.tmpdir, 'archive'),
+                            arcname='archive')
+        shutil.rmtree(os.path.join(self.tmpdir, 'archive'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_zstd_tarball(self):
+        self.assertTrue(is_tarfile(self.archive))
+        self.assertTrue(TarballArchive.check_is_type(self.archive))
+        archive = TarballArchive(self.archive, self.tmpdir)
+        self.assertEqual(archive.get_compression(), 'zst')
+        archive.extract(quiet=True)
+        with open(os.path.join(archive.extracted_path, 'etc/hosts')) as hfile:
+            self.assertEqual(hfile.read(), '10.0.0.3 node3.example.com\n')
+        archive.compress(archive.get_compression())
+        self.assertTrue(archive.final_archive_path.endswith('.tar.zst'))
+        with open_tarfile(archive.final_archive_path, self.tmpdir) as tar:
+            self.assertEqual(tar.extractfile('archive/etc/hosts').read(),
+                             b'10.0.0.3 node3.example.com\n')
+
+
+class ProcessObfuscationTests(unittest.TestCase):
+    """
+    Ensure that obfuscating the files of an archive with multiple processes
+    gives the same result as obfuscating them one by one
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpdir, 'map'), 'w') as mfile:
+            mfile.write('{}')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _make_archive(self, name):
+        path = os.path.join(self.tmpdir, name, 'sosdata')
+        os.makedirs(os.path.join(path, 'etc'))
+        os.makedirs(os.path.join(path, 'var/log'))
+        for i in range(40):
+            with open(os.path.join(path, 'etc', f"conf{i}"), 'w') as cfile:
+                for j in range(30):
+                    cfile.write(
+                        f"node{(i * j) % 23}.example.com has 10.{i % 3}.0.4/16"
+                        f" and talks to node{i % 5} about secretword {j}\n"
+                    )
+        with open(os.path.join(path, 'var/log/node3.example.com.log'),
+                  'w') as lfile:
+            lfile.write("messages from node3.example.com\n")
+        with gzip.open(os.path.join(path, 'var/log/messages-1.gz'),
+                       'wt') as lfile:
+            for i in range(200):
+                lfile.write(f"node{i % 31}.example.com said secretword\n")
+        return path
+
+    def _clean(self, name, file_jobs):
+        """Clean an archive in a forked process, so that every run starts
+        from the same state of the maps
+        """
+        def _run():
+            # the maps keep some of their state at the class level, which
+            # other tests may have changed
+            SoSHostnameMap.hosts.clear()
+            SoSHostnameMap._domains.clear()
+            SoSIPMap._networks.clear()
+            SoSIPv6Map.networks.clear()
+            path = self._make_archive(name)
+            opts = SoSOptions(
+                domains=['example.com'], disable_parsers=[],
+                skip_cleaning_files=[], jobs=1, file_jobs=file_jobs,
+                keywords=['secretword'], keyword_file=None, usernames=[],
+                map_file=os.path.join(self.tmpdir, 'map'), no_update=True,
+                keep_binary_files=False, batch=True
+            )
+            manifest = SoSMetadata()
+            manifest.add_section('components')
+            cleaner = SoSCleaner(in_place=True, hook_commons={
+                'options': opts,
+                'tmpdir': os.path.join(self.tmpdir, name),
+                'sys_tmp': self.tmpdir,
+                'policy': Mock(get_preferred_hash_name=lambda: 'sha256'),
+                'manifest': manifest
+            })
+            archive = DataDirArchive(path, os.path.join(self.tmpdir, name))
+            archive.extract()
+            cleaner.report_paths = [archive]
+            cleaner.preload_all_archives_into_maps()
+            cleaner.generate_parser_item_regexes()
+            if file_jobs > 1:
+                cleaner.obfuscate_files_in_processes(archive)
+            else:
+                for fname, short_name in \
+                        cleaner._get_files_to_obfuscate(archive):
+                    cleaner._obfuscate_archive_file(archive, fname,
+                                                    short_name)
+            with open(os.path.join(self.tmpdir, name, 'map.json'), 'w') as m:
+                json.dump(cleaner.compile_mapping_dict(), m)
+
+        proc = multiprocessing.get_context('fork').Process(target=_run)
+        proc.start()
+        proc.join()
+        self.assertEqual(proc.exitcode, 0)
+        with open(os.path.join(self.tmpdir, name, 'map.json'), 'r') as m:
+            return json.load(m)
+
+    def _read_archive(self, name):
+        path = os.path.join(self.tmpdir, name, 'sosdata')
+        contents = {}
+        for dirname, _, files in os.walk(path):
+            for fname in files:
+                fpath = os.path.join(dirname, fname)
+                _open = gzip.open if fname.endswith('.gz') else open
+                with _open(fpath, 'rt') as cfile:
+                    contents[os.path.relpath(fpath, path)] = cfile.read()
+        return contents
+
+    def test_process_obfuscation_matches_serial(self):
+        serial_map = self._clean('serial', 1)
+        process_map = self._clean('process', 3)
+        self.assertEqual(serial_map, process_map)
+        self.assertIn('node3.example.com', serial_map['hostname_map'])
+        serial = self._read_archive('serial')
+        self.assertEqual(serial, self._read_archive('process'))
+        self.assertNotIn('var/log/node3.example.com.log', serial)
+        self.assertIn('var/log/messages-1.gz', serial)
+        self.assertNotIn('example.com', ''.join(serial.values()))
+        self.assertNotIn('secretword', ''.join(serial.values()))
+
+    def test_workers_forked_as_others_finish(self):
+        fork_worker = SoSCleaner._fork_shard_worker
+
+        def _fork_shard_worker(cleaner, *args):
+            # the workers that have finished are already joined
+            if len(multiprocessing.active_children()) >= 2:
+                raise Exception('too many workers running')
+            return fork_worker(cleaner, *args)
+
+        with patch.object(SoSCleaner, '_fork_shard_worker',
+                          _fork_shard_worker):
+            process_map = self._clean('process', 2)
+        self.assertEqual(process_map, self._clean('serial', 1))
+
+
+class PreloadTests(unittest.TestCase):
+    """
+    Ensure that reading the prep files of several archives concurrently
+    prepares the maps the same way as reading them one archive at a time
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpdir, 'map'), 'w') as mfile:
+            mfile.write('{}')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _make_archive(self, name, num):
+        path = os.path.join(self.tmpdir, name)
+        os.makedirs(os.path.join(path, 'etc'))
+        with open(os.path.join(path, 'etc/hosts'), 'w') as hfile:
+            for i in range(20):
+                hfile.write(f"10.0.{num}.{i} node{num}-{i}.example.com "
+                            f"alias{(num * 7 + i) % 13}.example.com\n")
+        return path
+
+    def _preload(self, jobs):
+        """Preload the maps from several archives in a forked process, so
+        that every run starts from the same state of the maps
+        """
+        map_path = os.path.join(self.tmpdir, f"map{jobs}.json")
+
+        def _run():
+            SoSHostnameMap.hosts.clear()
+            SoSHostnameMap._domains.clear()
+            SoSIPMap._networks.clear()
+            SoSIPv6Map.networks.clear()
+            opts = SoSOptions(
+                domains=['example.com'], disable_parsers=[],
+                skip_cleaning_files=[], jobs=jobs, keywords=[],
+                keyword_file=None, usernames=[],
+                map_file=os.path.join(self.tmpdir, 'map'), no_update=True,
+                keep_binary_files=False, batch=True
+            )
+            manifest = SoSMetadata()
+            manifest.add_section('components')
+            cleaner = SoSCleaner(in_place=True, hook_commons={
+                'options': opts,
+                'tmpdir': os.path.join(self.tmpdir, f"run{jobs}"),
+                'sys_tmp': self.tmpdir,
+                'policy': Mock(get_preferred_hash_name=lambda: 'sha256'),
+                'manifest': manifest
+            })
+            cleaner.report_paths = [
+                DataDirArchive(self._make_archive(f"archive{jobs}-{num}", num),
+                               os.path.join(self.tmpdir, f"run{jobs}"))
+                for num in range(4)
+            ]
+            cleaner.preload_all_archives_into_maps()
+            for archive in cleaner.report_paths:
+                assert not archive.file_content_cache
+            with open(map_path, 'w') as m:
+                json.dump(cleaner.compile_mapping_dict(), m)
+
+        proc = multiprocessing.get_context('fork').Process(target=_run)
+        proc.start()
+        proc.join()
+        self.assertEqual(proc.exitcode, 0)
+        with open(map_path, 'r') as m:
+            return json.load(m)
+
+    def test_concurrent_preload_matches_serial(self):
+        serial_map = self._preload(1)
+        self.assertEqual(serial_map, self._preload(4))
+        self.assertEqual(serial_map['hostname_map']['node0-0.example.com'],
+                         'host0.obfuscateddomain0.com')
+
+    def test_file_content_cached(self):
+        path = self._make_archive('archive', 0)
+        archive = DataDirArchive(path, self.tmpdir)
+        content = archive.get_file_content('etc/hosts')
+        with open(os.path.join(path, 'etc/hosts'), 'w') as hfile:
+            hfile.write('changed\n')
+        self.assertEqual(content, archive.get_file_content('etc/hosts'))
+        archive.clear_file_content_cache()
+        self.assertEqual('changed\n', archive.get_file_content('etc/hosts'))
+
+
+class FileObfuscationTests(unittest.TestCase):
+    """
+    Ensure that obfuscating a file in blocks gives the same result as
+    obfuscating it line by line, and that files are only rewritten when
+    something in them was obfuscated
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpdir, 'map'), 'w') as mfile:
+            json.dump({'keyword_map': {'secretword': 'obfuscatedword0'}},
+                      mfile)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _make_cleaner(self):
+        opts = SoSOptions(
+            domains=[], disable_parsers=['hostname', 'ip', 'ipv6'],
+            skip_cleaning_files=[], jobs=1, keywords=[],
+            keyword_file=None, usernames=[],
+            map_file=os.path.join(self.tmpdir, 'map'), no_update=True,
+            keep_binary_files=False, batch=True
+        )
+        manifest = SoSMetadata()
+        manifest.add_section('components')
+        cleaner = SoSCleaner(in_place=True, hook_commons={
+            'options': opts,
+            'tmpdir': self.tmpdir,
+            'sys_tmp': self.tmpdir,
+            'policy': Mock(get_preferred_hash_name=lambda: 'sha256'),
+            'manifest': manifest
+        })
+        cleaner.generate_parser_item_regexes()
+        return cleaner
+
+    def _write_file(self, content):
+        path = os.path.join(self.tmpdir, 'data', 'file')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as dfile:
+            dfile.write(content)
+        return path
+
+    def test_blocks_match_line_by_line(self):
+        content = b''.join([
+            b'nothing to see here\n',
+            b'\n',
+            b'the secretword is here\r\n',
+            b'mac 60:55:cb:4b:c9:27 and 10:05:05 \xff\xfe bytes\n',
+            b'a line that spans the block size of the test cleaner\r',
+            b'SecretWord\n',
+            b'  \n',
+            b'time 10:05:05 only\n',
+        ] * 5) + b'last secretword'
+        path = self._write_file(content)
+        random.seed(1)
+        line_cleaner = self._make_cleaner()
+        with open(path, 'r', errors='replace') as dfile:
+            expected = ''.join(
+                line_cleaner.obfuscate_line(line)[0] for line in dfile
+            )
+        random.seed(1)
+        cleaner = self._make_cleaner()
+        cleaner.obfuscate_block_size = 16
+        self.assertEqual(cleaner.obfuscate_file(path, 'data/file'), 16)
+        with open(path, 'r') as dfile:
+            self.assertEqual(dfile.read(), expected)
+        self.assertNotIn('secretword', expected.lower())
+        self.assertEqual(
+            [(p.lines_parsed, p.lines_rejected) for p in line_cleaner.parsers],
+            [(p.lines_parsed, p.lines_rejected) for p in cleaner.parsers]
+        )
+
+    def test_unchanged_file_not_rewritten(self):
+        path = self._write_file(b'nothing to see here\n' * 100)
+        before = os.stat(path)
+        self.assertEqual(self._make_cleaner().obfuscate_file(path), 0)
+        after = os.stat(path)
+        self.assertEqual((before.st_ino, before.st_mtime_ns),
+                         (after.st_ino, after.st_mtime_ns))
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['file'])
+
+    def test_compressed_files(self):
+        path = os.path.dirname(self._write_file(b''))
+        archive = DataDirArchive(path, self.tmpdir)
+        archive.extract()
+        cleaner = self._make_cleaner()
+        for ext, module in (('gz', gzip), ('xz', lzma), ('bz2', bz2)):
+            fname = f"messages.{ext}"
+            with module.open(os.path.join(path, fname), 'wb') as cfile:
+                cfile.write(b'the secretword\n' * 100)
+            self.assertFalse(archive.should_remove_file(fname))
+            self.assertEqual(
+                cleaner.obfuscate_file(os.path.join(path, fname), fname), 100
+            )
+            with module.open(os.path.join(path, fname), 'rb') as cfile:
+                self.assertEqual(cfile.read(),
+                                 b'the obfuscatedword0\n' * 100)
+        self.assertEqual(
+            sorted(os.listdir(path)),
+            ['file', 'messages.bz2', 'messages.gz', 'messages.xz']
+        )
+        with gzip.open(os.path.join(path, 'binary.gz'), 'wb') as cfile:
+            cfile.write(b'\xff\xfe\x00\x01')
+        self.assertTrue(archive.should_remove_file('binary.gz'))
+        with open(os.path.join(path, 'corrupt.xz'), 'wb') as cfile:
+            cfile.write(b'not compressed')
+        self.assertTrue(archive.should_remove_file('corrupt.xz'))
+
+    def test_changed_file_replaced(self):
+        path = self._write_file(b'nothing to see here\n' * 100 +
+                                b'but the secretword\n')
+        os.chmod(path, 0o640)
+        self.assertEqual(self._make_cleaner().obfuscate_file(path), 1)
+        with open(path, 'r') as dfile:
+            self.assertEqual(
+                dfile.read(),
+                'nothing to see here\n' * 100 + 'but the obfuscatedword0\n'
+            )
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['file'])
+
+
+class StreamObfuscationTests(unittest.TestCase):
+    """
+    Ensure that obfuscating a tarball without extracting it gives the same
+    result as extracting it, obfuscating it and repacking it
+    """
+
+    long_dir = 'sys/' + '/'.join(['subdirectory'] * 10)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpdir, 'map'), 'w') as mfile:
+            json.dump({
+                'hostname_map': {
+                    'example.com': 'obfuscateddomain0.com',
+                    'node3.example.com': 'host0.obfuscateddomain0.com'
+                },
+                'keyword_map': {'secretword': 'obfuscatedword0'},
+                'ip_map': {'10.0.0.3': '100.0.0.3'}
+            }, mfile)
+        self.archive = self._make_archive()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _make_archive(self, compression='gz'):
+        files = {
+            'etc/hosts': b'10.0.0.3 node3.example.com\n',
+            'etc/motd': b'no secrets here\n',
+            'node3.example.com/info': b'secretword on node3.example.com\n',
+            f'{self.long_dir}/node3.example.com': b'secretword\r\n',
+            'proc/kallsyms': b'secretword is not cleaned here\n',
+            'var/data': b'\xff\xfe\x00\x01binary secretword',
+            'var/dump.gz': b'secretword',
+            'var/log/messages-1.gz': gzip.compress(
+                b'secretword on node3.example.com\n'
+            ),
+            'var/log/messages-2.xz': lzma.compress(b'10.0.0.3 is up\n'),
+            'var/log/messages-3.bz2': bz2.compress(b'no secrets here\n'),
+            'var/log/binary.gz': gzip.compress(b'\xff\xfe\x00\x01')
+        }
+        path = os.path.join(self.tmpdir, 'archive')
+        for fname, content in files.items():
+            os.makedirs(os.path.join(path, os.path.dirname(fname)),
+                        exist_ok=True)
+            with open(os.path.join(path, fname), 'wb') as afile:
+                afile.write(content)
+        os.symlink('node3.example.com/info', os.path.join(path, 'latest'))
+        os.symlink('../etc/hosts', os.path.join(path, 'var', 'hosts'))
+        tarpath = os.path.join(self.tmpdir, f'archive.tar.{compression}')
+        if compression == 'zst':
+            with open(tarpath, 'wb') as zfile:
+                with zstandard.ZstdCompressor().stream_writer(zfile) as _zw:
+                    with tarfile.open(fileobj=_zw, mode='w') as tar:
+                        tar.add(path, arcname='archive')
+        else:
+            with tarfile.open(tarpath, f'w:{compression}') as tar:
+                tar.add(path, arcname='archive')
+        shutil.rmtree(path)
+        return tarpath
+
+    def _clean(self, name, stream):
+        """Clean the archive in a forked process, so that every run starts
+        from the same state of the maps
+        """
+        def _run():
+            SoSHostnameMap.hosts.clear()
+            SoSHostnameMap._domains.clear()
+            SoSIPMap._networks.clear()
+            opts = SoSOptions(
+                domains=['example.com'], disable_parsers=[],
+                skip_cleaning_files=[], jobs=1, file_jobs=1, stream=stream,
+                keywords=[], keyword_file=None, usernames=[],
+                map_file=os.path.join(self.tmpdir, 'map'), no_update=True,
+                keep_binary_files=False, batch=True
+            )
+            manifest = SoSMetadata()
+            manifest.add_section('components')
+            tmpdir = os.path.join(self.tmpdir, name)
+            os.makedirs(tmpdir)
+            cleaner = SoSCleaner(in_place=True, hook_commons={
+                'options': opts,
+                'tmpdir': tmpdir,
+                'sys_tmp': self.tmpdir,
+                'policy': Mock(get_preferred_hash_name=lambda: 'sha256'),
+                'manifest': manifest
+            })
+            archive = TarballArchive(self.archive, tmpdir)
+            cleaner.report_paths = [archive]
+            cleaner.completed_reports = []
+            cleaner.preload_all_archives_into_maps()
+            cleaner.generate_parser_item_regexes()
+            cleaner.obfuscate_report(archive)
+            self.assertTrue(archive.final_archive_path.endswith(
+                self.archive.split('.tar')[-1]
+            ))
+            with open_tarfile(archive.final_archive_path, tmpdir) as tar:
+                tar.extractall(os.path.join(tmpdir, 'result'))
+
+        proc = multiprocessing.get_context('fork').Process(target=_run)
+        proc.start()
+        proc.join()
+        self.assertEqual(proc.exitcode, 0)
+        path = os.path.join(self.tmpdir, name, 'result')
+        contents = {}
+        for dirname, dirs, files in os.walk(path):
+            for fname in dirs + files:
+                fpath = os.path.join(dirname, fname)
+                if os.path.islink(fpath):
+                    contents[fpath[len(path):]] = os.readlink(fpath)
+                elif os.path.isfile(fpath):
+                    with open(fpath, 'rb') as cfile:
+                        content = cfile.read()
+                    # compressed files record when they were compressed
+                    if get_file_compression(fname):
+                        content = get_file_compression(fname).decompress(
+                            content
+                        )
+                    contents[fpath[len(path):]] = content
+                else:
+                    contents[fpath[len(path):]] = None
+        return contents
+
+    def test_stream_matches_extract(self):
+        extracted = self._clean('extract', False)
+        streamed = self._clean('stream', True)
+        self.assertEqual(extracted, streamed)
+        self.assertEqual(streamed['/archive/latest'],
+                         'host0.obfuscateddomain0.com/info')
+        self.assertIn(f'/archive/{self.long_dir}/host0.obfuscateddomain0.com',
+                      streamed)
+        self.assertIn('/archive/proc/kallsyms', streamed)
+        self.assertNotIn('/archive/var/data', streamed)
+        self.assertNotIn('/archive/var/dump.gz', streamed)
+        self.assertNotIn('/archive/var/log/binary.gz', streamed)
+        self.assertEqual(streamed['/archive/var/log/messages-1.gz'],
+                         b'obfuscatedword0 on host0.obfuscateddomain0.com\n')
+        self.assertEqual(streamed['/archive/var/log/messages-2.xz'],
+                         b'100.0.0.3 is up\n')
+        self.assertEqual(streamed['/archive/var/log/messages-3.bz2'],
+                         b'no secrets here\n')
+        for name, content in streamed.items():
+            self.assertNotIn('example.com', name)
+            if isinstance(content, bytes) and \
+                    not name.endswith('kallsyms'):
+                self.assertNotIn(b'secretword', content)
+
+    @unittest.skipIf(zstandard is None, 'zstandard module not available')
+    def test_zstd_archive(self):
+        expected = self._clean('gz', True)
+        os.remove(self.archive)
+        self.archive = self._make_archive('zst')
+        self.assertTrue(is_tarfile(self.archive))
+        self.assertEqual(self._clean('extract', False), expected)
+        self.assertEqual(self._clean('stream', True), expected)
+
+    def test_unreadable_member_left_out(self):
+        expected = self._clean('whole', True)
+        extractfile = tarfile.TarFile.extractfile
+
+        class FailingReader:
+            def __init__(self, fobj):
+                self.fobj = fobj
+
+            def read(self, size=-1):
+                if self.fobj.tell():
+                    raise OSError('unexpected end of data')
+                return self.fobj.read(4)
+
+        def _extractfile(tar, member):
+            if getattr(member, 'name', member).endswith('kallsyms'):
+                return FailingReader(extractfile(tar, member))
+            return extractfile(tar, member)
+
+        with patch.object(tarfile.TarFile, 'extractfile', _extractfile):
+            streamed = self._clean('stream', True)
+        del expected['/archive/proc/kallsyms']
+        self.assertEqual(streamed, expected)
+
+
+class ItemMatcherTests(unittest.TestCase):
+
+    lines = [
+        'foo-bar-baz and foo-bar',
+        'bar-baz_foo notfoo foo_ FOO-BAR',
+        'host1.example.com host1_example_com host1.example.company',
+        'xhost1 host1x host1.example host2.example.com',
+    ]
+
+    def setUp(self):
+        self.kw_parser = SoSKeywordParser(config={})
+        self.host_parser = SoSHostnameParser(config={})
+        for item in ('foo', 'foo-bar', 'bar-baz', 'foo-bar-baz'):
+            self.kw_parser.mapping.add(item)
+        for item in ('host1', 'host1.example.com', 'example.com',
+                     'host2.example.com'):
+            self.host_parser.mapping.add(item)
+
+    def _parse_every_regex(self, parser, line):
+        """The line as parsed by searching for every compiled regex in turn
+        """
+        count = 0
+        for item, reg in parser.mapping.compiled_regexes:
+            if reg.search(line):
+                line, _count = reg.subn(parser.mapping.get(item.lower()),
+                                        line)
+                count += _count
+        return line, count
+
+    def _check_parser(self, parser):
+        for line in self.lines:
+            self.assertEqual(
+                parser._parse_line_with_compiled_regexes(line),
+                self._parse_every_regex(parser, line)
+            )
+
+    def test_pending_items(self):
+        self.assertIsNone(self.kw_parser.mapping.matcher.regex)
+        self._check_parser(self.kw_parser)
+        self._check_parser(self.host_parser)
+
+    def test_built_matcher(self):
+        self.kw_parser.mapping.matcher.build()
+        self.host_parser.mapping.matcher.build()
+        self.assertEqual(self.kw_parser.mapping.matcher.pending, [])
+        self._check_parser(self.kw_parser)
+        self._check_parser(self.host_parser)
+
+    def test_recent_items(self):
+        mapping = self.kw_parser.mapping
+        for num in range(400):
+            mapping.add(f'filler{num}')
+        mapping.matcher.build()
+        for item in ('baz', 'bar-baz_foo', 'notfoo'):
+            mapping.add(item)
+        mapping.matcher.add_items([])
+        self.assertIsNotNone(mapping.matcher.recent_regex)
+        self.assertEqual(mapping.matcher.pending, [])
+        self._check_parser(self.kw_parser)
+
+    def test_longest_first(self):
+        self.kw_parser.mapping.matcher.build()
+        self.assertEqual(
+            [i[0] for i in self.kw_parser.mapping.matcher.find(
+                'foo foo-bar-baz')],
+            ['foo-bar-baz', 'foo-bar', 'bar-baz', 'foo']
+        )
+
+    def test_hostname_underscore_variant(self):
+        self.host_parser.mapping.matcher.build()
+        line = self.host_parser._parse_line_with_compiled_regexes(
+            'host1_example_com')[0]
+        self.assertNotIn('example', line)
+
+
+class MapIndexTests(unittest.TestCase):
+
+    def _load_parsers(self, config, index=None):
+        parsers = [SoSKeywordParser(config=config),
+                   SoSHostnameParser(config=config)]
+        for parser in parsers:
+            if index:
+                parser.mapping.load_regex_index(index[parser.map_file_key])
+            parser.generate_item_regexes()
+        return parsers
+
+    def test_index_matches_generated_regexes(self):
+        config = {
+            'keyword_map': {'foo': 'obfuscatedword0',
+                            'foo-bar': 'obfuscatedword1',
+                            'baz': 'obfuscatedword2'},
+            'hostname_map': {'example.com': 'obfuscateddomain0.com',
+                             'host1.example.com':
+                             'host0.obfuscateddomain0.com',
+                             'host1': 'host0', 'api': 'api'}
+        }
+        index = {
+            parser.map_file_key: parser.mapping.get_regex_index()
+            for parser in self._load_parsers(config)
+        }
+        # the index is saved as json
+        index = json.loads(json.dumps(index))
+        lines = ItemMatcherTests.lines + ['foo-bar baz host1_example_com']
+        for fresh, loaded in zip(self._load_parsers(config),
+                                 self._load_parsers(config, index)):
+            self.assertEqual(
+                [item for item, _ in loaded.mapping.compiled_regexes],
+                [item for item, _ in fresh.mapping.compiled_regexes]
+            )
+            self.assertEqual(loaded.mapping.matcher.pattern,
+                             fresh.mapping.matcher.pattern)
+            for line in lines:
+                self.assertEqual(loaded.parse_line(line),
+                                 fresh.parse_line(line))
+
+    def test_index_items_added_later(self):
+        config = {'keyword_map': {'foo': 'obfuscatedword0'}}
+        index = self._load_parsers(config)[0].mapping.get_regex_index()
+        parser = SoSKeywordParser(config=config)
+        parser.mapping.load_regex_index(index)
+        parser.mapping.add('foobar')
+        self.assertEqual(
+            parser.parse_line('foo and foobar')[0],
+            'obfuscatedword0 and obfuscatedword1'
+        )
+
+
+class ItemMatcherBenchmark(unittest.TestCase):
+    """Benchmark of matching lines against known items for maps of very
+    different sizes, showing that the time spent per line does not grow with
+    the number of items in the map.
+    """
+
+    line = ('Oct 18 10:00:01 localhost systemd[1]: Started Session 42 of user'
+            ' root, running node-{} on host for the cluster member')
+
+    def _lines_per_sec(self, items):
+        parser = SoSKeywordParser(config={})
+        for num in range(items):
+            parser.mapping.add(f'keyword{num}')
+        parser.mapping.matcher.build()
+        lines = [self.line.format(num) for num in range(2000)]
+        start = time.perf_counter()
+        for line in lines:
+            parser._parse_line_with_compiled_regexes(line)
+        return len(lines) / (time.perf_counter() - start)
+
+    def test_map_size(self):
+        small = self._lines_per_sec(100)
+        large = self._lines_per_sec(5000)
+        print(f"\nlines/s against known items: 100 items {small:.0f}, "
+              f"5000 items {large:.0f}")
+        self.assertGreater(large * 4, small)
+
+
+class ParserBenchmark(unittest.TestCase):
+    """Benchmark of the lines per second each parser discovers new items at,
+    over lines mixing the items the parsers look for with lines that contain
+    none of them, as found in a typical report.
+    """
+
+    lines = [
+        'Oct 18 10:00:01 localhost systemd[1]: Started Session {} of user',
+        'inet 10.{}.0.1/24 brd 10.0.0.255 scope global eth0',
+        'inet6 2001:db8::{}/64 scope global',
+        'link/ether 52:54:00:12:34:{:02x} brd ff:ff:ff:ff:ff:ff',
+        'nameserver ns{}.example.com',
+        'kernel: [ 0.000000] Linux version 6.{} (mockbuild@localhost)',
+        'Installed: python3-libs-3.9.{}-1.el9.x86_64',
+        'no items on this line, number {}',
+    ]
+
+    def _lines_per_sec(self, parser, lines):
+        start = time.perf_counter()
+        for line in lines:
+            parser.parse_line(line)
+        return len(lines) / (time.perf_counter() - start)
+
+    def test_parser_lines_per_sec(self):
+        lines = [
+            line.format(num % 50) for num in range(250)
+            for line in self.lines
+        ]
+        host_parser = SoSHostnameParser(config={})
+        host_parser.mapping.add('example.com')
+        rates = []
+        for parser in (SoSIPParser(config={}), SoSIPv6Parser(config={}),
+                       SoSMacParser(config={}), host_parser):
+            rate = self._lines_per_sec(parser, lines)
+            rates.append(f"{parser.name} {rate:.0f}")
+            self.assertGreater(parser.lines_rejected, 0)
+        print(f"\nparser lines/s: {', '.join(rates)}")
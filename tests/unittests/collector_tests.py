@@ -0,0 +1,546 @@
+# This file is part of the sos project: https://github.com/sosreport/sos
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# version 2 of the GNU General Public License.
+#
+# See the LICENSE file in the source distribution for further information.
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from argparse import Namespace
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from sos.collector import SoSCollector, sosnode
+from sos.collector.clusters.jbon import jbon
+from sos.collector.orchestrator import NodeOrchestrator
+from sos.collector.sosnode import SosNode
+from sos.collector.transfers import RateLimiter, Transfer, TransferScheduler
+from sos.collector.transports import RemoteTransport
+from sos.collector.transports.local import LocalTransport
+from sos.component import SoSComponent, SoSMetadata
+from sos.policies import load
+
+
+class MockCmdLineOpts(object):
+    ssh_user = "root"
+    sudo_pw = None
+    root_password = None
+    become_root = False
+    transfer_chunk_size = 1
+    transfer_jobs = 1
+
+
+class FlakyTransport(LocalTransport):
+    """Fails to read, or corrupts, the given chunks the first time"""
+
+    max_chunk_size = None
+
+    def __init__(self, address, commons, failures):
+        super().__init__(address, commons)
+        self.failures = failures
+        self.requested = []
+
+    def _retrieve_range(self, fname, offset, length):
+        self.requested.append(offset)
+        failure = self.failures.pop(offset // length, None)
+        if failure == 'error':
+            raise OSError('connection reset')
+        data = super()._retrieve_range(fname, offset, length)
+        if failure == 'corrupt':
+            return data[:-1] + b'x'
+        return data
+
+
+class SimulatedTransport(RemoteTransport):
+    """Simulates a RHEL node with sos installed, without connecting to
+    anything, so that collecting from many nodes can be tested or benchmarked.
+    Every command takes ``latency`` seconds, sos report takes ``run_time``
+    seconds, unless set otherwise for the node in ``run_times``, and
+    retrieving the archive takes ``transfer_time`` seconds.
+    """
+
+    name = 'simulated'
+    latency = 0
+    run_time = 0
+    transfer_time = 0
+    run_times = {}
+    lock = threading.Lock()
+    running = {'exec': 0, 'retrieve': 0}
+    peak = {'exec': 0, 'retrieve': 0}
+    retrieved = []
+    outputs = {
+        'cat /etc/os-release': 'NAME="Red Hat Enterprise Linux"\nID="rhel"\n'
+                               'VERSION_ID="9.4"\n',
+        sosnode.RpmPackageManager.query_command: 'sos|4.9.0|1.el9\n',
+    }
+
+    @property
+    def connected(self):
+        return True
+
+    def _connect(self, password):
+        time.sleep(self.latency)
+        return True
+
+    def _disconnect(self):
+        return True
+
+    @classmethod
+    def _track(cls, phase, seconds):
+        with cls.lock:
+            cls.running[phase] += 1
+            cls.peak[phase] = max(cls.peak[phase], cls.running[phase])
+        time.sleep(seconds)
+        with cls.lock:
+            cls.running[phase] -= 1
+
+    def run_command(self, cmd, timeout=180, need_root=False, env=None,
+                    use_shell='auto'):
+        time.sleep(self.latency)
+        if sosnode.PROBE_MARKER in cmd:
+            res = {
+                _cmd: {'status': 0, 'output': out}
+                for _cmd, out in self.outputs.items()
+            }
+            return {'status': 0,
+                    'output': sosnode.PROBE_MARKER + json.dumps(res)}
+        if cmd == 'hostname':
+            return {'status': 0, 'output': self.address}
+        if cmd in self.outputs:
+            return {'status': 0, 'output': self.outputs[cmd]}
+        if 'report --batch' in cmd:
+            self._track('exec', self.run_times.get(self.address,
+                                                   self.run_time))
+            checksum = hashlib.sha256(self.address.encode()).hexdigest()
+            archive = f"/var/tmp/sosreport-{self.address}-2026-10-18.tar.xz"
+            return {'status': 0,
+                    'output': f"{archive}\n sha256\t{checksum}\n"}
+        return {'status': 0, 'output': ''}
+
+    def retrieve_file(self, fname, dest, checksum=None):
+        self._track('retrieve', self.transfer_time)
+        with self.lock:
+            self.retrieved.append(self.address)
+        with open(dest, 'w') as archive:
+            archive.write(self.address)
+        return True
+
+
+class DdTransport(LocalTransport):
+    """Reads chunks with dd, as remote transports do by default"""
+
+    max_chunk_size = None
+    _retrieve_range = RemoteTransport._retrieve_range
+
+
+class RemoteFileStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fifo = os.path.join(self.tmpdir, 'archive')
+        os.mkfifo(self.fifo)
+        self.dest = os.path.join(self.tmpdir, 'received')
+        self.transport = LocalTransport('localhost', {
+            'cmdlineopts': MockCmdLineOpts,
+            'tmpdir': self.tmpdir,
+            'need_sudo': False
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_stream_fifo(self):
+        data = os.urandom(1 << 16) * 40
+        stream = self.transport.stream_file(self.fifo, self.dest)
+
+        def write():
+            with open(self.fifo, 'wb') as fifo:
+                for i in range(0, len(data), 1 << 20):
+                    fifo.write(data[i:i + (1 << 20)])
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        self.assertTrue(stream.wait(30))
+        writer.join()
+        self.assertEqual(stream.size, len(data))
+        self.assertEqual(stream.hexdigest(),
+                         hashlib.sha256(data).hexdigest())
+        with open(self.dest, 'rb') as received:
+            self.assertEqual(received.read(), data)
+
+    def test_cancel_without_writer(self):
+        # nothing ever opens the FIFO for writing
+        stream = self.transport.stream_file(self.fifo, self.dest)
+        self.assertFalse(stream.wait(0.5))
+        self.assertIsNotNone(stream.proc.returncode)
+
+
+class ChunkedRetrieveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = os.urandom(1 << 16) * 56
+        self.src = os.path.join(self.tmpdir, 'sosreport-node.tar.xz')
+        with open(self.src, 'wb') as src:
+            src.write(self.data)
+        self.checksum = hashlib.sha256(self.data).hexdigest()
+        self.dest = os.path.join(self.tmpdir, 'received')
+        self.opts = type('opts', (MockCmdLineOpts, ), {})
+        self.commons = {
+            'cmdlineopts': self.opts,
+            'tmpdir': self.tmpdir,
+            'need_sudo': False
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _received(self):
+        with open(self.dest, 'rb') as received:
+            return received.read()
+
+    def test_chunk_checksums(self):
+        transport = LocalTransport('localhost', self.commons)
+        checksums = transport._get_chunk_checksums(self.src, len(self.data),
+                                                   1 << 20)
+        self.assertEqual(len(checksums), 4)
+        self.assertEqual(checksums[3],
+                         hashlib.sha256(self.data[3 << 20:]).hexdigest())
+
+    def test_resume_failed_chunks(self):
+        transport = FlakyTransport('localhost', self.commons,
+                                   {1: 'error', 2: 'corrupt'})
+        self.assertTrue(transport.retrieve_file(self.src, self.dest,
+                                                self.checksum))
+        self.assertEqual(self._received(), self.data)
+        # only the failed chunks are fetched again
+        self.assertEqual(transport.requested,
+                         [0, 1 << 20, 2 << 20, 3 << 20, 1 << 20, 2 << 20])
+
+    def test_parallel_chunks(self):
+        self.opts.transfer_jobs = 3
+        transport = FlakyTransport('localhost', self.commons, {3: 'error'})
+        self.assertTrue(transport.retrieve_file(self.src, self.dest,
+                                                self.checksum))
+        self.assertEqual(self._received(), self.data)
+
+    def test_checksum_mismatch(self):
+        transport = LocalTransport('localhost', self.commons)
+        self.assertFalse(transport.retrieve_file(self.src, self.dest,
+                                                 '0' * 64))
+
+    def test_rate_limited_chunks(self):
+        transport = DdTransport('localhost', self.commons)
+        transport.limiter = Transfer('localhost', [RateLimiter(8 << 20)])
+        start = time.monotonic()
+        self.assertTrue(transport.retrieve_file(self.src, self.dest,
+                                                self.checksum))
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        self.assertEqual(transport.limiter.transferred, len(self.data))
+        self.assertEqual(self._received(), self.data)
+
+    def test_small_file_chunked_when_limited(self):
+        self.opts.transfer_chunk_size = 4
+        transport = FlakyTransport('localhost', self.commons, {})
+        transport.limiter = Transfer('localhost')
+        self.assertTrue(transport.retrieve_file(self.src, self.dest,
+                                                self.checksum))
+        self.assertEqual(transport.requested, [0])
+        self.assertEqual(self._received(), self.data)
+
+    def test_local_file_copied_whole(self):
+        transport = LocalTransport('localhost', self.commons)
+        with patch.object(transport, '_get_chunk_checksums') as checksums:
+            self.assertTrue(transport.retrieve_file(self.src, self.dest,
+                                                    self.checksum))
+        checksums.assert_not_called()
+        self.assertEqual(self._received(), self.data)
+
+    def test_small_file_copied_whole(self):
+        self.opts.transfer_chunk_size = 4
+        transport = FlakyTransport('localhost', self.commons, {})
+        self.assertTrue(transport.retrieve_file(self.src, self.dest,
+                                                self.checksum))
+        self.assertEqual(transport.requested, [])
+        self.assertEqual(self._received(), self.data)
+
+
+class SosNodeProbeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.node = SosNode.__new__(SosNode)
+        self.node.address = 'node1'
+        self.node.hostname = 'node1'
+        self.node.hostlen = 5
+        self.node.local = False
+        self.node.host = None
+        self.node.need_sudo = False
+        self.node.opts = MockCmdLineOpts
+        self.node.soslog = logging.getLogger('sos')
+        self.node._probed = {}
+        self.node._transport = LocalTransport('node1', {
+            'cmdlineopts': MockCmdLineOpts,
+            'tmpdir': self.tmpdir,
+            'need_sudo': False
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_probe_node(self):
+        self.assertTrue(self.node.probe_node(load_facts=False))
+        self.assertIn('cat /etc/os-release', self.node._probed)
+        with open('/etc/os-release', 'r') as osrel:
+            self.assertEqual(self.node.read_file('/etc/os-release'),
+                             osrel.read())
+        # commands are not found on every node, which is still a result
+        self.assertIn('snap list', self.node._probed)
+
+    def test_probed_result_used_once(self):
+        self.node._probed = {'echo probe': {'status': 0, 'output': 'cached'}}
+        self.assertEqual(self.node.run_command('echo probe')['output'],
+                         'cached')
+        self.assertEqual(self.node.run_command('echo probe')['output'],
+                         'probe\r\n')
+
+    def test_probe_without_python(self):
+        with patch.object(sosnode, 'PROBE_PYTHONS', ['/nonexistent/python']):
+            self.assertFalse(self.node.probe_node(load_facts=False))
+        self.assertEqual(self.node._probed, {})
+
+
+class TransferSchedulerTest(unittest.TestCase):
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(4 << 20)
+        start = time.monotonic()
+        for _ in range(4):
+            limiter.consume(256 << 10)
+        # all but the initial burst is limited to 4MiB/s
+        self.assertGreaterEqual(time.monotonic() - start, 0.14)
+
+    def _retrieve_in_order(self, order, sizes):
+        scheduler = TransferScheduler(1, order=order)
+        retrieved = []
+
+        def _retrieve(size):
+            with scheduler.transfer(f"node-{size}", size) as transfer:
+                retrieved.append(size)
+                transfer.finish(size)
+
+        with scheduler.transfer('first'):
+            threads = []
+            for size in sizes:
+                threads.append(threading.Thread(target=_retrieve,
+                                                args=(size, )))
+                threads[-1].start()
+                # make sure the threads queue up in this order
+                while len(scheduler._waiting) < len(threads):
+                    time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        return scheduler, retrieved
+
+    def test_completion_order(self):
+        _, retrieved = self._retrieve_in_order('completion', [5, 3, 4, 1])
+        self.assertEqual(retrieved, [5, 3, 4, 1])
+
+    def test_size_order(self):
+        scheduler, retrieved = self._retrieve_in_order('size', [5, 3, 4, 1])
+        self.assertEqual(retrieved, [1, 3, 4, 5])
+        metrics = scheduler.get_metrics()
+        self.assertEqual(metrics['archives'], 4)
+        self.assertEqual(metrics['bytes'], 13)
+        self.assertEqual(metrics['peak_concurrent'], 1)
+
+    def test_held_turn(self):
+        scheduler = TransferScheduler(1)
+        with scheduler.transfer('node0', waited=1.5) as transfer:
+            self.assertEqual(scheduler.active, 1)
+            self.assertFalse(scheduler._waiting)
+        self.assertEqual(transfer.get_metrics()['wait_time'], 1.5)
+        self.assertEqual(scheduler.active, 0)
+        self.assertEqual(scheduler.get_metrics()['peak_concurrent'], 1)
+
+
+class SosNodeStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.node = SosNode.__new__(SosNode)
+        self.node.address = 'node1'
+        self.node.hostname = 'node1'
+        self.node.hostlen = 5
+        self.node.local = True
+        self.node.host = SimpleNamespace(containerized=False)
+        self.node.opts = MockCmdLineOpts
+        self.node.soslog = logging.getLogger('sos')
+        self.node.ui_log = logging.getLogger('sos_ui')
+        self.node.commons = {}
+        self.node.tmpdir = self.tmpdir
+        self.node.file_list = []
+        self.node.sos_bin = 'sos report'
+        self.node.sos_path = '/var/tmp/sosreport-node1.tar.xz'
+        self.node.stream = True
+        self.node.archive_saved = False
+        self.node._transport = LocalTransport('node1', {
+            'cmdlineopts': MockCmdLineOpts,
+            'tmpdir': self.tmpdir,
+            'need_sudo': False
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_stream_needs_stream_to_option(self):
+        helps = {
+            'usage: sos report [options]\n  --stream-to FILE': True,
+            'usage: sos report [options]\n  --batch': False
+        }
+        for output, supported in helps.items():
+            with patch.object(self.node, 'run_command',
+                              return_value={'status': 0, 'output': output}):
+                self.assertEqual(self.node._can_stream_archive(), supported)
+
+    def test_saved_archive_is_copied(self):
+        stream = SimpleNamespace(size=0)
+        with patch.object(self.node, 'make_stream_fifo',
+                          return_value='/var/tmp/sos-stream/archive'), \
+                patch.object(self.node, '_receive_stream',
+                             return_value=(True, stream)), \
+                patch.object(self.node, 'retrieve_sosreport',
+                             return_value=True) as retrieve:
+            self.node.archive_saved = True
+            self.assertTrue(self.node.stream_sosreport())
+        retrieve.assert_called_once()
+        # so that cleanup() removes the archive from the node
+        self.assertFalse(self.node.stream)
+
+    def test_empty_stream_is_copied(self):
+        stream = SimpleNamespace(size=0)
+        with patch.object(self.node, 'make_stream_fifo',
+                          return_value='/var/tmp/sos-stream/archive'), \
+                patch.object(self.node, '_receive_stream',
+                             return_value=(True, stream)), \
+                patch.object(self.node, 'retrieve_sosreport',
+                             return_value=False) as retrieve:
+            self.assertFalse(self.node.stream_sosreport())
+        retrieve.assert_called_once()
+
+
+class NodeOrchestratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        opts = Namespace(**{**SoSComponent._arg_defaults,
+                            **SoSCollector.arg_defaults})
+        opts.transport = 'simulated'
+        opts.sudo_pw = opts.root_password = None
+        self.commons = {
+            'cmdlineopts': opts,
+            'tmpdir': self.tmpdir,
+            'hostlen': 6,
+            'need_sudo': False,
+            'sos_options': {},
+            'policy': load(sysroot=None),
+            'sos_cmd': 'sos report --batch'
+        }
+        self.cluster = jbon(self.commons)
+        self.cluster.primary = SimpleNamespace(address='primary')
+        SimulatedTransport.running = {'exec': 0, 'retrieve': 0}
+        SimulatedTransport.peak = {'exec': 0, 'retrieve': 0}
+        SimulatedTransport.retrieved = []
+        SimulatedTransport.run_times = {}
+        self.transports = patch.dict(sosnode.TRANSPORTS,
+                                     {'simulated': SimulatedTransport})
+        self.transports.start()
+
+    def tearDown(self):
+        self.transports.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _connect(self, node):
+        if node[0].startswith('down'):
+            return None
+        client = SosNode(node[0], self.commons)
+        client.set_cluster(self.cluster)
+        client.set_node_manifest(SoSMetadata())
+        return client
+
+    def _nodes(self, num, prefix='node'):
+        return [(f"{prefix}{i}", None) for i in range(num)]
+
+    def test_collect_within_limits(self):
+        orchestrator = NodeOrchestrator(self._connect, connect_jobs=4,
+                                        exec_jobs=3, retrieve_jobs=2)
+        with patch.multiple(SimulatedTransport, run_time=0.02,
+                            transfer_time=0.01):
+            clients = orchestrator.run(self._nodes(30) + self._nodes(3,
+                                                                     'down'))
+        self.assertEqual(len(clients), 30)
+        self.assertEqual(orchestrator.retrieved, 30)
+        self.assertTrue(all(c.retrieved for c in clients))
+        self.assertLessEqual(SimulatedTransport.peak['exec'], 3)
+        self.assertLessEqual(SimulatedTransport.peak['retrieve'], 2)
+
+    def test_slow_node_does_not_hold_back_others(self):
+        SimulatedTransport.run_times = {'node0': 1}
+        orchestrator = NodeOrchestrator(self._connect, connect_jobs=2,
+                                        exec_jobs=2, retrieve_jobs=1)
+        with patch.object(SimulatedTransport, 'run_time', 0.01):
+            orchestrator.run(self._nodes(20))
+        self.assertEqual(len(SimulatedTransport.retrieved), 20)
+        self.assertEqual(SimulatedTransport.retrieved[-1], 'node0')
+
+    def test_transfer_metrics(self):
+        transfers = TransferScheduler(2, order='size', node_rate=1 << 20)
+        self.commons['transfers'] = transfers
+        orchestrator = NodeOrchestrator(self._connect, retrieve_jobs=2,
+                                        transfers=transfers)
+        clients = orchestrator.run(self._nodes(5))
+        self.assertEqual(orchestrator.retrieved, 5)
+        for client in clients:
+            self.assertEqual(client.manifest.transfer['bytes'],
+                             len(client.address))
+            self.assertEqual(client.manifest.transfer['rate_limit'], 1 << 20)
+        self.assertEqual(transfers.get_metrics()['archives'], 5)
+        self.assertLessEqual(transfers.get_metrics()['peak_concurrent'], 2)
+
+    def test_retrieve_turn_given_once(self):
+        transfers = TransferScheduler(1)
+        self.commons['transfers'] = transfers
+        orchestrator = NodeOrchestrator(self._connect, retrieve_jobs=1,
+                                        transfers=transfers)
+        with patch.object(SimulatedTransport, 'transfer_time', 0.05), \
+                patch.object(TransferScheduler, 'sort_key',
+                             wraps=transfers.sort_key) as sort_key:
+            clients = orchestrator.run(self._nodes(4))
+        # one key for the orchestrator's queue, none for the scheduler's
+        self.assertEqual(sort_key.call_count, 4)
+        self.assertEqual(transfers.get_metrics()['peak_concurrent'], 1)
+        # the nodes did wait for their turn, behind the retrieval in progress
+        self.assertGreater(
+            max(c.manifest.transfer['wait_time'] for c in clients), 0.04
+        )
+
+    def test_local_node_skipped_without_other_nodes(self):
+        local = SimpleNamespace(local=True, log_debug=lambda msg: None)
+        orchestrator = NodeOrchestrator(self._connect)
+        self.assertEqual(orchestrator.run(self._nodes(2, 'down'), [local]),
+                         [])
+        self.assertEqual(orchestrator.run([], [local]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: set et ts=4 sw=4 :
@@ -10,14 +10,18 @@ import os
 import tempfile
 import shutil
 import random
+import threading
 
 from io import StringIO
 from string import ascii_lowercase
+from unittest.mock import Mock
+from sos.report import SoSReport
 from sos.report.plugins import (Plugin, regex_findall,
-                                _mangle_command, PluginOpt)
-from sos.archive import TarFileArchive
+                                _mangle_command, PluginOpt, SoSCommand)
+from sos.archive import TarFileArchive, FileCacheArchive
 from sos.policies.distros import LinuxPolicy
 from sos.policies.init_systems import InitSystem
+from sos.component import SoSMetadata
 
 PATH = os.path.dirname(__file__)
 
@@ -59,6 +63,9 @@ class MockArchive(TarFileArchive):
     def open_file(self, name):
         return open(self.m.get(name), 'r')
 
+    def name_max(self):
+        return 255
+
     def close(self):
         pass
 
@@ -325,6 +332,175 @@ class PluginTests(unittest.TestCase):
         self.assertEqual(p.default_environment['TORVALDS'], 'Linus')
 
 
+class CmdBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.mp = MockPlugin({
+            'cmdlineopts': MockOptions(),
+            'policy': LinuxPolicy(init=InitSystem(), probe_runtime=False),
+            'sysroot': os.getcwd(),
+            'devices': {}
+        })
+        self.mp.archive = MockArchive()
+
+    def add_cmd(self, cmd, priority=10, changes=False, **kwargs):
+        self.mp.collect_cmds.append(
+            SoSCommand(cmd=cmd, priority=priority, changes=changes, **kwargs)
+        )
+
+    def get_batches(self):
+        self.mp.collect_cmds.sort(key=lambda x: x.priority)
+        return [[c.cmd for c in b] for b in self.mp._get_cmd_batches()]
+
+    def test_serial_without_budget(self):
+        self.mp.cmd_workers = 4
+        self.assertEqual(self.mp._get_cmd_workers(), 1)
+
+    def test_workers_bound_by_budget(self):
+        self.mp.cmd_workers = 8
+        self.mp.commons['cmd_budget'] = True
+        self.mp.commons['cmd_threads'] = 2
+        self.assertEqual(self.mp._get_cmd_workers(), 2)
+
+    def test_batches_split_by_priority(self):
+        self.add_cmd('foo', priority=1)
+        self.add_cmd('bar', priority=1)
+        self.add_cmd('baz', priority=5)
+        self.assertEqual(self.get_batches(), [['foo', 'bar'], ['baz']])
+
+    def test_batches_isolate_changes(self):
+        self.add_cmd('foo')
+        self.add_cmd('bar', changes=True)
+        self.add_cmd('baz')
+        self.assertEqual(self.get_batches(), [['foo'], ['bar'], ['baz']])
+
+    def test_batches_split_on_filename_collision(self):
+        self.add_cmd('foo')
+        self.add_cmd('bar', suggest_filename='foo')
+        self.add_cmd('foo', subdir='sub')
+        self.assertEqual(self.get_batches(), [['foo'], ['bar', 'foo']])
+
+    def test_parallel_results_in_queue_order(self):
+        opts = self.mp.commons['cmdlineopts']
+        opts.cmd_timeout = opts.plugin_timeout = 300
+        opts.chroot = 'auto'
+        opts.cmd_output = 'memory'
+        self.mp.set_plugin_manifest(SoSMetadata())
+        self.mp.commons['cmddir'] = 'sos_commands'
+        self.mp.commons['cmd_budget'] = threading.BoundedSemaphore(4)
+        self.mp.commons['cmd_threads'] = 4
+        cmds = ['sleep 0.3', 'sleep 0.2', 'sleep 0.1', 'true']
+        for cmd in cmds:
+            self.add_cmd(cmd)
+        self.mp._collect_cmds_parallel(4)
+        self.assertEqual([c['cmd'] for c in self.mp.executed_commands], cmds)
+        self.assertEqual(
+            [c['exec'] for c in self.mp.manifest.commands], cmds
+        )
+
+
+class CmdOutputModeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.opts = MockOptions()
+        self.opts.cmd_timeout = 300
+        self.opts.chroot = 'auto'
+        self.opts.cmd_output = 'stream'
+        policy = LinuxPolicy(init=InitSystem(), probe_runtime=False)
+        self.mp = MockPlugin({
+            'cmdlineopts': self.opts,
+            'policy': policy,
+            'sysroot': '/',
+            'cmddir': 'sos_commands',
+            'devices': {}
+        })
+        self.mp.archive = FileCacheArchive('test', self.tmpdir, policy, 1,
+                                           None, '/')
+        self.root = self.mp.archive.get_archive_path()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_mode_selection(self):
+        self.assertTrue(self.mp.stream_cmd_output)
+        self.opts.cmd_output = 'memory'
+        self.assertFalse(self.mp.stream_cmd_output)
+        self.mp.set_option('cmd-output', 'stream')
+        self.assertTrue(self.mp.stream_cmd_output)
+
+    def test_stream_output_returned(self):
+        res = self.mp.collect_cmd_output('echo streamed')
+        self.assertEqual(res['output'], 'streamed\n')
+        with open(res['filename'], 'r') as cfile:
+            self.assertEqual(cfile.read(), 'streamed\n')
+
+    def test_stream_tailed_on_disk(self):
+        res = self.mp.collect_cmd_output('seq 1 400000', sizelimit=1)
+        self.assertTrue(res['truncated'])
+        self.assertEqual(os.path.getsize(res['filename']), 1048576)
+        self.assertTrue(res['output'].endswith('399999\n400000\n'))
+        link = os.path.join(self.root, 'sos_commands/mockplugin/seq_1_400000')
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(os.path.realpath(link),
+                         os.path.realpath(res['filename']))
+
+    def test_stream_output_sub(self):
+        self.mp.collect_cmd_output('echo secret')
+        self.mp.do_cmd_output_sub('echo', 'secret', '******')
+        with open(os.path.join(self.root,
+                               'sos_commands/mockplugin/echo_secret')) as f:
+            self.assertEqual(f.read(), '******\n')
+
+    def test_stream_matches_memory_for_invalid_utf8(self):
+        cmd = r"printf 'caf\303\251 \377\376 done\n'"
+        streamed = self.mp.collect_cmd_output(cmd, suggest_filename='stream')
+        self.opts.cmd_output = 'memory'
+        memory = self.mp.collect_cmd_output(cmd, suggest_filename='memory')
+        with open(streamed['filename'], 'rb') as sfile:
+            content = sfile.read()
+        with open(memory['filename'], 'rb') as mfile:
+            self.assertEqual(content, mfile.read())
+        self.assertEqual(content, 'caf\u00e9  done\n'.encode('utf-8'))
+
+
+class TailedFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        policy = LinuxPolicy(init=InitSystem(), probe_runtime=False)
+        self.mp = MockPlugin({
+            'cmdlineopts': MockOptions(),
+            'policy': policy,
+            'sysroot': '/',
+            'cmddir': 'sos_commands',
+            'devices': {}
+        })
+        self.mp.manifest = SoSMetadata()
+        self.mp.manifest.add_field('strings', {})
+        self.mp.archive = FileCacheArchive('test', self.tmpdir, policy, 1,
+                                           None, '/')
+        self.root = self.mp.archive.get_archive_path()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_tail_collected(self):
+        fname = create_file(2, dir=self.tmpdir)
+        self.mp._tail_files_list.append((fname, 1048576))
+        self.mp._collect_tailed_files()
+        strfile = fname.lstrip('/').replace('/', '.') + '.tailed'
+        with open(fname, 'rb') as ofile:
+            ofile.seek(-1048576, 2)
+            expected = ofile.read()
+        with open(os.path.join(self.root, 'sos_strings', 'mockplugin',
+                               strfile), 'rb') as tfile:
+            self.assertEqual(tfile.read(), expected)
+        self.assertTrue(os.path.islink(os.path.join(self.root,
+                                                    fname.lstrip('/'))))
+        self.assertIn(strfile.replace('.', '_'), self.mp.manifest.strings)
+
+
 class AddCopySpecTests(unittest.TestCase):
 
     expect_paths = set(['tests/unittests/tail_test.txt'])
@@ -470,6 +646,49 @@ class RegexSubTests(unittest.TestCase):
         self.assertEqual(1, replacements)
         self.assertTrue("foobar" in self.mp.archive.m.get(j('tail_test.txt')))
 
+    def test_batched_replacements(self):
+        self.mp.sysroot = '/'
+        writes = []
+        self.mp.archive.add_string = lambda c, d: writes.append((d, c))
+        self.mp.batch_file_subs()
+        # substitutions may be queued before the file is collected
+        self.assertEqual(0, self.mp.do_file_sub(
+            j("tail_test.txt"), r"(tail)", "foobar"))
+        self.mp.add_copy_spec(j("tail_test.txt"))
+        self.mp.collect_plugin()
+        self.assertEqual(0, self.mp.do_path_regex_sub(
+            r".*tail_test.txt", r"^this is the last line$", "redacted"))
+        self.mp.do_file_sub(j("tail_test.txt"), r"wont_match", "foobar")
+        self.assertEqual([], writes)
+        self.assertEqual(2, self.mp.apply_file_subs())
+        self.assertEqual(1, len(writes))
+        self.assertEqual(writes[0][0], j("tail_test.txt"))
+        self.assertIn("foobar", writes[0][1])
+        self.assertTrue(writes[0][1].endswith("redacted\n"))
+        # batching stops once the queue has been applied
+        self.assertEqual(1, self.mp.do_file_sub(
+            j("tail_test.txt"), r"(mess)", "foobar"))
+
+    def test_batched_replacements_applied_on_postproc_error(self):
+        self.mp.sysroot = '/'
+        writes = []
+        self.mp.archive.add_string = lambda c, d: writes.append((d, c))
+        self.mp.add_copy_spec(j("tail_test.txt"))
+        self.mp.collect_plugin()
+        self.mp.batch_file_subs()
+
+        def _postproc():
+            self.mp.do_file_sub(j("tail_test.txt"), r"(tail)", "foobar")
+            raise ValueError("postproc failed")
+
+        self.mp.postproc = _postproc
+        report = Mock()
+        SoSReport._postproc_plugin(report, 'mockplugin', self.mp)
+        report.handle_exception.assert_called_once_with('mockplugin',
+                                                        'postproc')
+        self.assertEqual(1, len(writes))
+        self.assertIn("foobar", writes[0][1])
+
 
 if __name__ == "__main__":
     unittest.main()
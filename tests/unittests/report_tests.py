@@ -5,6 +5,9 @@
 # version 2 of the GNU General Public License.
 #
 # See the LICENSE file in the source distribution for further information.
+import os
+import shutil
+import tempfile
 import unittest
 
 try:
@@ -14,6 +17,7 @@ except ImportError:
 
 from sos.report.reporting import (Report, Section, Command, CopiedFile,
                                   CreatedFile, Alert, PlainTextReport)
+from sos.report.scheduler import PluginScheduler
 
 
 class ReportTest(unittest.TestCase):
@@ -149,6 +153,64 @@ class TestPlainReport(unittest.TestCase):
             PlainTextReport(self.report).unicode())
 
 
+class MockSchedPlugin():
+
+    def __init__(self, cmds=0, files=0):
+        self.collect_cmds = [None] * cmds
+        self.copy_paths = set(range(files))
+        self._tail_files_list = []
+        self.copy_strings = []
+
+
+class PluginSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'history.json')
+        self.loaded = [
+            ('alpha', MockSchedPlugin(cmds=1)),
+            ('beta', MockSchedPlugin(cmds=20)),
+            ('gamma', MockSchedPlugin(files=5))
+        ]
+        self.pluglist = [(1, 'alpha'), (2, 'beta'), (3, 'gamma')]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_static_order(self):
+        sched = PluginScheduler(path=self.path)
+        self.assertEqual(
+            [p[1] for p in sched.order(self.pluglist, self.loaded)],
+            ['beta', 'alpha', 'gamma']
+        )
+
+    def test_history_order(self):
+        sched = PluginScheduler(path=self.path)
+        sched.record('gamma', 120)
+        sched.record('alpha', 2)
+        sched.write_history()
+        sched = PluginScheduler(path=self.path)
+        self.assertEqual(sched.history['gamma'], 120)
+        self.assertEqual(
+            [p[1] for p in sched.order(self.pluglist, self.loaded)],
+            ['gamma', 'beta', 'alpha']
+        )
+
+    def test_history_smoothing(self):
+        sched = PluginScheduler(path=self.path)
+        sched.record('alpha', 10)
+        sched.write_history()
+        sched = PluginScheduler(path=self.path)
+        sched.record('alpha', 20)
+        sched.write_history()
+        self.assertEqual(PluginScheduler(path=self.path).history['alpha'], 15)
+
+    def test_bad_history_ignored(self):
+        with open(self.path, 'w') as hfile:
+            hfile.write('not json')
+        self.assertEqual(PluginScheduler(path=self.path).history, {})
+
+
 if __name__ == "__main__":
     unittest.main()
 
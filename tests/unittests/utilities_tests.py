@@ -5,14 +5,23 @@
 # version 2 of the GNU General Public License.
 #
 # See the LICENSE file in the source distribution for further information.
-import os.path
+import io
+import os
+import shutil
+import subprocess
+import errno
+import tempfile
+import time
 import unittest
+from unittest import mock
 
 # PYCOMPAT
 from io import StringIO
 
+from sos import utilities
 from sos.utilities import (grep, is_executable, sos_get_command_output,
-                           find, tail, shell_out)
+                           find, tail, shell_out, SoSTimeoutError,
+                           AsyncReader, TailedFileWriter, copy_file)
 
 TEST_DIR = os.path.dirname(__file__)
 
@@ -84,6 +93,216 @@ class ExecutableTest(unittest.TestCase):
     def test_shell_out(self):
         self.assertEqual("executed\n", shell_out('echo executed'))
 
+    def test_output_timeout(self):
+        result = sos_get_command_output("sleep 10", timeout=1)
+        self.assertEqual(result['status'], 124)
+
+    def test_output_poller_timeout(self):
+        start = time.monotonic()
+        with self.assertRaises(SoSTimeoutError):
+            sos_get_command_output(
+                "sleep 10", poller=lambda: time.monotonic() - start > 0.2
+            )
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_output_sizelimit(self):
+        result = sos_get_command_output("seq 1 1000000", sizelimit=1)
+        self.assertTrue(result['truncated'])
+        self.assertTrue(result['output'].endswith("999999\n1000000\n"))
+
+
+class AsyncReaderTest(unittest.TestCase):
+
+    def _read(self, data, sizelimit=None, binary=False, stream=None):
+        rfd, wfd = os.pipe()
+        with os.fdopen(rfd, 'rb') as chan:
+            reader = AsyncReader(chan, sizelimit, binary, stream=stream)
+            # write in pieces that do not line up with the ring buffer size
+            for idx in range(0, len(data), 3000):
+                os.write(wfd, data[idx:idx + 3000])
+                reader.read()
+            os.close(wfd)
+            while reader.read():
+                pass
+        return reader
+
+    def test_no_limit(self):
+        reader = self._read(b'abc' * 10000)
+        self.assertFalse(reader.is_full)
+        self.assertEqual(reader.get_contents(), 'abc' * 10000)
+
+    def test_exact_limit_not_truncated(self):
+        reader = self._read(b'a' * 1048576, sizelimit=1, binary=True)
+        self.assertFalse(reader.is_full)
+        self.assertEqual(len(reader.get_contents()), 1048576)
+
+    def test_truncated_keeps_last_bytes(self):
+        data = bytes(range(256)) * 5000
+        reader = self._read(data, sizelimit=1, binary=True)
+        self.assertTrue(reader.is_full)
+        self.assertEqual(reader.get_contents(), data[-1048576:])
+
+    def test_multibyte_decoded_once(self):
+        data = ('\u00e9' * 600000).encode('utf-8')
+        reader = self._read(data, sizelimit=1)
+        self.assertTrue(reader.is_full)
+        self.assertEqual(reader.get_contents(), '\u00e9' * 524288)
+
+    def test_stream(self):
+        stream = io.BytesIO()
+        reader = self._read(b'abc' * 10000, sizelimit=1, stream=stream)
+        self.assertEqual(stream.getvalue(), b'abc' * 10000)
+        self.assertEqual(reader.get_contents(), '')
+
+    def test_stream_drops_invalid_utf8(self):
+        data = b'\xff' + '\u00e9'.encode('utf-8') * 3000 + b'\xfe\n'
+        stream = io.BytesIO()
+        self._read(data, stream=stream)
+        self.assertEqual(stream.getvalue(),
+                         self._read(data).get_contents().encode('utf-8'))
+        stream = io.BytesIO()
+        self._read(data, binary=True, stream=stream)
+        self.assertEqual(stream.getvalue(), data)
+
+
+class TailedFileWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'output')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, data, sizelimit, binary=True):
+        writer = TailedFileWriter(self.path, sizelimit, binary)
+        for idx in range(0, len(data), 100000):
+            writer.write(data[idx:idx + 100000])
+        writer.close()
+        with open(self.path, 'rb') as ofile:
+            return writer, ofile.read()
+
+    def test_within_limit(self):
+        writer, content = self._write(b'a' * 1048576, 1)
+        self.assertFalse(writer.truncated)
+        self.assertEqual(len(content), 1048576)
+
+    def test_tail_kept(self):
+        data = bytes(range(256)) * 10000
+        writer, content = self._write(data, 1)
+        self.assertTrue(writer.truncated)
+        self.assertEqual(content, data[-1048576:])
+        self.assertEqual(os.listdir(self.tmpdir), ['output'])
+
+    def test_text_tail_starts_on_character(self):
+        # the last MB starts with the second byte of a character
+        data = '\u00e9'.encode('utf-8') * 600000 + b'\n'
+        writer, content = self._write(data, 1, binary=False)
+        self.assertTrue(writer.truncated)
+        self.assertEqual(content, data[-1048575:])
+        writer, content = self._write(data, 1)
+        self.assertEqual(content, data[-1048576:])
+
+    def test_stream_command(self):
+        res = sos_get_command_output('seq 1 400000', sizelimit=1,
+                                     stream=self.path)
+        self.assertTrue(res['truncated'])
+        self.assertEqual(res['output'], '')
+        self.assertEqual(os.path.getsize(self.path), 1048576)
+
+
+class CopyFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'source')
+        self.dest = os.path.join(self.tmpdir, 'dest')
+        self.data = os.urandom(3 * 1048576 + 123)
+        with open(self.src, 'wb') as sfile:
+            sfile.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _dest_content(self):
+        with open(self.dest, 'rb') as dfile:
+            return dfile.read()
+
+    def test_whole_file(self):
+        self.assertEqual(copy_file(self.src, self.dest), len(self.data))
+        self.assertEqual(self._dest_content(), self.data)
+
+    def test_tail(self):
+        offset = len(self.data) - 1048576
+        self.assertEqual(
+            copy_file(self.src, self.dest, offset=offset, count=1048576),
+            1048576
+        )
+        self.assertEqual(self._dest_content(), self.data[-1048576:])
+
+    def test_buffered(self):
+        copy_file(self.src, self.dest, offset=10, buffered=True)
+        self.assertEqual(self._dest_content(), self.data[10:])
+
+    def test_pseudo_file(self):
+        copy_file('/proc/self/status', self.dest)
+        self.assertIn(b'Pid:', self._dest_content())
+
+    def test_kernel_copy_unsupported(self):
+        def unsupported(*args):
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        with mock.patch('os.copy_file_range', unsupported, create=True), \
+                mock.patch('os.sendfile', unsupported), \
+                mock.patch('fcntl.ioctl', unsupported):
+            copy_file(self.src, self.dest, offset=5, count=1000)
+        self.assertEqual(self._dest_content(), self.data[5:1005])
+
+    def test_growing_file(self):
+        copy_kernel = utilities._copy_kernel
+        appended = b'written during the copy\n'
+
+        def _copy_and_grow(*args):
+            copied = copy_kernel(*args)
+            with open(self.src, 'ab') as sfile:
+                sfile.write(appended)
+            return copied
+
+        with mock.patch('sos.utilities._copy_kernel', _copy_and_grow):
+            self.assertEqual(copy_file(self.src, self.dest),
+                             len(self.data) + len(appended))
+            self.assertEqual(self._dest_content(), self.data + appended)
+            # an explicit count is still honored
+            copy_file(self.src, self.dest, offset=5, count=1000)
+            self.assertEqual(self._dest_content(), self.data[5:1005])
+
+
+class CommandOverheadBenchmark(unittest.TestCase):
+    """Microbenchmark of the overhead sos_get_command_output() adds on top of
+    simply spawning a trivial command, which dominates the run time of plugins
+    that collect many short commands.
+    """
+
+    iterations = 50
+
+    def _time_per_cmd(self, func):
+        start = time.perf_counter()
+        for _ in range(self.iterations):
+            func()
+        return (time.perf_counter() - start) / self.iterations
+
+    def test_true_overhead(self):
+        base = self._time_per_cmd(lambda: subprocess.run(['true']))
+        plain = self._time_per_cmd(lambda: sos_get_command_output('true'))
+        polled = self._time_per_cmd(
+            lambda: sos_get_command_output('true', poller=lambda: False)
+        )
+        print(f"\nper-command time for 'true': spawn {base * 1000:.2f}ms, "
+              f"sos {plain * 1000:.2f}ms, sos+poller {polled * 1000:.2f}ms")
+        # waiting for completion must not be tied to a polling interval
+        self.assertLess(plain - base, 0.05)
+        self.assertLess(polled - base, 0.05)
+
 
 class FindTest(unittest.TestCase):
 